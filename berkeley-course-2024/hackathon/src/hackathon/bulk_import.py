@@ -0,0 +1,157 @@
+###################################################################################################
+# Offline bulk import: CSVs for neo4j-admin database import
+#
+# For initial loads of large corpora, the graph is written as CSV files with typed headers, imported
+# into an empty (stopped) database with `neo4j-admin database import full`, and the schema and the
+# vector index are created afterwards (see post_import):
+#
+#   entities.csv      Entity nodes: node_id, name, embedding (float array) and content_hash (see graph_sync)
+#   chunks.csv        Chunk nodes: id and text
+#   relates_to.csv    (Entity)-[:RELATES_TO {type}]->(Entity), from the triples of the chunks
+#   similar_to.csv    (Entity)-[:SIMILAR_TO]->(Entity), from the similar entity pairs
+#   mentions.csv      (Chunk)-[:MENTIONS]->(Entity), from the named entities of the chunks
+#
+# Chunk nodes and MENTIONS relationships are import-only: the Cypher loaders of graph_neo4j and the
+# incremental sync of graph_sync don't write (or update) them, and retrieval doesn't read them.
+###################################################################################################
+
+import argparse
+import csv
+import os
+
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from llm_foundation import logger
+
+from hackathon.graph_neo4j import bootstrap_schema, build_vector_index, claim_graph_document, entity_content_hash
+from hackathon.utils import Neo4jClientFactory
+from hackathon.vector_mirror import bump_entities_version
+
+ARRAY_DELIMITER = ";"
+NODE_FILES = {"Entity": "entities.csv", "Chunk": "chunks.csv"}
+RELATIONSHIP_FILES = {"RELATES_TO": "relates_to.csv", "SIMILAR_TO": "similar_to.csv", "MENTIONS": "mentions.csv"}
+
+
+def _write_entities(path: str, named_entities_dict: Dict[str, int], entities_embeddings, batch_size: int) -> int:
+    node_ids = np.sort(np.fromiter(named_entities_dict.values(), dtype=np.int64, count=len(named_entities_dict)))
+    uid2entity = {uid: entity for entity, uid in named_entities_dict.items()}
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["node_id:ID(Entity)", "name", "embedding:float[]", "content_hash"])
+        for start in range(0, len(node_ids), batch_size):
+            # Only a batch of (possibly memory-mapped) embeddings is in memory at a time. 9 significant digits
+            # round-trip float32, so the imported embeddings (and their content hashes) match the artifacts
+            batch_ids = node_ids[start:start + batch_size]
+            batch_embeddings = np.asarray(entities_embeddings[batch_ids], dtype=np.float32)
+            for node_id, embedding in zip(batch_ids.tolist(), batch_embeddings):
+                writer.writerow([node_id, uid2entity[node_id], ARRAY_DELIMITER.join(f"{value:.9g}" for value in embedding.tolist()),
+                                 entity_content_hash(uid2entity[node_id], embedding)])
+    return len(node_ids)
+
+
+def _write_similar_to(path: str, similar_pairs: np.ndarray) -> int:
+    # Unique, as MERGE would do
+    similar_pairs = np.unique(np.asarray(similar_pairs, dtype=np.int64).reshape(-1, 2), axis=0)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow([":START_ID(Entity)", ":END_ID(Entity)"])
+        writer.writerows(similar_pairs.tolist())
+    return len(similar_pairs)
+
+
+def _write_chunks(output_dir: str, named_entities_dict: Dict[str, int], doc_structure: Iterable[Dict]) -> Dict[str, int]:
+    """Writes the chunks, and the RELATES_TO and MENTIONS relationships, in a single pass over the chunks."""
+    counts = {"Chunk": 0, "RELATES_TO": 0, "MENTIONS": 0}
+    relates_to = set()  # Unique (subject, object, type), as MERGE would do
+    with open(os.path.join(output_dir, NODE_FILES["Chunk"]), "w", newline="") as chunks_file, \
+         open(os.path.join(output_dir, RELATIONSHIP_FILES["RELATES_TO"]), "w", newline="") as relates_to_file, \
+         open(os.path.join(output_dir, RELATIONSHIP_FILES["MENTIONS"]), "w", newline="") as mentions_file:
+        chunks_writer = csv.writer(chunks_file, lineterminator="\n")
+        relates_to_writer = csv.writer(relates_to_file, lineterminator="\n")
+        mentions_writer = csv.writer(mentions_file, lineterminator="\n")
+        chunks_writer.writerow(["id:ID(Chunk)", "text"])
+        relates_to_writer.writerow([":START_ID(Entity)", ":END_ID(Entity)", "type"])
+        mentions_writer.writerow([":START_ID(Chunk)", ":END_ID(Entity)"])
+
+        for chunk in doc_structure:
+            chunks_writer.writerow([chunk["id"], chunk.get("text", "")])
+            counts["Chunk"] += 1
+
+            # Only entities of the graph, like the MATCHes of graph_neo4j
+            mentioned = {named_entities_dict[entity.lower()] for entity in chunk.get("named_entities", []) if entity.lower() in named_entities_dict}
+            mentions_writer.writerows([chunk["id"], node_id] for node_id in sorted(mentioned))
+            counts["MENTIONS"] += len(mentioned)
+
+            for triple in chunk.get("triples", []):  # Chunks whose extraction failed have no triples
+                if len(triple) != 3:
+                    continue
+                subject, predicate, object = triple[0].lower(), triple[1].replace(" ", "_").upper(), triple[2].lower()
+                if subject not in named_entities_dict or object not in named_entities_dict:
+                    continue
+                relationship = (named_entities_dict[subject], named_entities_dict[object], predicate)
+                if relationship not in relates_to:
+                    relates_to.add(relationship)
+                    relates_to_writer.writerow(relationship)
+        counts["RELATES_TO"] = len(relates_to)
+    return counts
+
+
+def export_bulk_import(output_dir: str,
+                       named_entities_dict: Dict[str, int],
+                       entities_embeddings,
+                       doc_structure: Iterable[Dict],
+                       similar_pairs: np.ndarray,
+                       batch_size: int = 65536) -> Dict[str, int]:
+    """Writes the graph as CSV files for neo4j-admin database import (see neo4j_admin_import_command).
+
+    Streams from the artifacts: the chunks are read once, one at a time, and the embeddings in batches.
+    Unlike the Cypher loaders, the graph also has the Chunk nodes and MENTIONS relationships (import-only).
+
+    Args:
+        output_dir (str): directory for the CSV files.
+        named_entities_dict (Dict[str, int]): entity name -> node id.
+        entities_embeddings: (n, dimension) embeddings indexed by node id, e.g. a memory-mapped embeddings file.
+        doc_structure (Iterable[Dict]): the chunks, with id, text, named_entities and triples.
+        similar_pairs (np.ndarray): (n, 2) node ids of the similar entities (see index.find_similar_pairs).
+        batch_size (int, optional): embeddings formatted at a time. Defaults to 65536.
+
+    Returns:
+        Dict[str, int]: number of nodes/relationships written per label/type.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {"Entity": _write_entities(os.path.join(output_dir, NODE_FILES["Entity"]), named_entities_dict, entities_embeddings, batch_size)}
+    counts.update(_write_chunks(output_dir, named_entities_dict, doc_structure))
+    counts["SIMILAR_TO"] = _write_similar_to(os.path.join(output_dir, RELATIONSHIP_FILES["SIMILAR_TO"]), similar_pairs)
+    logger.info(f"Bulk import files written to {output_dir}: {counts}")
+    return counts
+
+
+def neo4j_admin_import_command(output_dir: str, database: str = "neo4j") -> str:
+    """Command importing the exported files into an empty database (the database must be stopped)."""
+    nodes = " ".join(f"--nodes={label}={os.path.join(output_dir, file)}" for label, file in NODE_FILES.items())
+    relationships = " ".join(f"--relationships={type}={os.path.join(output_dir, file)}" for type, file in RELATIONSHIP_FILES.items())
+    return (f"neo4j-admin database import full {database} --overwrite-destination --id-type=integer "
+            f"--multiline-fields=true --array-delimiter='{ARRAY_DELIMITER}' {nodes} {relationships}")
+
+
+def post_import(neo4j_factory: Neo4jClientFactory, emb_dim: int = 256, document: Optional[str] = None):
+    """Creates the constraints, indexes and the entity vector index once the database is imported and started.
+    If given, the document of the graph is recorded (see graph_neo4j.claim_graph_document)."""
+    bootstrap_schema(neo4j_factory)
+    if document is not None:
+        claim_graph_document(neo4j_factory, document)
+    build_vector_index(neo4j_factory, emb_dim=emb_dim)
+    neo4j_factory.langchain_client().query("CALL db.awaitIndexes()")
+    bump_entities_version(neo4j_factory)  # The entity vector mirrors of running apps reload the imported entities
+    logger.info("Post import schema and vector index created")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the schema and the vector index after a neo4j-admin import")
+    parser.add_argument("--emb-dim", type=int, default=256)
+    parser.add_argument("--document", help="Document of the imported graph, checked by the incremental sync")
+    args = parser.parse_args()
+
+    post_import(Neo4jClientFactory(), emb_dim=args.emb_dim, document=args.document)
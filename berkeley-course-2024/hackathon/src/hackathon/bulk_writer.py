@@ -0,0 +1,128 @@
+###################################################################################################
+# Batched UNWIND writes to Neo4j
+#
+# Instead of sending a whole dataset as a single $param list in one transaction (hundreds of MBs with
+# the embeddings, which times out or exhausts the heap), rows are streamed in batches of batch_size,
+# each written in its own transaction. Batches that don't conflict with each other (e.g. distinct nodes)
+# can be written in parallel sessions of the shared driver.
+###################################################################################################
+
+import os
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+from llm_foundation import logger
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+from pydantic import BaseModel
+
+from hackathon.retry import RetryConfig, retry_call
+from hackathon.utils import Neo4jClientFactory
+
+# Errors worth retrying: deadlocks, lock timeouts, leader switches, lost connections...
+TRANSIENT_ERRORS = (TransientError, ServiceUnavailable, SessionExpired)
+
+# Called with the rows of each batch once written (from the writer threads when parallel)
+BatchCallback = Callable[[List[Dict]], None]
+
+
+class BulkWriteConfig(RetryConfig):
+    """Batching of the writes, and retries of the batches failing with a transient error."""
+    batch_size: int = int(os.getenv("NEO4J_WRITE_BATCH_SIZE", "5000"))  # Rows per transaction
+    parallelism: int = int(os.getenv("NEO4J_WRITE_PARALLELISM", "4"))  # Sessions writing batches at the same time
+
+
+class BulkWriteReport(BaseModel):
+    name: str
+    rows: int = 0
+    batches: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def batched(rows: Iterable[Dict], batch_size: int) -> Iterator[List[Dict]]:
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        yield batch
+
+
+class BulkWriter:
+    """Writes rows to Neo4j with an UNWIND query, in batches, optionally in parallel, retrying transient failures.
+
+    The query gets each batch as the $rows parameter, e.g.:
+
+        writer.write("UNWIND $rows AS row MERGE (a:Entity {node_id: row.node_id})", rows, name="entities")
+    """
+
+    def __init__(self, neo4j_factory: Neo4jClientFactory, config: Optional[BulkWriteConfig] = None):
+        self.neo4j_factory = neo4j_factory
+        self.config = config or BulkWriteConfig()
+
+    def _write_batch(self, query: str, batch: List[Dict], report: BulkWriteReport, lock: threading.Lock):
+        def write():
+            with self.neo4j_factory.neo4j_client() as driver:
+                with driver.session(database=self.neo4j_factory.database) as session:
+                    session.execute_write(lambda tx: tx.run(query, rows=batch).consume())
+
+        def on_retry(attempt: int, e: Exception, wait_time: float):
+            logger.warning(f"{report.name}: batch of {len(batch)} rows failed ({e}). Retrying in {wait_time:.1f}s")
+            with lock:
+                report.retries += 1
+
+        retry_call(write, self.config, retry_on=TRANSIENT_ERRORS, on_retry=on_retry)
+
+    def write(self, query: str, rows: Iterable[Dict], name: str = "rows", parallel: bool = True,
+              on_batch: Optional[BatchCallback] = None) -> BulkWriteReport:
+        """Writes the rows (any iterable, consumed lazily) in batches.
+
+        Args:
+            query (str): UNWIND query over the $rows parameter.
+            rows (Iterable[Dict]): the rows to write.
+            name (str, optional): what is written, for the logs and the report. Defaults to "rows".
+            parallel (bool, optional): whether batches can be written concurrently (config.parallelism sessions).
+                Only for batches that don't conflict, e.g. creating distinct nodes. Relationship MERGEs lock
+                both ends, so they deadlock (and retry) when parallel. Defaults to True.
+            on_batch (Optional[BatchCallback], optional): called with the rows of each written batch.
+
+        Returns:
+            BulkWriteReport: rows, batches, retries, time and rows/second.
+        """
+        report = BulkWriteReport(name=name)
+        lock = threading.Lock()
+        start = time.perf_counter()
+
+        def write_batch(batch: List[Dict]):
+            self._write_batch(query, batch, report, lock)
+            if on_batch is not None:
+                on_batch(batch)
+            with lock:
+                report.rows += len(batch)
+                report.batches += 1
+
+        batches = batched(rows, self.config.batch_size)
+        if not parallel or self.config.parallelism <= 1:
+            for batch in batches:
+                write_batch(batch)
+        else:
+            with ThreadPoolExecutor(max_workers=self.config.parallelism) as executor:
+                pending: Set[Future] = set()
+                for batch in batches:
+                    if len(pending) >= 2 * self.config.parallelism:  # Bound the batches in memory
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(write_batch, batch))
+                for future in pending:
+                    future.result()
+
+        report.seconds = time.perf_counter() - start
+        logger.info(f"{report.name}: {report.rows} rows written in {report.batches} batches ({report.retries} retries) "
+                    f"in {report.seconds:.1f}s, {report.rows_per_second:.0f} rows/s")
+        return report
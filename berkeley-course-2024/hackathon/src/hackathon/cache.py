@@ -0,0 +1,242 @@
+###################################################################################################
+# On-disk caches
+###################################################################################################
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+from llm_foundation import logger
+from pydantic import BaseModel
+
+
+def sha256_hexdigest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    entries: int = 0
+    size_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class DiskLRUCache:
+    """Persistent key -> bytes cache in a SQLite file, bounded in size with LRU eviction.
+
+    Safe to share between threads. Hits and misses are counted per instance (i.e. per process run).
+    """
+
+    def __init__(self, path: str, max_size_bytes: int = 1 << 30):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._conn.commit()
+        self._stats = CacheStats()
+        self._stats.entries, self._stats.size_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats.misses += 1
+                return None
+            self._stats.hits += 1
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time_ns(), key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if previous is not None:
+                self._stats.entries -= 1
+                self._stats.size_bytes -= previous[0]
+            self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, value, len(value), time.time_ns()))
+            self._stats.entries += 1
+            self._stats.size_bytes += len(value)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        while self._stats.size_bytes > self.max_size_bytes and self._stats.entries > 1:
+            key, size = self._conn.execute("SELECT key, size FROM entries ORDER BY last_access LIMIT 1").fetchone()
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._stats.entries -= 1
+            self._stats.size_bytes -= size
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return self._stats.model_copy()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LLMResponseCache(DiskLRUCache):
+    """Cache of LLM responses (JSON serializable), keyed by the model, the prompt, the role and the input text.
+
+    The prompt is the rendered prompt/instructions without the input (e.g. the system message and the
+    examples), so changing the prompt, the model or the role invalidates the cached responses.
+    """
+
+    @staticmethod
+    def make_key(model: str, prompt: str, role: str, input_text: str) -> str:
+        return sha256_hexdigest(json.dumps([model, sha256_hexdigest(prompt), role, sha256_hexdigest(input_text)]))
+
+    def get_response(self, model: str, prompt: str, role: str, input_text: str) -> Optional[Any]:
+        value = self.get(self.make_key(model, prompt, role, input_text))
+        return None if value is None else json.loads(value)
+
+    def set_response(self, model: str, prompt: str, role: str, input_text: str, response: Any):
+        self.set(self.make_key(model, prompt, role, input_text), json.dumps(response).encode())
+
+    def cached_call(self, model: str, prompt: str, role: str, input_text: str, call: Callable[[], Any]) -> Any:
+        """Returns the cached response, or calls the LLM with call() and caches its response."""
+        response = self.get_response(model, prompt, role, input_text)
+        if response is None:
+            response = call()
+            self.set_response(model, prompt, role, input_text, response)
+        return response
+
+
+@lru_cache(maxsize=None)
+def get_llm_response_cache() -> Optional[LLMResponseCache]:
+    """Process-wide LLM response cache, configured with the LLM_CACHE_PATH and LLM_CACHE_MAX_MB env variables.
+    Returns None (no caching) if LLM_CACHE_PATH is set to an empty string."""
+    path = os.getenv("LLM_CACHE_PATH", ".cache/llm_responses.sqlite")
+    if not path:
+        return None
+    cache = LLMResponseCache(path, max_size_bytes=int(os.getenv("LLM_CACHE_MAX_MB", "1024")) << 20)
+    logger.info(f"LLM response cache at {path}: {cache.stats()}")
+    return cache
+
+
+class EmbeddingCacheStats(BaseModel):
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    deduped: int = 0  # Repeated texts in the same request, embedded only once
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+
+def normalize_embedding_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model, dimensions, normalized text).
+
+    An in-memory LRU of the most recent embeddings sits in front of an on-disk LRU (DiskLRUCache), so
+    only the texts that were never embedded before with the same model and dimensions are sent to the
+    embedding model. Embeddings are stored as float64 so cached values are exactly the ones returned by
+    the model.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int = 1 << 30, max_memory_entries: int = 100_000):
+        self.disk_cache = DiskLRUCache(path, max_size_bytes=max_size_bytes)
+        self.max_memory_entries = max_memory_entries
+        self._memory_cache: OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = EmbeddingCacheStats()
+
+    @staticmethod
+    def make_key(model: str, dimensions: int, text: str) -> str:
+        return sha256_hexdigest(json.dumps([model, dimensions, normalize_embedding_text(text)]))
+
+    def get(self, model: str, dimensions: int, text: str) -> Optional[List[float]]:
+        key = self.make_key(model, dimensions, text)
+        with self._lock:
+            embedding = self._memory_cache.get(key)
+            if embedding is not None:
+                self._memory_cache.move_to_end(key)
+                self._stats.memory_hits += 1
+                return embedding
+        value = self.disk_cache.get(key)
+        with self._lock:
+            if value is None:
+                self._stats.misses += 1
+                return None
+            self._stats.disk_hits += 1
+            embedding = np.frombuffer(value, dtype=np.float64).tolist()
+            self._remember(key, embedding)
+            return embedding
+
+    def set(self, model: str, dimensions: int, text: str, embedding: List[float]):
+        key = self.make_key(model, dimensions, text)
+        self.disk_cache.set(key, np.asarray(embedding, dtype=np.float64).tobytes())
+        with self._lock:
+            self._remember(key, list(embedding))
+
+    def _remember(self, key: str, embedding: List[float]):
+        self._memory_cache[key] = embedding
+        self._memory_cache.move_to_end(key)
+        while len(self._memory_cache) > self.max_memory_entries:
+            self._memory_cache.popitem(last=False)
+
+    def embed_documents(self, embeddings_model, model: str, dimensions: int, docs: List[str]) -> List[List[float]]:
+        """Embeds the docs with embeddings_model (a LangChain Embeddings), only sending the deduped cache misses."""
+        embeddings: List[Optional[List[float]]] = [None] * len(docs)
+        missing_positions: OrderedDict[str, List[int]] = OrderedDict()  # Normalized text -> positions in docs
+        for position, doc in enumerate(docs):
+            normalized_doc = normalize_embedding_text(doc)
+            if normalized_doc in missing_positions:
+                missing_positions[normalized_doc].append(position)
+                with self._lock:
+                    self._stats.deduped += 1
+                continue
+            embeddings[position] = self.get(model, dimensions, doc)
+            if embeddings[position] is None:
+                missing_positions[normalized_doc] = [position]
+
+        if missing_positions:
+            missing_docs = [docs[positions[0]] for positions in missing_positions.values()]
+            logger.info(f"Embedding {len(missing_docs)} cache misses out of {len(docs)} docs")
+            new_embeddings = embeddings_model.embed_documents(missing_docs)
+            for doc, embedding, positions in zip(missing_docs, new_embeddings, missing_positions.values()):
+                self.set(model, dimensions, doc, embedding)
+                for position in positions:
+                    embeddings[position] = embedding
+        return embeddings
+
+    def stats(self) -> EmbeddingCacheStats:
+        with self._lock:
+            return self._stats.model_copy()
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Process-wide embedding cache, configured with the EMBEDDING_CACHE_PATH and EMBEDDING_CACHE_MAX_MB env
+    variables. Returns None (no caching) if EMBEDDING_CACHE_PATH is set to an empty string."""
+    path = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite")
+    if not path:
+        return None
+    cache = EmbeddingCache(path, max_size_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024")) << 20)
+    logger.info(f"Embedding cache at {path}: {cache.disk_cache.stats()}")
+    return cache
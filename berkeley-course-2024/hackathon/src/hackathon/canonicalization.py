@@ -0,0 +1,160 @@
+###################################################################################################
+# Entity canonicalization: merge near-duplicate entities ("hipporag", "hippo rag", "hipporag's")
+###################################################################################################
+
+import json
+import os
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import scipy.sparse as sp
+
+from llm_foundation import logger
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1 with path compression and union by size."""
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x: int) -> int:
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x: int, y: int):
+        root_x, root_y = self.find(x), self.find(y)
+        if root_x == root_y:
+            return
+        if self.size[root_x] < self.size[root_y]:
+            root_x, root_y = root_y, root_x
+        self.parent[root_y] = root_x
+        self.size[root_x] += self.size[root_y]
+
+
+class CanonicalEntities:
+    """Mapping of the entities of a document to their canonical entities.
+
+    Canonical entities get new dense uids (0..n_canonical-1, in the order of the uids of their
+    representatives), as the uids are the rows of the entity x chunk matrix and the PageRank vector.
+
+    Attributes:
+        entity2uid (Dict[str, int]): canonical entity -> new uid.
+        aliases (Dict[str, str]): every original entity (canonical ones included) -> its canonical entity.
+        old2new (np.ndarray): new uid of each original uid.
+        representatives (List[int]): original uid of each canonical entity, by new uid.
+    """
+
+    def __init__(self, entity2uid: Dict[str, int], aliases: Dict[str, str], old2new: np.ndarray, representatives: List[int]):
+        self.entity2uid = entity2uid
+        self.aliases = aliases
+        self.old2new = old2new
+        self.representatives = representatives
+
+    def canonical_name(self, entity: str) -> str:
+        """Canonical entity of an entity (the entity itself if it's unknown)."""
+        return self.aliases.get(entity.lower(), entity.lower())
+
+    def remap_matrix(self, entities_ref_count_matrix: sp.spmatrix) -> sp.csr_matrix:
+        """Sums the rows of the aliases of each canonical entity in the (n_entities x n_chunks) ref count matrix."""
+        n_entities = entities_ref_count_matrix.shape[0]
+        aggregation = sp.csr_matrix((np.ones(n_entities, dtype=np.int64), (self.old2new, np.arange(n_entities))),
+                                    shape=(len(self.representatives), n_entities))
+        matrix = (aggregation @ sp.csr_matrix(entities_ref_count_matrix, dtype=np.int64)).tocsr()
+        return matrix.astype(np.min_scalar_type(matrix.max() if matrix.nnz else 0))
+
+    def remap_embeddings(self, entities_embeddings: np.ndarray) -> np.ndarray:
+        """The embedding of each canonical entity is the one of its representative."""
+        return np.asarray(entities_embeddings[self.representatives])
+
+    def remap_similar_pairs(self, similar_pairs: np.ndarray) -> np.ndarray:
+        """Maps (uid, uid) pairs to new uids, dropping the ones merged in the same canonical entity and the duplicates."""
+        similar_pairs = self.old2new[np.asarray(similar_pairs, dtype=np.int64).reshape(-1, 2)]
+        similar_pairs = similar_pairs[similar_pairs[:, 0] != similar_pairs[:, 1]]
+        _, first_positions = np.unique(similar_pairs, axis=0, return_index=True)
+        return similar_pairs[np.sort(first_positions)]
+
+    def remap_document_structure(self, document_chunks: List[Dict]) -> List[Dict]:
+        """Copies of the chunks with their named entities and the subjects/objects of their triples canonicalized."""
+        remapped_chunks = []
+        for chunk in document_chunks:
+            chunk = dict(chunk)
+            if "named_entities" in chunk:
+                chunk["named_entities"] = list(dict.fromkeys(self.canonical_name(entity) for entity in chunk["named_entities"]))
+            if "triples" in chunk:
+                chunk["triples"] = [[self.canonical_name(triple[0]), triple[1], self.canonical_name(triple[2])] if len(triple) == 3 else triple
+                                    for triple in chunk["triples"]]
+            remapped_chunks.append(chunk)
+        return remapped_chunks
+
+    def save_aliases(self, output_file: str):
+        with open(output_file, "w") as f:
+            json.dump(self.aliases, f, indent=4)
+        logger.info(f"Entity aliases saved to {output_file}")
+
+
+def load_entity_aliases(input_file: str) -> Dict[str, str]:
+    with open(input_file, "r") as f:
+        return json.load(f)
+
+
+def canonicalization_enabled() -> bool:
+    """Whether the entities are merged into canonical entities (CANONICALIZE_ENTITIES env var)."""
+    return os.getenv("CANONICALIZE_ENTITIES", "false").lower() == "true"
+
+
+def canonicalize_entities(named_entities_dict: Dict[str, int],
+                          similar_pairs: np.ndarray,
+                          entities_ref_count_matrix: Optional[sp.spmatrix] = None,
+                          mutual_only: bool = True) -> CanonicalEntities:
+    """Clusters the similar entities with union-find and picks a canonical entity per cluster.
+
+    The canonical entity of a cluster is the most referenced one in the chunks (if the ref count matrix
+    is given), then the shortest name, then the lowest uid.
+
+    Args:
+        named_entities_dict (Dict[str, int]): entity -> uid (0..n-1).
+        similar_pairs (np.ndarray): (n_pairs, 2) similar (uid, uid) pairs, e.g. from index.find_similar_pairs.
+        entities_ref_count_matrix (Optional[sp.spmatrix], optional): (n_entities x n_chunks) ref counts. Defaults to None.
+        mutual_only (bool, optional): only merge the pairs found in both directions (each entity is among the
+        neighbors of the other), which avoids chaining unrelated entities through hubs. Defaults to True.
+
+    Returns:
+        CanonicalEntities: the canonical entities and the mapping of the original ones.
+    """
+    uid2entity = {uid: entity for entity, uid in named_entities_dict.items()}
+    n_entities = len(uid2entity)
+    similar_pairs = np.asarray(similar_pairs, dtype=np.int64).reshape(-1, 2)
+    if mutual_only:
+        pair_set = set(map(tuple, similar_pairs.tolist()))
+        merged_pairs = [(a, b) for a, b in pair_set if a < b and (b, a) in pair_set]
+    else:
+        merged_pairs = similar_pairs.tolist()
+
+    clusters = UnionFind(n_entities)
+    for a, b in merged_pairs:
+        clusters.union(a, b)
+
+    ref_counts = (np.asarray(entities_ref_count_matrix.sum(axis=1), dtype=np.int64).ravel() if entities_ref_count_matrix is not None
+                  else np.zeros(n_entities, dtype=np.int64))
+    members: Dict[int, List[int]] = {}
+    for uid in range(n_entities):
+        members.setdefault(clusters.find(uid), []).append(uid)
+    representative_of_root = {root: min(uids, key=lambda uid: (-ref_counts[uid], len(uid2entity[uid]), uid))
+                              for root, uids in members.items()}
+
+    representatives = sorted(representative_of_root.values())
+    new_uid_of_representative = {representative: new_uid for new_uid, representative in enumerate(representatives)}
+    old2new = np.array([new_uid_of_representative[representative_of_root[clusters.find(uid)]] for uid in range(n_entities)], dtype=np.int64)
+    entity2uid = {uid2entity[representative]: new_uid for new_uid, representative in enumerate(representatives)}
+    aliases = {uid2entity[uid]: uid2entity[representatives[old2new[uid]]] for uid in range(n_entities)}
+
+    logger.info(f"Canonicalization: {n_entities} entities merged into {len(representatives)} canonical entities "
+                f"({len(merged_pairs)} merged pairs out of {len(similar_pairs)} similar pairs)")
+    return CanonicalEntities(entity2uid, aliases, old2new, representatives)
@@ -0,0 +1,199 @@
+###################################################################################################
+# Corpus ingestion: parse and chunk many PDFs in parallel
+###################################################################################################
+
+import argparse
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Literal, Optional
+
+from llm_foundation import logger
+
+from hackathon.utils import (DOCUMENT_STRUCTURE_SUFFIXES, document_structure_path, extracted_chunks_by_digest, file_digest,
+                             iter_document_structure, load_document_structure, reuse_extracted_chunk, save_document_structure)
+
+CORPUS_MANIFEST_FILE = "corpus_manifest.json"
+
+
+def list_corpus_documents(source: str) -> List[str]:
+    """Lists the PDF documents of a corpus.
+
+    Args:
+        source (str): a directory (all the PDFs in it, recursively, are taken) or a manifest file. The
+        manifest can be a text file with one path per line or a JSON file with a list of paths (or a dict
+        with a "documents" list). Relative paths in a manifest are resolved against the manifest directory.
+
+    Returns:
+        List[str]: the sorted paths to the documents of the corpus.
+    """
+    if os.path.isdir(source):
+        documents = []
+        for root, _, files in os.walk(source):
+            documents.extend(os.path.join(root, f) for f in files if f.lower().endswith(".pdf"))
+        return sorted(documents)
+
+    with open(source, "r") as f:
+        if source.endswith(".json"):
+            manifest = json.load(f)
+            documents = manifest["documents"] if isinstance(manifest, dict) else manifest
+        else:
+            documents = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    base_dir = os.path.dirname(os.path.abspath(source))
+    return [d if os.path.isabs(d) else os.path.join(base_dir, d) for d in documents]
+
+
+def corpus_root(source: str, documents: List[str]) -> str:
+    """The directory the artifacts paths are relative to: the corpus directory, or the common directory of
+    the documents of a manifest."""
+    if os.path.isdir(source):
+        return os.path.abspath(source)
+    if not documents:
+        return os.path.dirname(os.path.abspath(source))
+    return os.path.commonpath([os.path.dirname(os.path.abspath(document)) for document in documents])
+
+
+def ingest_document(document_path: str,
+                    output_dir: str,
+                    chunk_size: int = 1000,
+                    char_overlap: int = 0,
+                    format: Literal["pickle", "columnar"] = "columnar",
+                    source_root: Optional[str] = None,
+                    source_digest: Optional[str] = None) -> Dict:
+    """Chunks a single document and saves its document structure artifact. Runs in the pool workers.
+
+    If the artifact already exists, the entities and triples extracted for the chunks that didn't change
+    are carried over to the new artifact, so only new or changed chunks are pending extraction. With a
+    source_root, the artifact keeps the path of the document relative to it (see document_artifact_path).
+    The source_digest (see file_digest) is computed if not given.
+
+    Columnar artifacts are written streaming over the chunks, page at a time (see iter_document_structure),
+    so only the extractions of the previous artifact are kept in memory. Pickle artifacts need all the chunks.
+    """
+    artifact = document_structure_path(document_path, format, output_dir=output_dir, source_root=source_root)
+    os.makedirs(os.path.dirname(artifact) or ".", exist_ok=True)
+    extracted_chunks = extracted_chunks_by_digest(load_document_structure(artifact)) if os.path.exists(artifact) else {}
+    counts = {"n_chunks": 0, "n_pending_chunks": 0}
+
+    def iter_chunks():
+        for chunk in iter_document_structure(document_path, chunk_size=chunk_size, char_overlap=char_overlap):
+            counts["n_chunks"] += 1
+            if not reuse_extracted_chunk(chunk, extracted_chunks):
+                counts["n_pending_chunks"] += 1
+            yield chunk
+
+    document_chunks = iter_chunks() if format == "columnar" else list(iter_chunks())
+    save_document_structure(document_chunks, artifact, format=format)
+    logger.info(f"Reused extractions for {counts['n_chunks'] - counts['n_pending_chunks']} chunks of {document_path}. "
+                f"{counts['n_pending_chunks']} chunks pending")
+    return {
+        "document": os.path.basename(document_path),
+        "source_path": os.path.abspath(document_path),
+        "source_digest": source_digest or file_digest(document_path),
+        "artifact": os.path.abspath(artifact),
+        **counts,
+    }
+
+
+def _load_corpus_manifest(output_dir: str) -> Dict:
+    manifest_file = os.path.join(output_dir, CORPUS_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+
+def ingest_corpus(source: str,
+                  output_dir: str,
+                  chunk_size: int = 1000,
+                  char_overlap: int = 0,
+                  max_workers: Optional[int] = None,
+                  format: Literal["pickle", "columnar"] = "columnar") -> Dict:
+    """Parses and chunks all the documents of a corpus in parallel with a process pool.
+
+    One document structure artifact is written per document in output_dir (keeping the path of the document
+    relative to the corpus directory, so same-named documents in different directories don't collide), plus a corpus manifest
+    (corpus_manifest.json) describing the ingestion. Documents that fail are logged and recorded in
+    the manifest with their error, but don't stop the ingestion of the rest of the corpus.
+
+    Re-ingestion is incremental: documents whose bytes and chunking params didn't change since the last
+    manifest, and whose artifact is still there, are skipped. Changed documents are re-chunked reusing
+    the extractions of their unchanged chunks (see ingest_document).
+
+    Args:
+        source (str): directory or manifest file with the documents of the corpus (see list_corpus_documents).
+        output_dir (str): directory where the artifacts and the corpus manifest are written.
+        chunk_size (int, optional): max number of chars per chunk. Defaults to 1000.
+        char_overlap (int, optional): number of chars overlapping between chunks. Defaults to 0.
+        max_workers (Optional[int], optional): number of worker processes. Defaults to all cores.
+        format (Literal["pickle", "columnar"], optional): format of the document structure artifacts.
+        Defaults to "columnar" (see hackathon.document_store).
+
+    Returns:
+        Dict: the corpus manifest.
+    """
+    documents = list_corpus_documents(source)
+    source_root = corpus_root(source, documents)
+    artifact_suffix = DOCUMENT_STRUCTURE_SUFFIXES[format]
+    os.makedirs(output_dir, exist_ok=True)
+    max_workers = max_workers or os.cpu_count() or 1
+    logger.info(f"Ingesting {len(documents)} documents from {source} with {max_workers} workers")
+
+    entries: Dict[str, Dict] = {}
+    source_digests: Dict[str, str] = {}  # Each document is hashed once, here or in its worker
+    previous_manifest = _load_corpus_manifest(output_dir)
+    if (previous_manifest.get("chunk_size") == chunk_size and previous_manifest.get("char_overlap") == char_overlap
+            and previous_manifest.get("format", "pickle") == format):
+        previous_entries = {e["source_path"]: e for e in previous_manifest["documents"] if "error" not in e}
+        for document in documents:
+            previous_entry = previous_entries.get(os.path.abspath(document))
+            # Artifacts written under an older naming (e.g. without the relative path) are rebuilt
+            if (previous_entry is None or not os.path.exists(previous_entry["artifact"])
+                    or previous_entry["artifact"] != os.path.abspath(document_artifact_path(document, artifact_suffix, output_dir, source_root))):
+                continue
+            source_digests[document] = file_digest(document)
+            if previous_entry["source_digest"] == source_digests[document]:
+                entries[document] = previous_entry
+        logger.info(f"{len(entries)} documents unchanged since the last ingestion. Skipping them")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(ingest_document, document, output_dir, chunk_size, char_overlap, format, source_root,
+                            source_digests.get(document)): document
+            for document in documents if document not in entries
+        }
+        for future in as_completed(futures):
+            document = futures[future]
+            try:
+                entries[document] = future.result()
+                logger.info(f"Ingested {document}: {entries[document]['n_chunks']} chunks")
+            except Exception as e:
+                logger.error(f"Error ingesting {document}: {e}")
+                entries[document] = {"document": os.path.basename(document), "source_path": os.path.abspath(document), "error": str(e)}
+
+    manifest = {
+        "chunk_size": chunk_size,
+        "char_overlap": char_overlap,
+        "format": format,
+        "documents": [entries[document] for document in documents],  # Keep the order of the corpus listing
+    }
+    manifest_file = os.path.join(output_dir, CORPUS_MANIFEST_FILE)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+    logger.info(f"Corpus manifest saved to {manifest_file}")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse and chunk a corpus of PDFs in parallel")
+    parser.add_argument("source", help="Directory with PDFs or manifest file (.txt/.json) listing them")
+    parser.add_argument("--output-dir", default="corpus")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--char-overlap", type=int, default=0)
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--format", choices=["pickle", "columnar"], default="columnar")
+    args = parser.parse_args()
+
+    ingest_corpus(args.source, args.output_dir, chunk_size=args.chunk_size, char_overlap=args.char_overlap,
+                  max_workers=args.max_workers, format=args.format)
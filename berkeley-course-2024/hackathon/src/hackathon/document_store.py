@@ -0,0 +1,250 @@
+###################################################################################################
+# Columnar document structure store
+#
+# A document structure (the list of chunk dicts with id, text, named_entities, triples...) is stored
+# as a directory with one pair of files per column (field of the chunks):
+#
+#   meta.json            version, number of chunks, columns and their codecs, compression
+#   ids.npy              the chunk ids, in row order
+#   <column>.data        the encoded values of the column, concatenated in row order
+#   <column>.offsets.npy the offsets of the values in the data file (n_chunks + 1 entries)
+#   <column>.valid.npy   bitmap (np.packbits) of the chunks having a value for the column, as values
+#                        can be empty (e.g. an empty text)
+#
+# Data files are memory-mapped and offsets are loaded with mmap_mode, so opening a store is
+# near-instant regardless of its size and reading a chunk (or a column of a chunk) only pages in
+# the bytes of that value.
+###################################################################################################
+
+import json
+import mmap
+import os
+import shutil
+import zlib
+
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Optional, Union
+
+import numpy as np
+
+from llm_foundation import logger
+
+STORE_VERSION = 2
+SUPPORTED_STORE_VERSIONS = (1, 2)  # Version 1 stores have no validity bitmaps: empty values are missing
+META_FILE = "meta.json"
+IDS_FILE = "ids.npy"
+
+Compression = Optional[Literal["zlib"]]
+
+
+def _encode(value: Any, codec: str, compression: Compression) -> bytes:
+    data = value.encode() if codec == "utf8" else json.dumps(value).encode()
+    return zlib.compress(data) if compression == "zlib" else data
+
+
+def _decode(data: bytes, codec: str, compression: Compression) -> Any:
+    if compression == "zlib":
+        data = zlib.decompress(data)
+    return data.decode() if codec == "utf8" else json.loads(data)
+
+
+class ColumnarDocumentStore:
+    """Read access to a document structure saved in the columnar format.
+
+    Behaves as a read-only sequence of chunk dicts (len, indexing by position, iteration), so it can
+    be used where a document structure list is expected for reading, e.g. in retrieve_context. Values
+    are decoded on access, so mutating the returned dicts doesn't change the store. Use to_list() to
+    get a regular (mutable) document structure.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] not in SUPPORTED_STORE_VERSIONS:
+            raise ValueError(f"Unsupported document store version: {self.meta['version']}")
+        self.compression: Compression = self.meta["compression"]
+        self.codecs: Dict[str, str] = self.meta["columns"]
+        self.ids = np.load(os.path.join(path, IDS_FILE), mmap_mode="r")
+        self._offsets: Dict[str, np.ndarray] = {}
+        self._valid: Dict[str, Optional[np.ndarray]] = {}
+        self._data: Dict[str, Union[mmap.mmap, bytes]] = {}
+        self._id2position: Optional[Dict[int, int]] = None
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.codecs.keys())
+
+    def __len__(self) -> int:
+        return self.meta["n_chunks"]
+
+    def __getitem__(self, position: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(position, slice):
+            return [self.row(p) for p in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(f"Chunk position {position} out of range")
+        return self.row(position)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return self.iter_rows()
+
+    def _column_files(self, column: str):
+        if column not in self._data:
+            if column not in self.codecs:
+                raise KeyError(f"Unknown column {column}. Columns are: {self.columns}")
+            self._offsets[column] = np.load(os.path.join(self.path, f"{column}.offsets.npy"), mmap_mode="r")
+            valid_file = os.path.join(self.path, f"{column}.valid.npy")
+            self._valid[column] = np.load(valid_file, mmap_mode="r") if os.path.exists(valid_file) else None
+            data_file = os.path.join(self.path, f"{column}.data")
+            if os.path.getsize(data_file) == 0:
+                self._data[column] = b""  # Empty files can't be memory-mapped
+            else:
+                with open(data_file, "rb") as f:
+                    self._data[column] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._offsets[column], self._data[column]
+
+    def value(self, position: int, column: str) -> Any:
+        """Decodes the value of a column for the chunk at a position. Raises KeyError if the chunk has no value."""
+        offsets, data = self._column_files(column)
+        start, end = int(offsets[position]), int(offsets[position + 1])
+        valid = self._valid[column]
+        if valid is None:  # Version 1 stores: zero-length values are the chunks missing the column
+            if start == end:
+                raise KeyError(column)
+        elif not (int(valid[position >> 3]) >> (7 - (position & 7))) & 1:
+            raise KeyError(column)
+        return _decode(data[start:end], self.codecs[column], self.compression)
+
+    def row(self, position: int, columns: Optional[List[str]] = None) -> Dict:
+        """Returns the chunk at a position with all (or only the given) columns."""
+        chunk = {}
+        for column in columns or self.columns:
+            try:
+                chunk[column] = self.value(position, column)
+            except KeyError:
+                continue
+        return chunk
+
+    def position(self, chunk_id: int) -> int:
+        """Returns the row position of a chunk id."""
+        if self.meta["sequential_ids"]:
+            if not 0 <= chunk_id < len(self):
+                raise KeyError(f"Unknown chunk id {chunk_id}")
+            return chunk_id
+        if self._id2position is None:
+            self._id2position = {int(chunk_id): position for position, chunk_id in enumerate(self.ids)}
+        return self._id2position[chunk_id]
+
+    def get(self, chunk_id: int, column: Optional[str] = None) -> Any:
+        """Returns a chunk (or the value of one of its columns) by chunk id."""
+        position = self.position(chunk_id)
+        return self.row(position) if column is None else self.value(position, column)
+
+    def column(self, column: str) -> Iterator[Any]:
+        """Iterates over the values of a column, in row order. Chunks missing the column yield None."""
+        for position in range(len(self)):
+            try:
+                yield self.value(position, column)
+            except KeyError:
+                yield None
+
+    def iter_rows(self, columns: Optional[List[str]] = None) -> Iterator[Dict]:
+        """Iterates over the chunks with all (or only the given) columns, in row order."""
+        for position in range(len(self)):
+            yield self.row(position, columns)
+
+    def to_list(self) -> List[Dict]:
+        return list(self.iter_rows())
+
+    def close(self):
+        for data in self._data.values():
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self._data.clear()
+        self._offsets.clear()
+        self._valid.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def write(document_chunks: Iterable[Dict], path: str, compression: Compression = None) -> int:
+        """Writes a document structure in the columnar format, streaming over the chunks.
+
+        Columns are created as they are found in the chunks. String columns (e.g. text) are stored
+        as UTF-8, the rest (e.g. named_entities, triples) as JSON. Values are compressed one by one,
+        so random access to single values is kept with compression.
+
+        The store is written to a temporary directory and moved into place at the end, so an
+        existing store at the same path can be read while the new one is being written.
+
+        Args:
+            document_chunks (Iterable[Dict]): the chunks, e.g. a list or the iter_document_structure generator.
+            path (str): directory of the store.
+            compression (Compression, optional): None or "zlib". Defaults to None.
+
+        Returns:
+            int: the number of chunks written.
+        """
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        codecs: Dict[str, str] = {}
+        data_files = {}
+        offsets: Dict[str, List[int]] = {}
+        valid: Dict[str, List[bool]] = {}
+        ids: List[int] = []
+        try:
+            for position, chunk in enumerate(document_chunks):
+                ids.append(chunk["id"])
+                for column, value in chunk.items():
+                    if column not in codecs:
+                        codecs[column] = "utf8" if isinstance(value, str) else "json"
+                        data_files[column] = open(os.path.join(tmp_path, f"{column}.data"), "wb")
+                        offsets[column] = [0] * (position + 1)  # Chunks before have no value
+                        valid[column] = [False] * position
+                    data = _encode(value, codecs[column], compression)
+                    data_files[column].write(data)
+                    offsets[column].append(offsets[column][-1] + len(data))
+                    valid[column].append(True)
+                for column in codecs:
+                    if len(offsets[column]) == position + 1:  # This chunk has no value for the column
+                        offsets[column].append(offsets[column][-1])
+                        valid[column].append(False)
+        finally:
+            for data_file in data_files.values():
+                data_file.close()
+
+        for column, column_offsets in offsets.items():
+            np.save(os.path.join(tmp_path, f"{column}.offsets.npy"), np.array(column_offsets, dtype=np.int64))
+            np.save(os.path.join(tmp_path, f"{column}.valid.npy"), np.packbits(np.array(valid[column], dtype=bool)))
+        np.save(os.path.join(tmp_path, IDS_FILE), np.array(ids, dtype=np.int64))
+        meta = {
+            "version": STORE_VERSION,
+            "n_chunks": len(ids),
+            "columns": codecs,
+            "compression": compression,
+            "sequential_ids": ids == list(range(len(ids))),
+        }
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=4)
+
+        if os.path.exists(path):
+            old_path = f"{path}.old"
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp_path, path)
+        logger.info(f"Document structure with {len(ids)} chunks and columns {list(codecs)} saved to {path}")
+        return len(ids)
+
+
+def is_columnar_document_store(path: str) -> bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
@@ -0,0 +1,202 @@
+###################################################################################################
+# Binary embedding artifacts
+#
+# Embeddings are stored as a raw C-order (count x dimension) array preceded by a small header:
+#
+#   b"HKEMB\0"       magic (6 bytes)
+#   version          uint16, little endian
+#   header length    uint32, little endian
+#   header           JSON: model, dimension, dtype, count, entity_ids (the entity id of each row) and,
+#                    for int8, the per dimension scale
+#   padding          up to a 64 bytes boundary
+#   data             count x dimension values of dtype
+#
+# Loading memory-maps the data, so it's zero-copy: FAISS and the Neo4j loaders read the mapped
+# buffer directly instead of unpickling (and copying) lists of Python floats.
+#
+# Embeddings can be stored in reduced precision: float16 (half the bytes of float32) or int8, scalar
+# quantized with a symmetric per dimension scale (a quarter of the bytes), i.e. value ~= code * scale.
+###################################################################################################
+
+import os
+import pickle
+import struct
+
+from typing import List, Literal, Optional, Tuple, Union
+
+import numpy as np
+
+from llm_foundation import logger
+from pydantic import BaseModel
+
+MAGIC = b"HKEMB\0"
+FORMAT_VERSION = 1
+DATA_ALIGNMENT = 64
+
+EmbeddingsPrecision = Literal["float32", "float16", "int8"]
+
+
+class EmbeddingsHeader(BaseModel):
+    model: str
+    dimension: int
+    dtype: EmbeddingsPrecision = "float32"
+    count: int
+    entity_ids: List[Union[int, str]]  # entity_ids[i] is the entity (e.g. node_id) of the row i
+    scale: Optional[List[float]] = None  # Per dimension scale of the int8 codes
+
+
+def _encode_header(header: EmbeddingsHeader) -> bytes:
+    header_json = header.model_dump_json().encode()
+    prefix = MAGIC + struct.pack("<HI", FORMAT_VERSION, len(header_json)) + header_json
+    return prefix + b"\0" * (-len(prefix) % DATA_ALIGNMENT)
+
+
+def read_embeddings_header(path: str) -> Tuple[EmbeddingsHeader, int]:
+    """Returns the header of an embeddings file and the offset of its data."""
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an embeddings file")
+        version, header_length = struct.unpack("<HI", f.read(6))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported embeddings file version: {version}")
+        header = EmbeddingsHeader.model_validate_json(f.read(header_length))
+    prefix_length = len(MAGIC) + 6 + header_length
+    return header, prefix_length + (-prefix_length % DATA_ALIGNMENT)
+
+
+def create_embeddings_file(path: str, header: EmbeddingsHeader) -> np.memmap:
+    """Creates an embeddings file for header.count embeddings and returns its (writable) data as a memmap."""
+    encoded_header = _encode_header(header)
+    with open(path, "wb") as f:
+        f.write(encoded_header)
+    return np.memmap(path, dtype=np.dtype(header.dtype), mode="r+", offset=len(encoded_header), shape=(header.count, header.dimension))
+
+
+def quantize_int8(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per dimension int8 quantization. Returns the codes and the scale (embeddings ~= codes * scale)."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scale = np.abs(embeddings).max(axis=0) / 127 if len(embeddings) else np.zeros(embeddings.shape[1], dtype=np.float32)
+    scale[scale == 0] = 1.0
+    return np.clip(np.rint(embeddings / scale), -127, 127).astype(np.int8), scale.astype(np.float32)
+
+
+def save_embeddings(path: str, embeddings, model: str, entity_ids: Optional[List[Union[int, str]]] = None,
+                    dtype: EmbeddingsPrecision = "float32"):
+    """Saves embeddings (array or list of lists) in the binary format. Rows are entity_ids (default 0..n-1)."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    count, dimension = embeddings.shape
+    scale = None
+    if dtype == "int8":
+        embeddings, scale = quantize_int8(embeddings)
+    header = EmbeddingsHeader(model=model, dimension=dimension, dtype=dtype, count=count,
+                              entity_ids=entity_ids if entity_ids is not None else list(range(count)),
+                              scale=scale.tolist() if scale is not None else None)
+    data = create_embeddings_file(path, header)
+    data[:] = embeddings
+    data.flush()
+    logger.info(f"{count} embeddings ({dimension} dims, {dtype}) saved to {path}")
+
+
+def _is_converted(input_path: str, output_path: str, dtype: EmbeddingsPrecision) -> bool:
+    """Whether output_path is the conversion of the current input_path to dtype."""
+    if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(input_path):
+        return False
+    try:
+        _, input_header = load_embeddings(input_path)
+        _, output_header = load_embeddings(output_path)
+    except ValueError:  # e.g. a truncated conversion
+        return False
+    return output_header.dtype == dtype and output_header.model_dump(exclude={"dtype", "scale"}) == input_header.model_dump(exclude={"dtype", "scale"})
+
+
+def convert_embeddings(input_path: str, output_path: str, dtype: EmbeddingsPrecision, batch_size: int = 65536, force: bool = False):
+    """Converts an embeddings file to another precision, in batches of rows so memory stays bounded.
+
+    Skipped if output_path is already the conversion of the current input_path (unless force)."""
+    if not force and _is_converted(input_path, output_path, dtype):
+        logger.info(f"{output_path} is up to date with {input_path}. Not converted")
+        return
+    embeddings, header = load_embeddings(input_path)
+    output_header = header.model_copy(update={"dtype": dtype, "scale": None})
+    if dtype == "int8":
+        scale = np.zeros(header.dimension, dtype=np.float32)
+        for start in range(0, header.count, batch_size):
+            batch = dequantize_embeddings(embeddings[start:start + batch_size], header)
+            scale = np.maximum(scale, np.abs(batch).max(axis=0) / 127)
+        scale[scale == 0] = 1.0
+        output_header.scale = scale.tolist()
+    output = create_embeddings_file(output_path, output_header)
+    for start in range(0, header.count, batch_size):
+        batch = dequantize_embeddings(embeddings[start:start + batch_size], header)
+        if dtype == "int8":
+            batch = np.clip(np.rint(batch / scale), -127, 127)
+        output[start:start + batch_size] = batch.astype(np.dtype(dtype))
+    output.flush()
+    logger.info(f"{header.count} embeddings converted from {header.dtype} ({input_path}) to {dtype} ({output_path})")
+
+
+def dequantize_embeddings(embeddings: np.ndarray, header: EmbeddingsHeader) -> np.ndarray:
+    """float32 values of stored embeddings (rows of a loaded file). float32 embeddings are returned as is."""
+    if header.dtype == "int8":
+        return np.asarray(embeddings, dtype=np.float32) * np.asarray(header.scale, dtype=np.float32)
+    if header.dtype == "float32":
+        return embeddings
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def load_embeddings(path: str, mode: str = "r") -> Tuple[np.ndarray, EmbeddingsHeader]:
+    """Loads an embeddings file zero-copy (memory-mapped), in its stored dtype (see load_embeddings_float32).
+
+    Legacy pickled lists of embeddings (*_entity_embeddings.pkl) are also supported, but are copied
+    into a float32 array and have no model info.
+
+    Returns:
+        Tuple[np.ndarray, EmbeddingsHeader]: the (count x dimension) embeddings and the header.
+    """
+    if path.endswith(".pkl"):
+        with open(path, "rb") as f:
+            embeddings = np.array(pickle.load(f), dtype=np.float32)
+        count, dimension = embeddings.shape
+        return embeddings, EmbeddingsHeader(model="unknown", dimension=dimension, count=count, entity_ids=list(range(count)))
+
+    header, offset = read_embeddings_header(path)
+    expected_size = offset + header.count * header.dimension * np.dtype(header.dtype).itemsize
+    if os.path.getsize(path) != expected_size:
+        raise ValueError(f"Truncated embeddings file {path}: {os.path.getsize(path)} bytes, expected {expected_size}")
+    embeddings = np.memmap(path, dtype=np.dtype(header.dtype), mode=mode, offset=offset, shape=(header.count, header.dimension))
+    return embeddings, header
+
+
+class DequantizedEmbeddings:
+    """float32 view of stored (memory-mapped) embeddings. Only the rows read are dequantized, so float16
+    and int8 embeddings are never copied in memory as a whole. Supports len, shape and row indexing."""
+
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, embeddings: np.ndarray, header: EmbeddingsHeader):
+        self.embeddings = embeddings
+        self.header = header
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.embeddings.shape
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        return dequantize_embeddings(self.embeddings[rows], self.header)
+
+
+def load_embeddings_dequantized(path: str) -> Tuple[Union[np.ndarray, DequantizedEmbeddings], EmbeddingsHeader]:
+    """Like load_embeddings_float32, but float16 and int8 embeddings are dequantized lazily, as their rows are read
+    (see DequantizedEmbeddings). float32 embeddings are returned memory-mapped."""
+    embeddings, header = load_embeddings(path)
+    return (embeddings if header.dtype == "float32" else DequantizedEmbeddings(embeddings, header)), header
+
+
+def load_embeddings_float32(path: str) -> Tuple[np.ndarray, EmbeddingsHeader]:
+    """Like load_embeddings, but float16 and int8 embeddings are converted to float32 (so they are copied in memory)."""
+    embeddings, header = load_embeddings(path)
+    return dequantize_embeddings(embeddings, header), header
@@ -0,0 +1,124 @@
+###################################################################################################
+# Embedding providers
+#
+# The provider is selected with the EMBEDDING_PROVIDER env variable:
+#   openai   (default) OpenAI embeddings, e.g. text-embedding-3-small
+#   hashing  deterministic feature hashing. CPU only, offline and free, for tests and benchmarks
+#   local    a small on-disk sentence-transformers model (EMBEDDING_LOCAL_MODEL, path or model name)
+###################################################################################################
+
+import hashlib
+import os
+import re
+
+from functools import lru_cache
+from typing import List, Literal
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from llm_foundation import logger
+
+EmbeddingProvider = Literal["openai", "hashing", "local"]
+
+DEFAULT_LOCAL_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+class HashingEmbeddings(Embeddings):
+    """Embeddings by feature hashing of the words and the char trigrams of the words of a text.
+
+    Each feature is hashed (blake2b, so it's stable across processes and runs) to a dimension and a
+    sign, and the vector is L2 normalized. Texts sharing words or word fragments get similar vectors,
+    which is enough to exercise the whole pipeline (indexes, similarity edges, retrieval) offline.
+    """
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for word in re.findall(r"\w+", text.lower()):
+            features.append(word)
+            padded_word = f"#{word}#"
+            features.extend(padded_word[i:i + 3] for i in range(len(padded_word) - 2))
+        return features
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float64)
+        for feature in self._features(text):
+            feature_hash = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+            vector[feature_hash % self.dimensions] += 1.0 if (feature_hash >> 63) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class LocalModelEmbeddings(Embeddings):
+    """Embeddings with a sentence-transformers model loaded from disk (or the HF cache), on CPU.
+
+    If the model has more dimensions than requested, vectors are truncated and renormalized, so the
+    embeddings fit the existing vector indexes (e.g. the 256 dims of entityIdx).
+    """
+
+    def __init__(self, model_path: str = DEFAULT_LOCAL_MODEL, dimensions: int = 256):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("The local embedding provider requires sentence-transformers (pip install sentence-transformers)") from e
+        self.model = SentenceTransformer(model_path, device="cpu")
+        self.dimensions = dimensions
+        model_dimensions = self.model.get_sentence_embedding_dimension()
+        if model_dimensions < dimensions:
+            raise ValueError(f"Local model {model_path} has {model_dimensions} dimensions, less than the {dimensions} requested")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.model.encode(texts, convert_to_numpy=True)[:, :self.dimensions].astype(np.float64)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.where(norms == 0, 1, norms)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def get_embedding_provider_name() -> EmbeddingProvider:
+    provider = os.getenv("EMBEDDING_PROVIDER", "openai").lower()
+    if provider not in ("openai", "hashing", "local"):
+        raise ValueError(f"Unknown EMBEDDING_PROVIDER: {provider}")
+    return provider
+
+
+def embedding_model_id(model: str = "text-embedding-3-small") -> str:
+    """Identifies the embeddings actually produced for model with the configured provider.
+
+    Used in the cache keys and in the embedding file headers, so embeddings of different providers are never mixed.
+    """
+    provider = get_embedding_provider_name()
+    if provider == "hashing":
+        return "hashing"
+    if provider == "local":
+        return f"local:{os.getenv('EMBEDDING_LOCAL_MODEL', DEFAULT_LOCAL_MODEL)}"
+    return model
+
+
+@lru_cache(maxsize=None)
+def _get_embeddings_model(provider: EmbeddingProvider, model: str, emb_dimension: int) -> Embeddings:
+    logger.info(f"Embedding provider: {provider} ({model}, {emb_dimension} dims)")
+    if provider == "hashing":
+        return HashingEmbeddings(emb_dimension)
+    if provider == "local":
+        return LocalModelEmbeddings(os.getenv("EMBEDDING_LOCAL_MODEL", DEFAULT_LOCAL_MODEL), emb_dimension)
+    return OpenAIEmbeddings(model=model, dimensions=emb_dimension)
+
+
+def get_embeddings_model(model: str = "text-embedding-3-small", emb_dimension: int = 256) -> Embeddings:
+    """Shared embeddings client (a LangChain Embeddings) of the configured provider per model and dimension.
+
+    The model is only used by the openai provider.
+    """
+    return _get_embeddings_model(get_embedding_provider_name(), model, emb_dimension)
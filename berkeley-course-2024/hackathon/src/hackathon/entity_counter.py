@@ -0,0 +1,139 @@
+###################################################################################################
+# Multi-pattern entity counting (Aho-Corasick)
+###################################################################################################
+
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from llm_foundation import logger
+
+# Below this number of chunks, counting in the current process is faster than spinning up a pool
+MIN_CHUNKS_FOR_PARALLEL_COUNT = 256
+
+
+def normalize_chunk_text(text: str) -> str:
+    """Normalizes a chunk text for entity counting: lower case, multiple spaces and new lines removed."""
+    text = re.sub(' +', ' ', text.lower())
+    return re.sub('\n+', ' ', text)
+
+
+class EntityAutomaton:
+    """Aho-Corasick automaton to count the occurrences of many entities in a text in a single scan.
+
+    Counts follow the semantics of str.count for each entity independently, i.e. non-overlapping
+    occurrences of the entity scanned from left to right, so text.count(entity) == counts[entity_idx].
+    Occurrences of different entities can overlap (e.g. "hippo" and "hipporag").
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.lengths = [len(pattern) for pattern in patterns]
+        self.empty_patterns = [idx for idx, pattern in enumerate(patterns) if pattern == ""]
+
+        # Trie
+        self.goto: List[Dict[str, int]] = [{}]
+        self.output: List[List[int]] = [[]]
+        for idx, pattern in enumerate(patterns):
+            if pattern == "":
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.output.append([])
+                state = next_state
+            self.output[state].append(idx)
+
+        # Failure links (BFS) and dictionary suffix links (closest suffix state with output)
+        self.fail = [0] * len(self.goto)
+        self.dict_link = [-1] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                suffix = self.fail[next_state]
+                self.dict_link[next_state] = suffix if self.output[suffix] else self.dict_link[suffix]
+                queue.append(next_state)
+
+    def count(self, text: str) -> Dict[int, int]:
+        """Counts the occurrences of the patterns in the text.
+
+        Returns:
+            Dict[int, int]: the count of each pattern (by pattern index) found at least once in the text.
+        """
+        goto, fail, output, dict_link, lengths = self.goto, self.fail, self.output, self.dict_link, self.lengths
+        counts: Dict[int, int] = {}
+        next_start: Dict[int, int] = {}  # Position where the next non-overlapping occurrence of a pattern can start
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            match_state = state if output[state] else dict_link[state]
+            while match_state > 0:
+                for idx in output[match_state]:
+                    start = position - lengths[idx] + 1
+                    if start >= next_start.get(idx, 0):
+                        counts[idx] = counts.get(idx, 0) + 1
+                        next_start[idx] = position + 1
+                match_state = dict_link[match_state]
+        for idx in self.empty_patterns:
+            counts[idx] = len(text) + 1  # As "abc".count("") == 4
+        return counts
+
+
+def prepare_chunk_text(text: str, normalize: bool = True) -> str:
+    """The text the entities are counted in: normalized (see normalize_chunk_text) or just lower case."""
+    return normalize_chunk_text(text) if normalize else text.lower()
+
+
+_worker_automaton: Optional[EntityAutomaton] = None
+_worker_normalize: bool = True
+
+
+def _init_worker(patterns: List[str], normalize: bool):
+    global _worker_automaton, _worker_normalize
+    _worker_automaton = EntityAutomaton(patterns)
+    _worker_normalize = normalize
+
+
+def _count_in_worker(text: str) -> Dict[int, int]:
+    return _worker_automaton.count(prepare_chunk_text(text, _worker_normalize))
+
+
+def count_entities_in_chunks(chunk_texts: List[str], patterns: List[str], max_workers: Optional[int] = None,
+                             normalize: bool = True) -> List[Dict[int, int]]:
+    """Counts the occurrences of the patterns in each chunk text (prepared once per chunk).
+
+    Chunks are distributed across a process pool when there are enough of them to pay off.
+
+    Args:
+        chunk_texts (List[str]): the raw chunk texts.
+        patterns (List[str]): the (lower case) entities to count.
+        max_workers (Optional[int], optional): number of worker processes. Defaults to all cores.
+        Use 1 to count in the current process.
+        normalize (bool, optional): if True, multiple spaces and new lines are removed from the texts before
+        counting (see normalize_chunk_text). Otherwise, texts are only lower cased, i.e. the counts are
+        text.lower().count(entity). Defaults to True.
+
+    Returns:
+        List[Dict[int, int]]: per chunk, the count of each pattern (by pattern index) found in it.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(chunk_texts) < MIN_CHUNKS_FOR_PARALLEL_COUNT:
+        automaton = EntityAutomaton(patterns)
+        return [automaton.count(prepare_chunk_text(text, normalize)) for text in chunk_texts]
+
+    logger.info(f"Counting {len(patterns)} entities in {len(chunk_texts)} chunks with {max_workers} workers")
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(patterns, normalize)) as executor:
+        chunksize = max(1, len(chunk_texts) // (max_workers * 4))
+        return list(executor.map(_count_in_worker, chunk_texts, chunksize=chunksize))
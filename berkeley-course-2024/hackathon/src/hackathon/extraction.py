@@ -0,0 +1,162 @@
+###################################################################################################
+# Concurrent entity/triple extraction over document chunks
+###################################################################################################
+
+import argparse
+import asyncio
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from crewai import Crew
+from crewai.crews import CrewOutput
+from llm_foundation import logger
+
+from hackathon.cache import LLMResponseCache
+from hackathon.retry import RetryConfig, retry_async
+
+# Extracts the entities and triples of a chunk, e.g. {"named_entities": [...], "triples": [[...], ...]}
+ChunkExtractor = Callable[[Dict], Awaitable[Dict]]
+# Called with each chunk as soon as its extraction finishes (in completion order, not chunk order)
+ChunkCallback = Callable[[Dict], None]
+
+
+class ExtractionConfig(RetryConfig):
+    """Concurrency of the extractions, and retries of the chunks whose extraction fails."""
+    concurrency: int = 8  # Max number of chunks being extracted (LLM calls in flight) at the same time
+
+
+async def _extract_with_retries(chunk: Dict, extractor: ChunkExtractor, config: ExtractionConfig) -> Dict:
+    def on_retry(attempt: int, e: Exception, wait: float):
+        logger.warning(f"Extraction of chunk {chunk['id']} failed (attempt {attempt + 1}): {e}. Retrying in {wait:.1f}s")
+
+    return await retry_async(lambda: extractor(chunk), config, on_retry=on_retry)
+
+
+async def extract_chunks_async(document_chunks: List[Dict],
+                               extractor: ChunkExtractor,
+                               config: Optional[ExtractionConfig] = None,
+                               on_chunk_extracted: Optional[ChunkCallback] = None) -> List[Dict]:
+    """Extracts the entities and triples of the document chunks concurrently.
+
+    At most config.concurrency extractions are in flight at any time, so the wall time is roughly
+    (chunks / concurrency) x LLM latency instead of the sum of all the latencies. Each chunk is
+    retried with exponential backoff. The named_entities and triples of each chunk are set in place,
+    so the results keep the order of the chunks regardless of the completion order.
+
+    Args:
+        document_chunks (List[Dict]): the chunks to extract, updated in place.
+        extractor (ChunkExtractor): async function extracting the named_entities and triples of a chunk.
+        config (Optional[ExtractionConfig], optional): concurrency and retry params. Defaults to ExtractionConfig().
+        on_chunk_extracted (Optional[ChunkCallback], optional): called with each extracted chunk.
+
+    Returns:
+        List[Dict]: the chunks that failed after all the retries. They are left without named_entities
+        and triples, so they are still pending in a later run.
+    """
+    config = config or ExtractionConfig()
+    semaphore = asyncio.Semaphore(config.concurrency)
+    failed_chunks = []
+
+    async def extract(chunk: Dict):
+        async with semaphore:
+            try:
+                result = await _extract_with_retries(chunk, extractor, config)
+            except Exception as e:
+                logger.error(f"Error extracting chunk {chunk['id']}: {e}")
+                failed_chunks.append(chunk)
+                return
+        chunk["named_entities"] = result["named_entities"]
+        chunk["triples"] = result["triples"]
+        if on_chunk_extracted is not None:
+            on_chunk_extracted(chunk)
+
+    logger.info(f"Extracting {len(document_chunks)} chunks with concurrency {config.concurrency}")
+    await asyncio.gather(*(extract(chunk) for chunk in document_chunks))
+    logger.info(f"Extraction finished. {len(document_chunks) - len(failed_chunks)} chunks extracted, {len(failed_chunks)} failed")
+    return sorted(failed_chunks, key=lambda chunk: chunk["id"])
+
+
+def extract_chunks(document_chunks: List[Dict],
+                   extractor: ChunkExtractor,
+                   config: Optional[ExtractionConfig] = None,
+                   on_chunk_extracted: Optional[ChunkCallback] = None) -> List[Dict]:
+    """Sync version of extract_chunks_async."""
+    config = config or ExtractionConfig()
+
+    async def run() -> List[Dict]:
+        # Blocking extractors (e.g. crew kickoffs) run in the default executor, so it must not cap the concurrency
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=config.concurrency))
+        return await extract_chunks_async(document_chunks, extractor, config, on_chunk_extracted)
+
+    return asyncio.run(run())
+
+
+def crew_extractor(crew_factory: Callable[[], Crew], inputs_builder: Callable[[Dict], Dict]) -> ChunkExtractor:
+    """Builds a chunk extractor running a crew whose last task outputs the named_entities and triples as JSON.
+
+    A new crew is created per chunk with crew_factory, as crews (their tasks) keep the state of a kickoff
+    and can't be shared by concurrent extractions.
+    """
+    async def extract(chunk: Dict) -> Dict:
+        crew = crew_factory()
+        result: CrewOutput = await crew.kickoff_async(inputs=inputs_builder(chunk))
+        return json.loads(result.json)
+    return extract
+
+
+def cached_extractor(extractor: ChunkExtractor, cache: LLMResponseCache, model: str, prompt: str, role: str) -> ChunkExtractor:
+    """Wraps a chunk extractor with an LLM response cache, keyed by the model, prompt and role of the
+    extractor and the text of the chunk. Only the cache misses reach the LLM."""
+    async def extract(chunk: Dict) -> Dict:
+        response = cache.get_response(model, prompt, role, chunk["text"])
+        if response is None:
+            response = await extractor(chunk)
+            cache.set_response(model, prompt, role, chunk["text"], response)
+        return response
+    return extract
+
+
+def fake_extractor(latency: float = 0.5, failures_per_chunk: int = 0, attempts: Optional[Counter] = None) -> ChunkExtractor:
+    """Chunk extractor standing in for the LLM, to test and load test the runner offline.
+
+    Each call takes latency seconds (without blocking the event loop), and the first failures_per_chunk
+    attempts of each chunk fail. The extracted named_entities are the capitalized words of the chunk text.
+
+    Args:
+        latency (float, optional): seconds per call. Defaults to 0.5.
+        failures_per_chunk (int, optional): failing attempts of each chunk before it succeeds. Defaults to 0.
+        attempts (Optional[Counter], optional): if given, counts the attempts per chunk id.
+    """
+    attempts = attempts if attempts is not None else Counter()
+
+    async def extract(chunk: Dict) -> Dict:
+        attempts[chunk["id"]] += 1
+        await asyncio.sleep(latency)
+        if attempts[chunk["id"]] <= failures_per_chunk:
+            raise RuntimeError(f"Fake failure of chunk {chunk['id']} (attempt {attempts[chunk['id']]})")
+        named_entities = sorted({word.strip(".,;:()") for word in chunk["text"].split() if word[:1].isupper()})
+        return {"named_entities": named_entities, "triples": []}
+    return extract
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the concurrent extraction with a fake extractor "
+                                                 "(wall time ~ chunks / concurrency x latency)")
+    parser.add_argument("--chunks", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per extraction")
+    parser.add_argument("--failures-per-chunk", type=int, default=0)
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        chunks = [{"id": idx, "text": f"Chunk {idx} mentions Neo4j and FAISS"} for idx in range(args.chunks)]
+        config = ExtractionConfig(concurrency=concurrency, initial_backoff=0.0)
+        start = time.perf_counter()
+        failed_chunks = extract_chunks(chunks, fake_extractor(args.latency, args.failures_per_chunk), config)
+        seconds = time.perf_counter() - start
+        expected = -(-args.chunks // concurrency) * args.latency * (args.failures_per_chunk + 1)
+        print(f"concurrency={concurrency}: {args.chunks} chunks in {seconds:.2f}s (expected ~{expected:.2f}s), {len(failed_chunks)} failed")
@@ -0,0 +1,97 @@
+###################################################################################################
+# Write-ahead journal of chunk extractions
+###################################################################################################
+
+import json
+import os
+
+from typing import Dict, List, Literal, Optional
+
+from llm_foundation import logger
+
+from hackathon.utils import save_document_structure
+
+
+def _chunk_key(chunk: Dict) -> str:
+    # Content digest when available (see utils.chunk_digest), so a journal is never applied to a different chunking
+    return chunk.get("digest") or f"id:{chunk['id']}"
+
+
+class ExtractionJournal:
+    """Append-only JSON lines journal with the entities and triples of each extracted chunk.
+
+    Each extracted chunk is appended and fsync'ed as soon as its extraction finishes, so if the
+    extraction dies, a restarted run replays the journal and only extracts the missing chunks.
+    Once all the chunks are done, compact() writes the final document structure artifact and
+    removes the journal.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def replay(self) -> Dict[str, Dict]:
+        """Returns the journaled extractions by chunk key. A torn last line (crash while writing) is ignored."""
+        extractions = {}
+        if not os.path.exists(self.path):
+            return extractions
+        with open(self.path, "r") as f:
+            for line_number, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Ignoring corrupted entry in line {line_number} of the journal {self.path}")
+                    continue
+                extractions[entry["key"]] = entry
+        return extractions
+
+    def resume(self, document_chunks: List[Dict]) -> List[Dict]:
+        """Sets the journaled entities and triples on the document chunks (in place).
+
+        Returns:
+            List[Dict]: the chunks missing in the journal, i.e. still pending extraction.
+        """
+        extractions = self.replay()
+        pending_chunks = []
+        for chunk in document_chunks:
+            entry = extractions.get(_chunk_key(chunk))
+            if entry is None:
+                pending_chunks.append(chunk)
+                continue
+            chunk["named_entities"] = entry["named_entities"]
+            chunk["triples"] = entry["triples"]
+        if extractions:
+            logger.info(f"Resumed {len(document_chunks) - len(pending_chunks)} chunks from the journal {self.path}. {len(pending_chunks)} chunks pending")
+        return pending_chunks
+
+    def _open(self):
+        # Drop a torn last line before appending, so new entries start on their own line
+        if os.path.exists(self.path):
+            with open(self.path, "rb+") as f:
+                content = f.read()
+                if content and not content.endswith(b"\n"):
+                    f.truncate(content.rfind(b"\n") + 1)
+        self._file = open(self.path, "a")
+
+    def append(self, chunk: Dict):
+        """Durably records the extraction of a chunk."""
+        if self._file is None:
+            self._open()
+        entry = {"key": _chunk_key(chunk), "id": chunk["id"], "named_entities": chunk["named_entities"], "triples": chunk["triples"]}
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def compact(self, document_chunks: List[Dict], output_file: str,
+                format: Literal["pickle", "json", "columnar"] = "pickle", compression: Optional[Literal["zlib"]] = None):
+        """Saves the final document structure artifact and removes the journal."""
+        self.close()
+        save_document_structure(document_chunks, output_file, format=format, compression=compression)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            logger.info(f"Journal {self.path} compacted into {output_file}")
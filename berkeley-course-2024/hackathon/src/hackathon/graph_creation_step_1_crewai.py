@@ -1,4 +1,5 @@
 import json
+import os
 import pprint
 
 from typing import Dict, List, Literal
@@ -11,18 +12,45 @@ from pydantic import BaseModel
 from rich import print
 from rich.pretty import pprint
 
-from hackathon.utils import build_document_structure, save_document_structure
+from hackathon.cache import get_llm_response_cache
+from hackathon.extraction import ExtractionConfig, cached_extractor, crew_extractor, extract_chunks
+from hackathon.extraction_journal import ExtractionJournal
+from hackathon.utils import (DOCUMENT_STRUCTURE_SUFFIXES, build_document_structure, document_artifact_path, document_structure_format,
+                             document_structure_path, load_document_structure, reuse_extracted_chunks)
 
 CHUNK_SIZE = 5000
 document_name = "2405.14831v1.pdf"
 
+# Chunks extracted concurrently. See extraction.fake_extractor (and `python src/hackathon/extraction.py`) to test and
+# load test the runner offline, or point OPENAI_BASE_URL to a local OpenAI-compatible server
+extraction_config = ExtractionConfig(
+    concurrency=int(os.getenv("EXTRACTION_CONCURRENCY", "8")),
+    max_retries=int(os.getenv("EXTRACTION_MAX_RETRIES", "3")),
+)
+
 
 ########################################################################################
 ### Here starts everything...
 ########################################################################################
 
+# Columnar by default, so the next steps read the chunks lazily. See DOCUMENT_STRUCTURE_FORMAT
+structure_format = document_structure_format()
+document_structure_file = document_structure_path(document_name, structure_format)
 document_chunks = build_document_structure(document_name, chunk_size=CHUNK_SIZE)
 
+# Only new or changed chunks (by content digest) need to go through the agents again. The extractions
+# are also reused from an artifact in the other format, e.g. after switching formats
+pending_chunks = document_chunks
+previous_document_structure_files = [document_structure_path(document_name, format)
+                                     for format in sorted(DOCUMENT_STRUCTURE_SUFFIXES, key=lambda format: format != structure_format)]
+previous_document_structure_file = next(filter(os.path.exists, previous_document_structure_files), None)
+if previous_document_structure_file is not None:
+    pending_chunks = reuse_extracted_chunks(document_chunks, load_document_structure(previous_document_structure_file))
+
+# Chunks extracted by a previous run that died before saving the artifact are recovered from the journal
+journal = ExtractionJournal(document_artifact_path(document_name, "extraction_journal.jsonl"))
+pending_chunks = journal.resume(pending_chunks)
+
 entity_master = Persona.from_yaml_file("Personas/EntityMasterCrewAI.yaml")
 entity_extractor_role: Role = entity_master.get_role("entity_extractor")
 triple_extractor_role: Role = entity_master.get_role("triple_extractor")
@@ -35,61 +63,69 @@ logger.info("===================================================================
 logger.info(f"Triple Extractor Role:\n{pprint(triple_extractor_role)}")
 logger.info("================================================================================")
 
-entity_extractor: Agent = entity_extractor_role.to_crewai_agent(verbose=True, allow_delegation=False)
-triple_extractor: Agent = triple_extractor_role.to_crewai_agent(verbose=True, allow_delegation=False)
-
 class ExtractedEntities(BaseModel):
     named_entities: List[str]
 
-extract_entities = Task(
-    description=entity_extractor_role.tasks[0].description,
-    expected_output=entity_extractor_role.tasks[0].expected_output,
-    agent=entity_extractor,
-    output_json=ExtractedEntities,
-)
-
 class ExtractedTriples(BaseModel):
     named_entities: List[str]
     triples: List[List[str]]
 
-extract_triples = Task(
-    description=triple_extractor_role.tasks[0].description,
-    expected_output=triple_extractor_role.tasks[0].expected_output,
-    agent=triple_extractor,
-    output_json=ExtractedTriples,
-)
+def build_crew() -> Crew:
+    # A crew per chunk, as chunks are extracted concurrently and crews can't be shared between kickoffs
+    entity_extractor: Agent = entity_extractor_role.to_crewai_agent(verbose=True, allow_delegation=False)
+    triple_extractor: Agent = triple_extractor_role.to_crewai_agent(verbose=True, allow_delegation=False)
+
+    extract_entities = Task(
+        description=entity_extractor_role.tasks[0].description,
+        expected_output=entity_extractor_role.tasks[0].expected_output,
+        agent=entity_extractor,
+        output_json=ExtractedEntities,
+    )
+
+    extract_triples = Task(
+        description=triple_extractor_role.tasks[0].description,
+        expected_output=triple_extractor_role.tasks[0].expected_output,
+        agent=triple_extractor,
+        output_json=ExtractedTriples,
+    )
+
+    return Crew(
+        agents=[entity_extractor, triple_extractor],
+        tasks=[extract_entities, extract_triples],
+        verbose=True,
+    )
+
+def graph_creation_inputs(chunk: Dict) -> Dict:
+    return {
+        "paragraph": chunk["text"],
+        "entity_extractor_examples": entity_extractor_role.get_examples_as_str(),
+        "triple_extractor_examples": triple_extractor_role.get_examples_as_str(),
+    }
 
-crew = Crew(
-    agents=[entity_extractor, triple_extractor],
-    tasks=[extract_entities, extract_triples],
-    verbose=True,
-)
 
 def extend_document_chunks_with_entities_and_triples(document_chunks: List[Dict]) -> List[Dict]:
-
-    for chunk in document_chunks:
-
-        graph_creation_inputs = {
-            "paragraph": chunk["text"],
-            "entity_extractor_examples": entity_extractor_role.get_examples_as_str(),
-            "triple_extractor_examples": triple_extractor_role.get_examples_as_str(),
-        }
-
-        logger.info("^^^^^^^^^^^^^^^^^^^^^^^^^^^^ Calling Agents ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
-        result: CrewOutput = crew.kickoff(inputs=graph_creation_inputs)
-
-        logger.info(".................................................................................")
-        logger.info(type(result))
-        logger.info(pprint(json.loads(result.json)))
-        logger.info(".................................................................................")
-        
-        result_dict = json.loads(result.json)
-        chunk["named_entities"] = result_dict["named_entities"]
-        chunk["triples"] = result_dict["triples"]
-    
+    extractor = crew_extractor(build_crew, graph_creation_inputs)
+
+    # Responses already paid for (e.g. in a crashed run) are served from the LLM response cache
+    llm_cache = get_llm_response_cache()
+    if llm_cache is not None:
+        extraction_prompt = "\n".join([
+            entity_extractor_role.tasks[0].description, entity_extractor_role.tasks[0].expected_output,
+            triple_extractor_role.tasks[0].description, triple_extractor_role.tasks[0].expected_output,
+            *graph_creation_inputs({"text": ""}).values(),
+        ])
+        llm_model = os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini")
+        extractor = cached_extractor(extractor, llm_cache, llm_model, extraction_prompt, role="entity_extractor+triple_extractor")
+
+    logger.info("^^^^^^^^^^^^^^^^^^^^^^^^^^^^ Calling Agents ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
+    failed_chunks = extract_chunks(document_chunks, extractor, extraction_config, on_chunk_extracted=journal.append)
+    if failed_chunks:
+        logger.warning(f"Chunks without entities and triples (retry on the next run): {[chunk['id'] for chunk in failed_chunks]}")
+    if llm_cache is not None:
+        logger.info(f"LLM response cache: {llm_cache.stats()}")
     return document_chunks
 
 
-document_chunks = extend_document_chunks_with_entities_and_triples(document_chunks)
+extend_document_chunks_with_entities_and_triples(pending_chunks)  # Updates the document chunks in place
 
-save_document_structure(document_chunks, f"{document_name.rsplit(".", 1)[0]}_document_structure.pkl")
+journal.compact(document_chunks, document_structure_file, format=structure_format)
@@ -3,7 +3,8 @@ import pprint
 import pickle
 import hashlib
 
-from typing import Dict, List
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List
 import numpy as np
 
 from crewai import Agent, Task, Crew
@@ -14,25 +15,29 @@ from pydantic import BaseModel
 from rich import print
 from rich.pretty import pprint
 
-from hackathon.utils import save_document_structure
+from hackathon.tools import create_matrix_entity_ref_count
+from hackathon.utils import (document_artifact_path, document_structure_path, load_document_structure, save_document_structure,
+                             save_entity_ref_count_matrix)
 
 document_name: str = "2405.14831v1.pdf"
-document_structure_file = f"{document_name.rsplit(".", 1)[0]}_document_structure.pkl"
+document_structure_file = document_structure_path(document_name)  # See DOCUMENT_STRUCTURE_FORMAT
 
 
-logger.info(f"Loading document structure from {document_structure_file}")
-document_structure_with_entities_and_triples = pickle.load(open(document_structure_file, "rb"))
+# Columnar stores are read lazily, chunk by chunk, instead of being decoded in full upfront
+document_structure = load_document_structure(document_structure_file)
 
-assert len(document_structure_with_entities_and_triples) == 1  ## TODO Remove this filter!!!! Just for testing
+assert len(document_structure) == 1  ## TODO Remove this filter!!!! Just for testing
 
 # logger.info(document_structure_with_entities_and_triples)
 
-def filter_named_entities(document_structure_with_entities_and_triples: List[dict]) -> List[dict]:
+def filter_named_entities(document_structure_with_entities_and_triples: Iterable[dict]) -> Iterator[dict]:
     for chunk_info in document_structure_with_entities_and_triples:
-        named_entities = chunk_info["named_entities"]
+        chunk_info = dict(chunk_info)  # Chunks of a columnar store are read-only
+        # Chunks whose extraction failed in step 1 have no named_entities/triples (they are retried on its next run)
+        named_entities = chunk_info.get("named_entities", [])
         logger.info(named_entities)
         named_entities = [entity.lower() for entity in named_entities]
-        triples = chunk_info["triples"]
+        triples = chunk_info.get("triples", [])
         logger.info(f"Initial Named Entities ({len(named_entities)}): {named_entities}")
         named_entities: set = set(named_entities)
         logger.info(f"Initial Named Entities after dedup ({len(named_entities)}): {named_entities}")
@@ -44,11 +49,11 @@ def filter_named_entities(document_structure_with_entities_and_triples: List[dic
             named_entities.add(triple[0].lower())
             named_entities.add(triple[2].lower())
         logger.info(f"Final Named Entities ({len(named_entities)}): {named_entities}")
-        chunk_info["named_entities"] = list(named_entities)
-    return document_structure_with_entities_and_triples[:1] # TODO Remove this filter!!!! Just for testing
+        chunk_info["named_entities"] = sorted(named_entities)  # Sets aren't ordered across runs, and the node ids follow this order
+        yield chunk_info
 
 
-document_structure_with_entities_and_triples = filter_named_entities(document_structure_with_entities_and_triples)
+document_structure_with_entities_and_triples = list(islice(filter_named_entities(document_structure), 1))  # TODO Remove this filter!!!! Just for testing
 document_structure_file_with_ne = f"{document_name.rsplit(".", 1)[0]}_document_structure_with_ne.pkl"
 save_document_structure(document_structure_with_entities_and_triples, document_structure_file_with_ne)
 
@@ -65,7 +70,7 @@ def create_document_deduped_entities_dict(document_structure_with_entities_and_t
         #     hex_digest = hash_object.hexdigest()
         #     return hex_digest
         
-        named_entities = chunk_info["named_entities"]
+        named_entities = chunk_info.get("named_entities", [])
         for i, named_entity in enumerate(named_entities):
             if named_entity not in named_entities_dict:
                 # entity_hashed = hash_string(named_entity)
@@ -81,22 +86,9 @@ entity2uid_dict = create_document_deduped_entities_dict(document_structure_with_
 
 logger.info(pprint(entity2uid_dict))
 
-def create_matrix_entity_ref_count(document_structure_with_entities_and_triples: List[dict], named_entities_dict: dict) -> np.ndarray:
-    n_of_entities = len(named_entities_dict)
-    n_of_chunks = len(document_structure_with_entities_and_triples)
-    
-    document_chunks = document_structure_with_entities_and_triples
-    entity_per_chunk_count_matrix = np.zeros((n_of_entities, n_of_chunks))
-    for chunk_idx, chunk_info in enumerate(document_chunks):
-        named_entities = chunk_info["named_entities"]
-        for named_entity in named_entities:
-            named_entity_hash = named_entities_dict[named_entity.lower()]
-            # Count of named_entity appearing in the document chunk
-            entity_per_chunk_count_matrix[named_entity_hash][chunk_idx] = chunk_info["text"].lower().count(named_entity.lower())
-    return entity_per_chunk_count_matrix
-
-
-matrix = create_matrix_entity_ref_count(document_structure_with_entities_and_triples, entity2uid_dict)
+# Sparse (n_of_entities x n_of_chunks) matrix with integer counts. Counted in the raw (lower case) chunk texts,
+# without normalizing spaces and new lines, so the counts are the same as chunk_text.lower().count(entity)
+matrix = create_matrix_entity_ref_count(document_structure_with_entities_and_triples, entity2uid_dict, normalize=False)
 
 print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
 print(matrix)
@@ -109,9 +101,13 @@ example_chunk = document_structure_with_entities_and_triples[0]
 n_of_entities = len(entity2uid_dict)
 n_of_chunks = len(document_structure_with_entities_and_triples)
 
+uid2entity_dict = {uid: entity for entity, uid in entity2uid_dict.items()}
 for e_idx in range(n_of_entities):
-    entity_name = list(entity2uid_dict.keys())[list(entity2uid_dict.values()).index(e_idx)]
-    logger.info(f"Entity: {e_idx} {entity_name} Per chunk count: {matrix[e_idx][:]}")
+    entity_name = uid2entity_dict[e_idx]
+    logger.info(f"Entity: {e_idx} {entity_name} Per chunk count: {matrix[e_idx].toarray().ravel()}")
+
+entity_ref_count_matrix_file = document_artifact_path(document_name, "entity_per_chunk_count_matrix.npz")
+save_entity_ref_count_matrix(matrix, entity_ref_count_matrix_file)
 
 # Save the matrix to a file
 with open(f"{document_name.rsplit(".", 1)[0]}_entity2uid_dict.pkl", "wb") as f:
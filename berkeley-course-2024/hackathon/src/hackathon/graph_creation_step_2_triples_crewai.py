@@ -14,12 +14,13 @@ from pydantic import BaseModel
 
 from hackathon.tools import read_file, filter_named_entities, create_document_deduped_entities_dict
 from hackathon.input_output_types import DocumentStructures, DocumentStructure, NamedEntities
+from hackathon.utils import document_structure_path
 
 from llm_foundation import logger
 
 
 document_name: str = "2405.14831v1.pdf"
-document_structure_file = f"{document_name.rsplit(".", 1)[0]}_document_structure.pkl"
+document_structure_file = document_structure_path(document_name)  # See DOCUMENT_STRUCTURE_FORMAT
 
 
 entity_master = Persona.from_yaml_file("Personas/EntityMasterCrewAI.yaml")
@@ -1,3 +1,4 @@
+import json
 import os
 import pickle
 
@@ -5,27 +6,44 @@ from typing import Dict, List, Optional
 
 import numpy as np
 
-from langchain_community.graphs import Neo4jGraph
-from hackathon.index import generate_entity_embeddings, create_index, search_index, calculate_scores, build_similar_entities
-from hackathon.graph_neo4j import add_entities, add_relates_to_relationships, build_vector_index, add_similar_entities
+from hackathon.bulk_import import export_bulk_import, neo4j_admin_import_command
+from hackathon.canonicalization import canonicalization_enabled, canonicalize_entities
+from hackathon.embedding_store import convert_embeddings, load_embeddings, load_embeddings_dequantized
+from hackathon.index import IndexConfig, PersistentEntityIndex, generate_embeddings_to_memmap, calculate_scores, find_similar_pairs
+from hackathon.graph_neo4j import (add_entities, add_relates_to_relationships, bootstrap_schema, build_vector_index, add_similar_entities,
+                                   claim_graph_document)
+from hackathon.graph_sync import sync_graph
+from hackathon.utils import (Neo4jClientFactory, document_artifact_path, document_structure_path, load_document_structure,
+                             load_entity_ref_count_matrix, save_entity_ref_count_matrix)
 from llm_foundation import logger
 
 
-NEO4J_URI = os.environ["NEO4J_URI"]
-NEO4J_USERNAME = os.environ["NEO4J_USERNAME"]
-NEO4J_PASSWORD = os.environ["NEO4J_PASSWORD"]
-NEO4J_DATABASE = os.environ["NEO4J_DB"] 
-
 document_name: str = "2405.14831v1.pdf"
 
 # Embeddings and FAISS index params
+emb_model = "text-embedding-3-small"
 emb_dimension = 256
+# Precision of the stored embeddings artifact: float32, float16 or int8 (the index precision is in the index config)
+emb_precision = os.getenv("EMBEDDINGS_PRECISION", "float32")
 recall_at_k = 3  # how far in the indices/distances we go
+max_distance = 0.85  # Original max_distance=0.7
+range_search = False  # If True, all the entities within max_distance are similar, not only the recall_at_k nearest
+# If True, mutually similar entities are merged into a canonical entity before creating the graph
+canonicalize = canonicalization_enabled()
+# If set, the graph is exported as CSV files for neo4j-admin database import to this dir, instead of written with Cypher
+bulk_import_dir = os.getenv("BULK_IMPORT_DIR")
+# If True, the graph is diffed against the artifacts and only the changes are written (GRAPH_SYNC_DRY_RUN only reports them)
+graph_sync = os.getenv("GRAPH_SYNC", "false").lower() == "true"
+graph_sync_dry_run = os.getenv("GRAPH_SYNC_DRY_RUN", "false").lower() == "true"
 
 # M_max defines the maximum number of links a vertex can have, and M_max0, which defines the same but for vertices in layer 0.
 M = 64  # for HNSW index, the number of neighbors we add to each vertex on insertion. 
 # Faiss sets M_max and M_max0 automatically in the set_default_probas method, at index initialization. 
 # The M_max value is set to M, and M_max0 set to M*2
+# A config selected with index_benchmark (e.g. index_config.json) replaces the HNSW default, whose vectors
+# have the precision of the stored embeddings (scalar quantized for float16 and int8)
+index_config = (IndexConfig.load(os.environ["INDEX_CONFIG_PATH"]) if os.getenv("INDEX_CONFIG_PATH")
+                else IndexConfig(M=M, precision=emb_precision))
 
 ###################################################################################################
 # Index and Embeddings Creation
@@ -38,16 +56,58 @@ entities = list(named_entities_dict.keys())
 logger.info(f"Number of entities: {len(entities)}. First entity is: {entities[0]}")
 
 logger.info("Generate entity embeddings")
-embeddings_filepath = f"{document_name.rsplit('.', 1)[0]}_entity_embeddings.pkl"
-entities_embeddings = generate_entity_embeddings(entities, emb_dimension, embeddings_filepath)
+embeddings_filepath = document_artifact_path(document_name, "entity_embeddings.emb")
+# Free when the embeddings of the same entities are already in the file (see the progress checkpoint)
+generate_embeddings_to_memmap(entities, embeddings_filepath, emb_model, emb_dimension,
+                              entity_ids=[named_entities_dict[entity] for entity in entities])
+
+if emb_precision == "float32":
+    # Zero-copy: FAISS and the Neo4j loader read the embeddings from the memory-mapped file
+    entities_embeddings, embeddings_header = load_embeddings(embeddings_filepath)
+else:
+    compact_embeddings_filepath = document_artifact_path(document_name, f"entity_embeddings_{emb_precision}.emb")
+    convert_embeddings(embeddings_filepath, compact_embeddings_filepath, emb_precision)  # Skipped if already converted
+    # Rows are dequantized as they are read (by FAISS and the Neo4j loaders, in batches), not as a whole float32 copy
+    entities_embeddings, embeddings_header = load_embeddings_dequantized(compact_embeddings_filepath)
+logger.info(f"Embeddings loaded: {embeddings_header.count} x {embeddings_header.dimension} ({embeddings_header.model})")
+
+# The index is persisted by entity name, so only the entities new or changed since the previous run are inserted
+node_ids = [named_entities_dict[entity] for entity in entities]
+entity_index = PersistentEntityIndex.load_or_create(document_artifact_path(document_name, "entity_index"), emb_dimension,
+                                                    config=index_config, model=emb_model)
+entity_index.update(entities, entities_embeddings, node_ids)
+entity_index.save()
+# We query with the same elements we indexed, in batches. Node ids are the positions of the entities
+similar_pairs, _ = find_similar_pairs(entity_index.index, entities_embeddings, max_distance, recall_at_k,
+                                      range_search=range_search, config=index_config,
+                                      row_ids=entity_index.row_ids, query_ids=node_ids)
+
+# Columnar stores are read lazily, so the graph loaders and the bulk export stream the chunks from the artifact
+doc_structure = load_document_structure(document_structure_path(document_name))
 
-entities_embeddings = pickle.loads(open(embeddings_filepath, "rb").read())
-embs_as_nparrays = np.array(entities_embeddings)
+###################################################################################################
+# Entity Canonicalization (optional)
+###################################################################################################
 
-faiss_index = create_index(embs_as_nparrays, emb_dimension, M)
-# We query with the same elements we indexed
-distances, indexes = search_index(faiss_index, embs_as_nparrays, recall_at_k)
-similar_entities = build_similar_entities(entities, indexes, distances, recall_at_k, max_distance=0.85)  # Original max_distance=0.7
+if canonicalize:
+    matrix_file = document_artifact_path(document_name, "entity_per_chunk_count_matrix.npz")
+    entities_ref_count_matrix = load_entity_ref_count_matrix(matrix_file) if os.path.exists(matrix_file) else None
+    canonical_entities = canonicalize_entities(named_entities_dict, similar_pairs, entities_ref_count_matrix)
+    canonical_entities.save_aliases(document_artifact_path(document_name, "entity_aliases.json"))
+
+    # The graph, the matrix and the embeddings only keep the canonical entities, with new dense node ids
+    entities_embeddings = canonical_entities.remap_embeddings(entities_embeddings)
+    similar_pairs = canonical_entities.remap_similar_pairs(similar_pairs)
+    doc_structure = canonical_entities.remap_document_structure(list(doc_structure))
+    named_entities_dict = canonical_entities.entity2uid
+    entities = list(named_entities_dict.keys())
+    with open(document_artifact_path(document_name, "canonical_entity2uid_dict.pkl"), "wb") as f:
+        pickle.dump(named_entities_dict, f)
+    if entities_ref_count_matrix is not None:
+        save_entity_ref_count_matrix(canonical_entities.remap_matrix(entities_ref_count_matrix),
+                                     document_artifact_path(document_name, "canonical_entity_per_chunk_count_matrix.npz"))
+
+similar_entities = [{"entity": entities[entity], "similar_entity": entities[similar_entity]} for entity, similar_entity in similar_pairs.tolist()]
 logger.info(f"Similar entities:\n{similar_entities}")
 
 # TODO Scores discarded for now
@@ -60,19 +120,38 @@ logger.info(f"Similar entities:\n{similar_entities}")
 # Create the Neo4J graph!!!
 ###################################################################################################
 
-kg = Neo4jGraph(
-    url=NEO4J_URI, username=NEO4J_USERNAME, password=NEO4J_PASSWORD, database=NEO4J_DATABASE
-)
-
-# Step 1: Add all entities to the graph
-add_entities(kg, entities_embeddings, named_entities_dict)
-
-# Step 2: Add RELATES_TO relationships
-doc_structure = pickle.loads(open(f"{document_name.rsplit(".", 1)[0]}_document_structure.pkl", "rb").read())
-add_relates_to_relationships(kg, doc_structure)
-
-# Step 3: Add SIMILAR_TO relationships
-add_similar_entities(kg, similar_entities)
-
-# Step 4: Build vector index
-build_vector_index(kg)
+if bulk_import_dir:
+    export_bulk_import(bulk_import_dir, named_entities_dict, entities_embeddings, doc_structure, similar_pairs)
+    logger.info(f"Import the graph with:\n{neo4j_admin_import_command(bulk_import_dir)}\n"
+                f"and then create the schema and the vector index with:\npython src/hackathon/bulk_import.py --document {document_name}")
+elif graph_sync or graph_sync_dry_run:
+    neo4j_factory = Neo4jClientFactory()
+    if not graph_sync_dry_run:
+        bootstrap_schema(neo4j_factory)
+
+    # Only the entities and relationships that changed since the last run are written
+    graph_delta = sync_graph(neo4j_factory, document_name, named_entities_dict, entities_embeddings, doc_structure, similar_entities,
+                             dry_run=graph_sync_dry_run)
+    with open(document_artifact_path(document_name, "graph_delta.json"), "w") as f:
+        json.dump({"dry_run": graph_sync_dry_run, "total": graph_delta.total, **graph_delta.counts()}, f, indent=4)
+
+    if not graph_sync_dry_run:
+        build_vector_index(neo4j_factory)
+else:
+    neo4j_factory = Neo4jClientFactory()
+
+    # Step 0: Constraints and indexes, so entities are merged and relationships matched with index seeks
+    bootstrap_schema(neo4j_factory)
+    claim_graph_document(neo4j_factory, document_name)  # A database holds the graph of a single document
+
+    # Step 1: Add all entities to the graph
+    add_entities(neo4j_factory, entities_embeddings, named_entities_dict)
+
+    # Step 2: Add RELATES_TO relationships
+    add_relates_to_relationships(neo4j_factory, doc_structure)
+
+    # Step 3: Add SIMILAR_TO relationships
+    add_similar_entities(neo4j_factory, similar_entities)
+
+    # Step 4: Build vector index
+    build_vector_index(neo4j_factory)
@@ -9,11 +9,22 @@
 # Neo4J graph functions
 ###################################################################################################
 
-from typing import Dict, List
+import hashlib
+
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from hackathon.bulk_writer import BulkWriter
+from hackathon.document_store import ColumnarDocumentStore
 from hackathon.utils import Neo4jClientFactory
+from hackathon.vector_mirror import bump_entities_version, mirror_upsert_callback, sync_entity_vector_mirror
 
 from llm_foundation import logger
 
+# Upserts the written entity rows in the entity vector mirror
+upsert_entity_rows_in_mirror = mirror_upsert_callback(lambda row: {"id": row["node_id"], "name": row["name"]})
+
 
 def clean_db(neo4j_factory: Neo4jClientFactory):
     kg = neo4j_factory.langchain_client()
@@ -42,43 +53,160 @@ def clean_db(neo4j_factory: Neo4jClientFactory):
     logger.info(f"Result after schema removal:\n{result}")
 
 
-def add_entities(neo4j_factory: Neo4jClientFactory, entities_embeddings, named_entities_dict: Dict):
+def bootstrap_schema(neo4j_factory: Neo4jClientFactory):
+    """Creates the constraints and indexes of the graph (if they don't exist), before loading it.
+
+    Entity nodes are merged by node_id (unique), and relationships match their ends by name, so both are indexed.
+    Names are indexed but not unique, as users are also Entity nodes and different users can have the same name.
+    """
     kg = neo4j_factory.langchain_client()
     
-    entities = list(named_entities_dict.keys())
-    all_entities = [{"name": entity, "node_id": named_entities_dict[entity], "embedding": entities_embeddings[named_entities_dict[entity]]} for entity in entities]
+    queries = [
+        "CREATE CONSTRAINT entity_node_id IF NOT EXISTS FOR (e:Entity) REQUIRE e.node_id IS UNIQUE",
+        "CREATE INDEX entity_name IF NOT EXISTS FOR (e:Entity) ON (e.name)",
+    ]
+    for query in queries:
+        kg.query(query)
+    kg.query("CALL db.awaitIndexes()")  # Indexes are populated in the background
+    logger.info("Neo4j schema ready")
 
-    query = """
-    UNWIND $all_entities AS ae
-    MERGE (a:Entity {name: ae.name, node_id: ae.node_id, embedding: ae.embedding})
-    """
-    kg.query(query, {"all_entities": all_entities})
 
-def add_relates_to_relationships(neo4j_factory: Neo4jClientFactory, doc_structure):
+def claim_graph_document(neo4j_factory: Neo4jClientFactory, document: str, dry_run: bool = False):
+    """Node ids are the positions of the entities of a document, so a database holds the graph of a single
+    document. Records the document in the (:GraphDocument) node of the database, and fails if the database
+    holds the graph of another document. With dry_run, it's only checked."""
     kg = neo4j_factory.langchain_client()
-    
-    triplets = []
+    if dry_run:
+        result = kg.query("MATCH (d:GraphDocument) RETURN d.name AS name")
+    else:
+        result = kg.query("MERGE (d:GraphDocument) ON CREATE SET d.name = $document RETURN d.name AS name", {"document": document})
+    for record in result:
+        if record["name"] != document:
+            raise ValueError(f"Neo4j database {neo4j_factory.database} holds the graph of {record['name']}, not of {document}. "
+                             "Use a database per document, or clean it first (see clean_db)")
+
+
+def entity_content_hash(name: str, embedding) -> str:
+    """Hash of the content of an entity node, to find the entities that changed (see graph_sync). The node_id
+    isn't part of it, as node ids shift whenever the entities of the document change."""
+    content_hash = hashlib.blake2b(f"{name}\0".encode(), digest_size=16)
+    content_hash.update(np.ascontiguousarray(embedding, dtype=np.float32).tobytes())
+    return content_hash.hexdigest()
+
+
+def iter_entity_rows(named_entities_dict: Dict, entities_embeddings) -> Iterator[Dict]:
+    """The entity nodes: name, node_id, embedding (as a list of floats for the driver) and content_hash."""
+    for entity, node_id in named_entities_dict.items():
+        embedding = np.asarray(entities_embeddings[node_id])  # A row of a (possibly memory-mapped) array
+        yield {"name": entity, "node_id": node_id, "embedding": embedding.tolist(),
+               "content_hash": entity_content_hash(entity, embedding)}
+
+
+def iter_triplets(doc_structure) -> Iterator[Dict]:
+    """The RELATES_TO relationships of the triples of the chunks."""
+    if isinstance(doc_structure, ColumnarDocumentStore):  # Only the triples are needed
+        doc_structure = doc_structure.iter_rows(columns=["id", "triples"])
+
     for chunk in doc_structure:
-        for triple in chunk["triples"]:
+        for triple in chunk.get("triples", []):  # Chunks whose extraction failed have no triples
             if len(triple) != 3:
                 continue
             subject=triple[0].lower()
             predicate=triple[1].replace(" ", "_").upper()
             object=triple[2].lower()
-            triplets.append({
+            yield {
                 "subject": subject, 
                 "predicate": predicate, 
                 "object": object,
                 "passageId_subject": chunk["id"],
                 "passageId_object": chunk["id"],
-            })
+            }
+
+
+def rebind_entity_node_ids(neo4j_factory: Neo4jClientFactory, named_entities_dict: Dict, bulk_writer: Optional[BulkWriter] = None):
+    """Makes the entity nodes in the graph those of named_entities_dict, with the node_id of their name.
+
+    Step 2 assigns node ids by position, so they shift when the entities change. Without this, MERGEing the
+    entities by node_id would rename nodes in place and leave them with the relationships of the old name.
+    The nodes of the entities that are gone are deleted with their relationships (whatever their node_id,
+    so no node keeps a node_id beyond the entity dict), and the other entities keep their node (and
+    relationships) with the new node_id. Like in graph_sync, only the nodes that changed are written.
+    """
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
+    with neo4j_factory.neo4j_client() as driver:
+        with driver.session(database=neo4j_factory.database) as session:
+            node_ids = {record["name"]: record["node_id"]
+                        for record in session.run("MATCH (a:Entity) WHERE a.type IS NULL RETURN a.name AS name, a.node_id AS node_id")}
+    deleted = [{"name": entity, "node_id": node_id} for entity, node_id in node_ids.items() if entity not in named_entities_dict]
+    renumbered = [{"name": entity, "node_id": named_entities_dict[entity], "old_node_id": node_id}
+                  for entity, node_id in node_ids.items() if entity in named_entities_dict and node_id != named_entities_dict[entity]]
+
+    delete_entity_nodes(neo4j_factory, deleted, bulk_writer)
+    renumber_entity_nodes(neo4j_factory, renumbered, bulk_writer)
+
+
+def delete_entity_nodes(neo4j_factory: Neo4jClientFactory, rows: List[Dict], bulk_writer: Optional[BulkWriter] = None):
+    """Deletes the entity nodes of the rows (name and node_id) with their relationships."""
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
+    bulk_writer.write("""
+        UNWIND $rows AS row
+        MATCH (a:Entity {name: row.name})
+        WHERE a.type IS NULL
+        DETACH DELETE a
+        """, rows, name="Deleted Entity nodes", parallel=False)  # Deletes lock the relationships of the nodes
+    sync_entity_vector_mirror(removed_node_ids=[row["node_id"] for row in rows])
+
+
+def renumber_entity_nodes(neo4j_factory: Neo4jClientFactory, rows: List[Dict], bulk_writer: Optional[BulkWriter] = None):
+    """Changes the node_id of the entity nodes of the rows (name, node_id and old_node_id)."""
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
+    # Node ids must be unique: the node ids of the renumbered entities are freed before being reassigned
+    bulk_writer.write("""
+        UNWIND $rows AS row
+        MATCH (a:Entity {name: row.name})
+        WHERE a.type IS NULL
+        REMOVE a.node_id
+        """, rows, name="Freed Entity node ids")
+    bulk_writer.write("""
+        UNWIND $rows AS row
+        MATCH (a:Entity {name: row.name})
+        WHERE a.type IS NULL
+        SET a.node_id = row.node_id
+        """, rows, name="Renumbered Entity nodes")
+    sync_entity_vector_mirror(renumbered_node_ids={row["old_node_id"]: row["node_id"] for row in rows})
+
+
+def add_entities(neo4j_factory: Neo4jClientFactory, entities_embeddings, named_entities_dict: Dict,
+                 bulk_writer: Optional[BulkWriter] = None):
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
+    rebind_entity_node_ids(neo4j_factory, named_entities_dict, bulk_writer)
+    add_entity_rows(neo4j_factory, iter_entity_rows(named_entities_dict, entities_embeddings), bulk_writer)
+
+def add_entity_rows(neo4j_factory: Neo4jClientFactory, entity_rows: Iterable[Dict], bulk_writer: Optional[BulkWriter] = None):
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
+
+    query = """
+    UNWIND $rows AS ae
+    MERGE (a:Entity {node_id: ae.node_id})
+    SET a.name = ae.name, a.embedding = ae.embedding, a.content_hash = ae.content_hash
+    """
+    # Entities are distinct nodes, so their batches don't conflict
+    bulk_writer.write(query, entity_rows, name="Entity nodes", on_batch=upsert_entity_rows_in_mirror)
+    bump_entities_version(neo4j_factory)
+
+def add_relates_to_relationships(neo4j_factory: Neo4jClientFactory, doc_structure, bulk_writer: Optional[BulkWriter] = None):
+    add_triplets(neo4j_factory, iter_triplets(doc_structure), bulk_writer)
+
+def add_triplets(neo4j_factory: Neo4jClientFactory, triplets: Iterable[Dict], bulk_writer: Optional[BulkWriter] = None):
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
     
     query = """
-    UNWIND $triplets AS triplet
+    UNWIND $rows AS triplet
     MATCH (a:Entity {name: triplet.subject}), (b:Entity {name: triplet.object})
     MERGE (a)-[:RELATES_TO {type: triplet.predicate}]->(b)
     """
-    kg.query(query, {"triplets": triplets})
+    # Relationships between the same entities would deadlock in parallel batches
+    bulk_writer.write(query, triplets, name="RELATES_TO relationships", parallel=False)
 
 def build_vector_index(neo4j_factory: Neo4jClientFactory, idx_name = "entityIdx", emb_dim=256, sim_func='cosine'):
     kg = neo4j_factory.langchain_client()
@@ -94,12 +222,12 @@ def build_vector_index(neo4j_factory: Neo4jClientFactory, idx_name = "entityIdx"
     """
     kg.query(query, {'idx_name': idx_name, 'emb_dim': emb_dim, 'sim_func': sim_func})
 
-def add_similar_entities(neo4j_factory: Neo4jClientFactory, similar_entities: List):
-    kg = neo4j_factory.langchain_client()
+def add_similar_entities(neo4j_factory: Neo4jClientFactory, similar_entities: List, bulk_writer: Optional[BulkWriter] = None):
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
     
     query = """
-    UNWIND $similar_entities AS se
+    UNWIND $rows AS se
     MATCH (a:Entity {name: se.entity}), (b:Entity {name: se.similar_entity})
     MERGE (a)-[:SIMILAR_TO]->(b)
     """
-    kg.query(query, {"similar_entities": similar_entities})
+    bulk_writer.write(query, similar_entities, name="SIMILAR_TO relationships", parallel=False)
@@ -0,0 +1,182 @@
+###################################################################################################
+# Incremental graph sync
+#
+# Instead of re-MERGEing every entity, triple and similarity edge of a document, the artifacts are
+# diffed against the graph in Neo4j and only the delta (adds, updates and deletes) is written:
+#
+# * Entities are keyed by name. Entity nodes store the content hash of their name and embedding (see
+#   graph_neo4j.entity_content_hash), so changed entities are found without reading the embeddings
+#   back from Neo4j. Entities whose node id shifted but whose content didn't are only renumbered
+# * Relationships (RELATES_TO and SIMILAR_TO) are keyed by their ends and type, which is all their content
+#
+# The graph state is the whole database, as node ids are the positions of the entities of a document:
+# a database holds the graph of a single document, which sync_graph enforces (see
+# graph_neo4j.claim_graph_document). Users are also Entity nodes, but they aren't part of the document
+# artifacts, so they are never touched.
+###################################################################################################
+
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from llm_foundation import logger
+from pydantic import BaseModel
+
+from hackathon.bulk_writer import BulkWriter
+from hackathon.graph_neo4j import (add_entity_rows, add_similar_entities, add_triplets, claim_graph_document, delete_entity_nodes,
+                                   entity_content_hash, iter_triplets, renumber_entity_nodes, upsert_entity_rows_in_mirror)
+from hackathon.utils import Neo4jClientFactory
+
+
+class GraphDelta(BaseModel):
+    entities_added: List[Dict] = []  # Entity rows (see graph_neo4j.iter_entity_rows)
+    entities_updated: List[Dict] = []  # Entity rows, with the old_node_id
+    entities_renumbered: List[Dict] = []  # name, node_id and old_node_id of the entities whose content didn't change
+    entities_deleted: List[Dict] = []  # name and node_id
+    relates_to_added: List[Dict] = []  # subject, predicate and object (see graph_neo4j.iter_triplets)
+    relates_to_deleted: List[Dict] = []
+    similar_to_added: List[Dict] = []  # entity and similar_entity
+    similar_to_deleted: List[Dict] = []
+
+    def counts(self) -> Dict[str, int]:
+        return {field: len(getattr(self, field)) for field in type(self).model_fields}
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts().values())
+
+
+class GraphState(BaseModel):
+    """What the graph has of the document artifacts."""
+    entities: Dict[str, Tuple[Optional[int], Optional[str]]] = {}  # name -> (node_id, content_hash)
+    relates_to: Set[Tuple[str, str, str]] = set()  # (subject, predicate, object)
+    similar_to: Set[Tuple[str, str]] = set()  # (entity, similar_entity)
+
+
+def read_graph_state(neo4j_factory: Neo4jClientFactory) -> GraphState:
+    """Reads the keys and content hashes of the entities and relationships in the graph (streamed, without embeddings)."""
+    state = GraphState()
+    with neo4j_factory.neo4j_client() as driver:
+        with driver.session(database=neo4j_factory.database) as session:
+            for record in session.run("""
+                MATCH (n:Entity) WHERE n.type IS NULL
+                RETURN n.name AS name, n.node_id AS node_id, n.content_hash AS content_hash
+                """):
+                state.entities[record["name"]] = (record["node_id"], record["content_hash"])
+            for record in session.run("""
+                MATCH (a:Entity)-[r:RELATES_TO]->(b:Entity) WHERE a.type IS NULL AND b.type IS NULL
+                RETURN a.name AS subject, r.type AS predicate, b.name AS object
+                """):
+                state.relates_to.add((record["subject"], record["predicate"], record["object"]))
+            for record in session.run("""
+                MATCH (a:Entity)-[:SIMILAR_TO]->(b:Entity) WHERE a.type IS NULL AND b.type IS NULL
+                RETURN a.name AS entity, b.name AS similar_entity
+                """):
+                state.similar_to.add((record["entity"], record["similar_entity"]))
+    logger.info(f"Graph state: {len(state.entities)} entities, {len(state.relates_to)} RELATES_TO, {len(state.similar_to)} SIMILAR_TO")
+    return state
+
+
+def diff_graph(state: GraphState,
+               named_entities_dict: Dict[str, int],
+               entities_embeddings,
+               doc_structure,
+               similar_entities: List[Dict]) -> GraphDelta:
+    """Delta between the graph state and the artifacts of a document (the inputs of graph_creation_step_3).
+
+    Args:
+        state (GraphState): the graph state (see read_graph_state).
+        named_entities_dict (Dict[str, int]): entity name -> node id.
+        entities_embeddings: (n, dimension) embeddings indexed by node id, e.g. a memory-mapped embeddings file.
+        doc_structure: the chunks with their triples.
+        similar_entities (List[Dict]): the SIMILAR_TO relationships, as {"entity": ..., "similar_entity": ...}.
+
+    Returns:
+        GraphDelta: the adds, updates and deletes that make the graph match the artifacts.
+    """
+    delta = GraphDelta()
+
+    for entity, node_id in named_entities_dict.items():
+        embedding = np.asarray(entities_embeddings[node_id])
+        content_hash = entity_content_hash(entity, embedding)
+        current = state.entities.get(entity)
+        if current is not None and current[1] == content_hash:
+            if current[0] != node_id:
+                delta.entities_renumbered.append({"name": entity, "node_id": node_id, "old_node_id": current[0]})
+            continue
+        # Only the changed entities are converted to rows for the driver
+        row = {"name": entity, "node_id": node_id, "embedding": embedding.tolist(), "content_hash": content_hash}
+        if current is None:
+            delta.entities_added.append(row)
+        else:
+            delta.entities_updated.append({**row, "old_node_id": current[0]})
+    delta.entities_deleted = [{"name": entity, "node_id": node_id} for entity, (node_id, _) in state.entities.items()
+                              if entity not in named_entities_dict]
+
+    # Only triples between entities of the graph, like the MATCH of graph_neo4j.add_triplets
+    relates_to = {(triplet["subject"], triplet["predicate"], triplet["object"]) for triplet in iter_triplets(doc_structure)
+                  if triplet["subject"] in named_entities_dict and triplet["object"] in named_entities_dict}
+    delta.relates_to_added = [{"subject": subject, "predicate": predicate, "object": object}
+                              for subject, predicate, object in sorted(relates_to - state.relates_to)]
+    delta.relates_to_deleted = [{"subject": subject, "predicate": predicate, "object": object}
+                                for subject, predicate, object in sorted(state.relates_to - relates_to)]
+
+    similar_to = {(pair["entity"], pair["similar_entity"]) for pair in similar_entities}
+    delta.similar_to_added = [{"entity": entity, "similar_entity": similar_entity} for entity, similar_entity in sorted(similar_to - state.similar_to)]
+    delta.similar_to_deleted = [{"entity": entity, "similar_entity": similar_entity} for entity, similar_entity in sorted(state.similar_to - similar_to)]
+
+    logger.info(f"Graph delta ({delta.total} changes): {delta.counts()}")
+    return delta
+
+
+def apply_graph_delta(neo4j_factory: Neo4jClientFactory, delta: GraphDelta, bulk_writer: Optional[BulkWriter] = None):
+    """Writes the delta: first the deletes, then the entity updates and adds, and finally the relationship adds."""
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
+
+    # Deletes lock the relationships of the nodes, so they aren't parallel
+    bulk_writer.write("""
+        UNWIND $rows AS row
+        MATCH (a:Entity {name: row.subject})-[r:RELATES_TO {type: row.predicate}]->(b:Entity {name: row.object})
+        WHERE a.type IS NULL AND b.type IS NULL
+        DELETE r
+        """, delta.relates_to_deleted, name="Deleted RELATES_TO relationships", parallel=False)
+    bulk_writer.write("""
+        UNWIND $rows AS row
+        MATCH (a:Entity {name: row.entity})-[r:SIMILAR_TO]->(b:Entity {name: row.similar_entity})
+        WHERE a.type IS NULL AND b.type IS NULL
+        DELETE r
+        """, delta.similar_to_deleted, name="Deleted SIMILAR_TO relationships", parallel=False)
+    delete_entity_nodes(neo4j_factory, delta.entities_deleted, bulk_writer)
+
+    # Updated entities may be renumbered too, before their content is written
+    renumber_entity_nodes(neo4j_factory, delta.entities_renumbered + [row for row in delta.entities_updated if row["node_id"] != row["old_node_id"]],
+                          bulk_writer)
+    bulk_writer.write("""
+        UNWIND $rows AS row
+        MATCH (a:Entity {name: row.name})
+        WHERE a.type IS NULL
+        SET a.embedding = row.embedding, a.content_hash = row.content_hash
+        """, delta.entities_updated, name="Updated Entity nodes", on_batch=upsert_entity_rows_in_mirror)
+    add_entity_rows(neo4j_factory, delta.entities_added, bulk_writer)
+
+    add_triplets(neo4j_factory, delta.relates_to_added, bulk_writer)
+    add_similar_entities(neo4j_factory, delta.similar_to_added, bulk_writer)
+
+
+def sync_graph(neo4j_factory: Neo4jClientFactory,
+               document: str,
+               named_entities_dict: Dict[str, int],
+               entities_embeddings,
+               doc_structure,
+               similar_entities: List[Dict],
+               dry_run: bool = False,
+               bulk_writer: Optional[BulkWriter] = None) -> GraphDelta:
+    """Makes the graph match the artifacts of a document writing only what changed (see diff_graph).
+    Fails if the database holds the graph of another document. With dry_run, the delta is only computed and reported."""
+    claim_graph_document(neo4j_factory, document, dry_run=dry_run)
+    delta = diff_graph(read_graph_state(neo4j_factory), named_entities_dict, entities_embeddings, doc_structure, similar_entities)
+    if dry_run:
+        logger.info("Dry run: the graph delta is not applied")
+    elif delta.total:
+        apply_graph_delta(neo4j_factory, delta, bulk_writer)
+    return delta
@@ -2,55 +2,434 @@
 # Index and Embeddings functions
 ###################################################################################################
 
+import asyncio
+import hashlib
+import json
+import os
 import pickle
 
+from functools import lru_cache
+
 import faiss
 import numpy as np
+import tiktoken
 
 from numpy.typing import NDArray
-from typing import Any, Optional
-from langchain_openai import OpenAIEmbeddings
+from typing import Any, List, Literal, Optional, Tuple, Union
+from langchain_core.embeddings import Embeddings
 from llm_foundation import logger
+from pydantic import BaseModel
+
+from hackathon.cache import EmbeddingCache, get_embedding_cache
+from hackathon.embeddings import embedding_model_id, get_embeddings_model
+from hackathon.embedding_store import EmbeddingsHeader, create_embeddings_file, load_embeddings, save_embeddings
+from hackathon.retry import RetryConfig, retry_async
+
+
+def embed_texts(docs: List[str],
+                model: str = "text-embedding-3-small",
+                emb_dimension: int = 256,
+                cache: Optional[EmbeddingCache] = None) -> List[List[float]]:
+    """Embeds the docs with the configured provider (see embeddings), only paying for the (deduped) docs
+    missing in the embedding cache.
+
+    Args:
+        docs (List[str]): docs to embed.
+        model (str, optional): embedding model. Defaults to "text-embedding-3-small".
+        emb_dimension (int, optional): embedding dimension. Defaults to 256.
+        cache (Optional[EmbeddingCache], optional): embedding cache. Defaults to the process-wide one (see get_embedding_cache).
+
+    Returns:
+        List[List[float]]: the embeddings of the docs, in order.
+    """
+    embeddings_model: Embeddings = get_embeddings_model(model, emb_dimension)
+    cache = cache or get_embedding_cache()
+    if cache is None:
+        return embeddings_model.embed_documents(docs)
+    embeddings = cache.embed_documents(embeddings_model, embedding_model_id(model), emb_dimension, docs)
+    cache_stats = cache.stats()
+    logger.info(f"Embedding cache hit rate: {cache_stats.hit_rate:.2%} ({cache_stats})")
+    return embeddings
 
 
 def generate_embeddings(docs: list,
                         model: str = "text-embedding-3-small", 
                         emb_dimension: int = 256, 
-                        emb_save_path: Optional[str] = None) -> NDArray[Any]:
-    """Generate embeddings for the given documents with Open AI.
+                        emb_save_path: Optional[str] = None,
+                        cache: Optional[EmbeddingCache] = None) -> NDArray[Any]:
+    """Generate embeddings for the given documents with the configured provider (Open AI by default).
 
     Args:
         docs (list): docs to generate embeddings for.
         emb_dimension (int, optional): embedding dimension. Defaults to 256.
-        emb_save_path (Optional[str], optional): If present, the path where to save embeddings. Defaults to None.
+        emb_save_path (Optional[str], optional): If present, the path where to save embeddings in the binary
+        format of embedding_store (or as a pickled list if it ends with .pkl). Defaults to None.
+        cache (Optional[EmbeddingCache], optional): embedding cache. Defaults to the process-wide one.
 
     Returns:
         NDArray[Any]: array with the embeddings for the given documents.
     """
-    openai_embeddings = OpenAIEmbeddings(model=model, dimensions=emb_dimension)
-    doc_embeddings = openai_embeddings.embed_documents(docs)  # Embeddings are a array of array of floats
+    doc_embeddings = embed_texts(docs, model, emb_dimension, cache)  # Embeddings are a array of array of floats
     logger.debug(f"Doc embeddings: {doc_embeddings}")
     
-    if emb_save_path:
+    if emb_save_path and emb_save_path.endswith(".pkl"):
         with open(emb_save_path, "wb") as f:
             logger.debug(f"Doc embeddings saved to: {emb_save_path}")
             pickle.dump(doc_embeddings, f)
+    elif emb_save_path:
+        save_embeddings(emb_save_path, doc_embeddings, embedding_model_id(model))
     
     return np.array(doc_embeddings)
 
 
-def create_index(vectors: np.ndarray, emb_dimension: int, M: int) -> faiss.IndexHNSWFlat:
+@lru_cache(maxsize=None)
+def _get_token_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:  # e.g. offline, as tiktoken downloads the encodings
+        logger.warning(f"No token encoding available for {model} ({e}). Estimating token counts")
+        return None
+
+
+def count_tokens(docs: List[str], model: str = "text-embedding-3-small") -> List[int]:
+    encoding = _get_token_encoding(model)
+    if encoding is None:
+        return [len(doc) // 4 + 1 for doc in docs]  # ~4 chars per token in English
+    return [len(tokens) for tokens in encoding.encode_batch(docs)]
+
+
+def token_budgeted_batches(token_counts: List[int], max_tokens_per_batch: int = 100_000, max_docs_per_batch: int = 2048) -> List[Tuple[int, int]]:
+    """Splits the docs (by their token counts) in contiguous batches within the token and doc budgets.
+
+    Returns:
+        List[Tuple[int, int]]: the (start, end) doc positions of each batch.
+    """
+    batches = []
+    start, batch_tokens = 0, 0
+    for position, tokens in enumerate(token_counts):
+        if position > start and (batch_tokens + tokens > max_tokens_per_batch or position - start >= max_docs_per_batch):
+            batches.append((start, position))
+            start, batch_tokens = position, 0
+        batch_tokens += tokens
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+def _embedding_job_fingerprint(docs: List[str], model: str, emb_dimension: int, batches: List[Tuple[int, int]]) -> str:
+    job_hash = hashlib.sha256(json.dumps([model, emb_dimension, batches]).encode())
+    for doc in docs:
+        job_hash.update(doc.encode())
+        job_hash.update(b"\0")
+    return job_hash.hexdigest()
+
+
+def generate_embeddings_to_memmap(docs: List[str],
+                                  output_path: str,
+                                  model: str = "text-embedding-3-small",
+                                  emb_dimension: int = 256,
+                                  max_tokens_per_batch: int = 100_000,
+                                  max_docs_per_batch: int = 2048,
+                                  max_concurrency: int = 4,
+                                  max_retries: int = 3,
+                                  entity_ids: Optional[List[Union[int, str]]] = None,
+                                  checkpoint_every: int = 16,
+                                  cache: Optional[EmbeddingCache] = None) -> np.memmap:
+    """Generate embeddings for large collections of docs, streaming them to a float32 memmap on disk.
+
+    Docs are split in token-budgeted batches that are embedded concurrently (at most max_concurrency
+    requests in flight) through embed_texts, so docs already in the embedding cache aren't paid for
+    again. Each batch is written in place, in input order, in a preallocated (len(docs), emb_dimension)
+    float32 embeddings file (see embedding_store), so memory doesn't grow with the number of docs and
+    the result can be loaded zero-copy with load_embeddings. Every checkpoint_every batches (and when
+    the function returns or fails) the file is flushed and the finished batches are checkpointed in
+    output_path.progress.json, so after a failure, calling the function again with the same docs and
+    params only embeds the batches missing since the last checkpoint.
+
+    Args:
+        docs (List[str]): docs to generate embeddings for.
+        output_path (str): path of the embeddings file.
+        model (str, optional): embedding model. Defaults to "text-embedding-3-small".
+        emb_dimension (int, optional): embedding dimension. Defaults to 256.
+        max_tokens_per_batch (int, optional): max tokens per embedding request. Defaults to 100_000.
+        max_docs_per_batch (int, optional): max docs per embedding request. Defaults to 2048.
+        max_concurrency (int, optional): max concurrent embedding requests. Defaults to 4.
+        max_retries (int, optional): retries per batch, with exponential backoff (see retry). Defaults to 3.
+        entity_ids (Optional[List[Union[int, str]]], optional): entity id of each doc, stored in the
+        file header. Defaults to the doc positions.
+        checkpoint_every (int, optional): finished batches between checkpoints. Defaults to 16.
+        cache (Optional[EmbeddingCache], optional): embedding cache. Defaults to the process-wide one (see get_embedding_cache).
+
+    Returns:
+        np.memmap: the (len(docs), emb_dimension) float32 embeddings, backed by output_path.
+    """
+    if not docs:
+        raise ValueError("No docs to embed")
+    batches = token_budgeted_batches(count_tokens(docs, model), max_tokens_per_batch, max_docs_per_batch)
+    fingerprint = _embedding_job_fingerprint(docs, embedding_model_id(model), emb_dimension, batches)
+    progress_path = f"{output_path}.progress.json"
+
+    done_batches = set()
+    if os.path.exists(progress_path) and os.path.exists(output_path):
+        with open(progress_path, "r") as f:
+            progress = json.load(f)
+        if progress["fingerprint"] == fingerprint:
+            done_batches = set(progress["done_batches"])
+    header = EmbeddingsHeader(model=embedding_model_id(model), dimension=emb_dimension, count=len(docs),
+                              entity_ids=entity_ids if entity_ids is not None else list(range(len(docs))))
+    if done_batches:
+        embeddings, previous_header = load_embeddings(output_path, mode="r+")
+        if previous_header != header:
+            done_batches = set()
+    if not done_batches:
+        embeddings = create_embeddings_file(output_path, header)
+    logger.info(f"Embedding {len(docs)} docs in {len(batches)} batches ({len(done_batches)} already done) into {output_path}")
+
+    def checkpoint():
+        embeddings.flush()
+        with open(f"{progress_path}.tmp", "w") as f:
+            json.dump({"fingerprint": fingerprint, "done_batches": sorted(done_batches)}, f)
+        os.replace(f"{progress_path}.tmp", progress_path)
+
+    cache = cache or get_embedding_cache()
+    retry_config = RetryConfig(max_retries=max_retries)
+    batches_since_checkpoint = 0
+
+    async def embed_batch(batch_idx: int, semaphore: asyncio.Semaphore):
+        nonlocal batches_since_checkpoint
+        start, end = batches[batch_idx]
+        def on_retry(attempt: int, e: Exception, wait: float):
+            logger.warning(f"Embedding batch {batch_idx} failed (attempt {attempt + 1}): {e}. Retrying in {wait:.1f}s")
+
+        async with semaphore:
+            # In a thread, as the cache (and its disk LRU) is synchronous
+            batch_embeddings = await retry_async(lambda: asyncio.to_thread(embed_texts, docs[start:end], model, emb_dimension, cache),
+                                                 retry_config, on_retry=on_retry)
+        embeddings[start:end] = np.asarray(batch_embeddings, dtype=np.float32)
+        done_batches.add(batch_idx)
+        batches_since_checkpoint += 1
+        if batches_since_checkpoint >= checkpoint_every:
+            checkpoint()
+            batches_since_checkpoint = 0
+
+    async def embed_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        await asyncio.gather(*(embed_batch(batch_idx, semaphore) for batch_idx in range(len(batches)) if batch_idx not in done_batches))
+
+    try:
+        asyncio.run(embed_all())
+    finally:
+        checkpoint()  # Batches finished before a failure are kept for the next call
+    return embeddings
+
+
+class IndexConfig(BaseModel):
+    """FAISS index family and params, e.g. as selected by index_benchmark for a target recall."""
+    family: Literal["flat", "hnsw", "ivf", "ivfpq"] = "hnsw"
+    # HNSW
+    M: int = 64  # Neighbors added to each vertex on insertion
+    ef_construction: int = 40  # FAISS default
+    ef_search: int = 16  # FAISS default
+    # IVF and IVF-PQ
+    nlist: int = 100  # Number of inverted lists (capped by the number of training vectors)
+    nprobe: int = 1  # Number of lists visited per query
+    pq_m: int = 16  # Number of PQ sub-quantizers (must divide the dimension)
+    pq_bits: int = 8  # Bits per PQ code
+    # Precision of the vectors stored in flat, HNSW and IVF indexes (scalar quantizer for float16 and int8)
+    precision: Literal["float32", "float16", "int8"] = "float32"
+
+    @classmethod
+    def load(cls, path: str) -> "IndexConfig":
+        with open(path, "r") as f:
+            return cls.model_validate_json(f.read())
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.model_dump_json(indent=2))
+
+    def build_params(self) -> dict:
+        """The params that shape the index (all but the search params, which can change on a built index)."""
+        return self.model_dump(exclude={"ef_search", "nprobe"})
+
+
+def new_index(emb_dimension: int, config: IndexConfig, n_train: Optional[int] = None) -> faiss.Index:
+    """Creates an empty FAISS index for the config. IVF and scalar quantized indexes must be trained before adding vectors."""
     # See https://www.pinecone.io/learn/series/faiss/hnsw/ for info about HNSW
     # See also https://bakingai.com/blog/hnsw-semantic-search-faiss-integration/
-    faiss_index = faiss.IndexHNSWFlat(emb_dimension, M)
+    quantizer_type = {"float16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}.get(config.precision)
+    if config.family == "flat":
+        if quantizer_type is not None:
+            return faiss.IndexScalarQuantizer(emb_dimension, quantizer_type)
+        return faiss.IndexFlatL2(emb_dimension)
+    if config.family == "hnsw":
+        if quantizer_type is not None:
+            faiss_index = faiss.IndexHNSWSQ(emb_dimension, quantizer_type, config.M)
+        else:
+            faiss_index = faiss.IndexHNSWFlat(emb_dimension, config.M)
+        faiss_index.hnsw.efConstruction = config.ef_construction
+        return faiss_index
+    nlist = config.nlist if n_train is None else max(1, min(config.nlist, n_train // 39))  # FAISS wants >= 39 points per list
+    quantizer = faiss.IndexFlatL2(emb_dimension)
+    if config.family == "ivf":
+        if quantizer_type is not None:
+            return faiss.IndexIVFScalarQuantizer(quantizer, emb_dimension, nlist, quantizer_type)
+        return faiss.IndexIVFFlat(quantizer, emb_dimension, nlist)
+    return faiss.IndexIVFPQ(quantizer, emb_dimension, nlist, config.pq_m, config.pq_bits)
 
-    # convert to numpy array
 
-    faiss_index.add(vectors)  # Build the index
+def set_search_params(faiss_index: faiss.Index, config: IndexConfig):
+    if config.family == "hnsw":
+        faiss_index.hnsw.efSearch = config.ef_search
+    elif config.family in ("ivf", "ivfpq"):
+        faiss.extract_index_ivf(faiss_index).nprobe = config.nprobe
+
 
+def create_index(vectors: np.ndarray, emb_dimension: int, M: int = 64, config: Optional[IndexConfig] = None) -> faiss.Index:
+    """Builds a FAISS index with the vectors. Defaults to HNSW with M neighbors (config takes precedence)."""
+    config = config or IndexConfig(M=M)
+    faiss_index = new_index(emb_dimension, config, n_train=len(vectors))
+    if not faiss_index.is_trained:
+        faiss_index.train(vectors)
+    faiss_index.add(vectors)  # Build the index
+    set_search_params(faiss_index, config)
     return faiss_index
 
-def search_index(faiss_index: faiss.IndexHNSWFlat, query: list, recall_at_k: int) -> tuple:
+def vector_digests(vectors: np.ndarray, batch_size: int = 65536) -> List[str]:
+    """Digest of each (float32) vector, to find the changed vectors without comparing them."""
+    digests = []
+    for start in range(0, len(vectors), batch_size):
+        batch = np.ascontiguousarray(vectors[start:start + batch_size], dtype=np.float32)
+        digests.extend(hashlib.blake2b(vector.tobytes(), digest_size=8).hexdigest() for vector in batch)
+    return digests
+
+
+class PersistentEntityIndex:
+    """FAISS index of entity embeddings persisted on disk, updated in place as the entities change.
+
+    Rows are keyed by entity name, as node ids are reassigned on every run of step 2, together with the
+    digest of their vector, so re-indexing a document only costs the insertions of its new or changed
+    entities. Graph indexes (HNSW) can't remove vectors, so the rows of the removed or changed entities
+    are tombstoned (search never returns them) and the index is rebuilt once they exceed
+    max_stale_fraction of the rows.
+
+    The index is saved in <path>.faiss, the key and digest of each row in <path>.rows.json and the
+    embedding model (see embeddings.embedding_model_id), dimension and index build params (see
+    IndexConfig.build_params) in <path>.meta.json. Indexes of other models, dimensions, families or
+    precisions are rebuilt.
+    """
+
+    def __init__(self, path: str, faiss_index: Optional[faiss.Index], keys: List[Optional[str]], digests: List[Optional[str]],
+                 model: str, config: Optional[IndexConfig] = None, max_stale_fraction: float = 0.2):
+        self.path = path
+        self.index = faiss_index
+        self.keys = keys  # Entity name of each row, None if tombstoned
+        self.digests = digests
+        self.model = model
+        self.config = config or IndexConfig()
+        self.max_stale_fraction = max_stale_fraction
+        self.row_ids = np.full(len(keys), -1, dtype=np.int64)  # Id of each row (see update), -1 if unknown
+
+    def _meta(self, emb_dimension: int) -> dict:
+        return {"model": self.model, "dimension": emb_dimension, "index": self.config.build_params()}
+
+    @classmethod
+    def load_or_create(cls, path: str, emb_dimension: int, M: int = 64, config: Optional[IndexConfig] = None,
+                       model: str = "text-embedding-3-small", max_stale_fraction: float = 0.2) -> "PersistentEntityIndex":
+        config = config or IndexConfig(M=M)
+        entity_index = cls(path, None, [], [], embedding_model_id(model), config, max_stale_fraction)
+        if not all(os.path.exists(f"{path}.{suffix}") for suffix in ("faiss", "rows.json", "meta.json")):
+            return entity_index
+        with open(f"{path}.meta.json", "r") as f:
+            meta = json.load(f)
+        if meta != entity_index._meta(emb_dimension):
+            logger.warning(f"Entity index {path}.faiss was built for {meta}, not {entity_index._meta(emb_dimension)}. Rebuilding it")
+            return entity_index
+        faiss_index = faiss.read_index(f"{path}.faiss")
+        with open(f"{path}.rows.json", "r") as f:
+            rows = json.load(f)
+        if faiss_index.ntotal != len(rows["keys"]):
+            logger.warning(f"Entity index {path}.faiss doesn't match its rows ({faiss_index.ntotal} != {len(rows['keys'])}). Rebuilding it")
+            return entity_index
+        logger.info(f"Entity index loaded from {path}.faiss with {faiss_index.ntotal} rows")
+        set_search_params(faiss_index, config)
+        return cls(path, faiss_index, rows["keys"], rows["digests"], entity_index.model, config, max_stale_fraction)
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal if self.index is not None else 0
+
+    def update(self, keys: List[str], vectors: np.ndarray, ids: Optional[List[int]] = None) -> List[str]:
+        """Makes the index search exactly the given entities: the vectors of the new keys are added, and the
+        ones of the keys that are gone or whose vector changed are replaced or tombstoned.
+
+        Args:
+            keys (List[str]): the entity names.
+            vectors (np.ndarray): (len(keys), dimension) vectors, e.g. a memory-mapped embeddings file.
+            ids (Optional[List[int]], optional): id of each key (e.g. its node_id), returned by search and kept
+            in row_ids. Defaults to the key positions.
+
+        Returns:
+            List[str]: the keys whose vectors were (re)inserted.
+        """
+        ids = list(range(len(keys))) if ids is None else list(ids)
+        digests = vector_digests(vectors)
+        key_digests = dict(zip(keys, digests))
+        stale_rows = [row for row, key in enumerate(self.keys) if key is not None and key_digests.get(key) != self.digests[row]]
+        for row in stale_rows:
+            self.keys[row], self.digests[row] = None, None
+        indexed_keys = {key for key in self.keys if key is not None}
+        new_positions = [position for position, key in enumerate(keys) if key not in indexed_keys]
+
+        tombstones = len(self.keys) - len(indexed_keys)
+        if tombstones and tombstones > self.max_stale_fraction * (len(self.keys) + len(new_positions)):
+            logger.info(f"{tombstones} of {len(self.keys)} rows of the entity index are stale. Rebuilding it")
+            self.index, self.keys, self.digests = None, [], []
+            new_positions = list(range(len(keys)))
+        if new_positions:
+            self._insert(vectors, new_positions)
+            self.keys.extend(keys[position] for position in new_positions)
+            self.digests.extend(digests[position] for position in new_positions)
+
+        key_ids = dict(zip(keys, ids))
+        self.row_ids = np.asarray([key_ids[key] if key is not None else -1 for key in self.keys], dtype=np.int64)
+        logger.info(f"{len(new_positions)} entities (re)inserted in the index and {len(stale_rows)} tombstoned "
+                    f"({self.ntotal} rows, {len(keys)} entities)")
+        return [keys[position] for position in new_positions]
+
+    def _insert(self, vectors: np.ndarray, positions: List[int], batch_size: int = 65536):
+        """Adds the vectors at positions in batches, so only a batch is converted to float32 at a time."""
+        if self.index is None:  # IVF and scalar quantized indexes are trained with (a sample of) the first vectors added
+            train_vectors = np.ascontiguousarray(vectors[positions[::-(-len(positions) // batch_size)]], dtype=np.float32)
+            self.index = new_index(train_vectors.shape[1], self.config, n_train=len(train_vectors))
+            if not self.index.is_trained:
+                self.index.train(train_vectors)
+            set_search_params(self.index, self.config)
+        for start in range(0, len(positions), batch_size):
+            self.index.add(np.ascontiguousarray(vectors[positions[start:start + batch_size]], dtype=np.float32))
+
+    def search(self, query: np.ndarray, recall_at_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Like search_index, but the indices are row_ids (-1 for tombstones or if there are less than recall_at_k results)."""
+        distances, rows = search_index(self.index, query, recall_at_k, self.config)
+        return distances, np.append(self.row_ids, -1)[rows]  # Row -1 (no result) maps to -1
+
+    def save(self):
+        if self.index is None:
+            return
+        faiss.write_index(self.index, f"{self.path}.faiss.tmp")
+        with open(f"{self.path}.rows.json.tmp", "w") as f:
+            json.dump({"keys": self.keys, "digests": self.digests}, f)
+        with open(f"{self.path}.meta.json.tmp", "w") as f:
+            json.dump(self._meta(self.index.d), f)
+        for suffix in ("faiss", "rows.json", "meta.json"):
+            os.replace(f"{self.path}.{suffix}.tmp", f"{self.path}.{suffix}")
+
+
+def search_index(faiss_index: faiss.Index, query: list, recall_at_k: int, config: Optional[IndexConfig] = None) -> tuple:
+    if config is not None:
+        set_search_params(faiss_index, config)
     distances, indices = faiss_index.search(query, recall_at_k)
     logger.info(f"\nDistances:\n{np.round(distances, 3)}\nIndices:\n{indices}")
     
@@ -62,18 +441,110 @@ def calculate_scores(distances: list) -> list:
     return scores
 
 def build_similar_entities(entities: list, indices: list, distances: list, recall_at_k: int, max_distance: float=0.7) -> list:
-    similar_entities = []
-    for idx, entity in enumerate(entities):
-        for i in range(recall_at_k):
-            if indices[idx][i] != idx and distances[idx][i] <= max_distance:
-                logger.info(f"Similarity (<={max_distance} dist) found for {entity} ({idx}) with {entities[indices[idx][i]]} ({indices[idx][i]}): Distance {distances[idx][i]}")
-                similar_entities.append(
-                    {
-                        "entity": entity, 
-                        "similar_entity": entities[indices[idx][i]]
-                    }
-                )
-    return similar_entities
+    """SIMILAR_TO pairs from the search_index output of the entities queried against themselves.
+
+    Returns the pairs in the same order as looping over the entities and their recall_at_k neighbors.
+    """
+    pairs, _ = similar_pairs_from_search(np.asarray(distances)[:, :recall_at_k], np.asarray(indices)[:, :recall_at_k], max_distance)
+    logger.info(f"{len(pairs)} similar pairs (<={max_distance} dist) found for {len(entities)} entities")
+    return [{"entity": entities[query], "similar_entity": entities[neighbor]} for query, neighbor in pairs.tolist()]
+
+
+def similar_pairs_from_search(distances: np.ndarray, indices: np.ndarray, max_distance: float,
+                              query_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Masks the (n_queries, k) search results to the neighbors within max_distance, excluding the query itself
+    and missing results (-1).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the (query id, neighbor) pairs (query ids default to the query positions)
+        in row-major order, and their distances.
+    """
+    query_ids = np.arange(len(indices)) if query_ids is None else np.asarray(query_ids)
+    mask = (indices != query_ids[:, None]) & (indices >= 0) & (distances <= max_distance)
+    rows, cols = np.nonzero(mask)
+    return np.stack([query_ids[rows], indices[rows, cols]], axis=1), distances[rows, cols]
+
+
+def find_similar_pairs(faiss_index: faiss.Index,
+                       vectors: np.ndarray,
+                       max_distance: float,
+                       recall_at_k: int = 3,
+                       range_search: bool = False,
+                       batch_size: int = 8192,
+                       config: Optional[IndexConfig] = None,
+                       row_ids: Optional[List[int]] = None,
+                       query_ids: Optional[List[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the pairs of similar vectors (within max_distance) querying the index with the vectors it contains.
+
+    Queries run in batches of batch_size, so memory is bounded by batch_size x recall_at_k (or the range
+    results of a batch) instead of growing with the number of vectors.
+
+    Args:
+        faiss_index (faiss.Index): index with the vectors.
+        vectors (np.ndarray): (n, dimension) vectors to query, e.g. a memory-mapped embeddings file.
+        max_distance (float): max distance of a similar pair.
+        recall_at_k (int, optional): neighbors retrieved per vector (ignored with range_search). Defaults to 3.
+        range_search (bool, optional): return all the neighbors within max_distance instead of the recall_at_k
+        nearest ones. Not supported by all the index families (e.g. IVF-PQ). Defaults to False.
+        batch_size (int, optional): vectors queried per batch. Defaults to 8192.
+        config (Optional[IndexConfig], optional): search params of the index. Defaults to None.
+        row_ids (Optional[List[int]], optional): id of each index row, -1 for rows never returned (e.g. the
+        row_ids of a PersistentEntityIndex). Defaults to the row positions.
+        query_ids (Optional[List[int]], optional): id of each vector. Defaults to the vector positions.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the (n_pairs, 2) (vector id, similar id) pairs, sorted by vector and
+        then by distance, and their distances.
+    """
+    if config is not None:
+        set_search_params(faiss_index, config)
+    id_map = None if row_ids is None else np.append(np.asarray(row_ids, dtype=np.int64), -1)  # Row -1 (no result) maps to -1
+    # Rows without id (e.g. tombstones) take neighbor slots, so up to recall_at_k more neighbors are retrieved
+    search_k = recall_at_k if id_map is None else recall_at_k + min(recall_at_k, int(np.count_nonzero(id_map[:-1] < 0)))
+    query_ids = np.arange(len(vectors)) if query_ids is None else np.asarray(query_ids, dtype=np.int64)
+    all_pairs, all_distances = [], []
+    for start in range(0, len(vectors), batch_size):
+        batch = np.ascontiguousarray(vectors[start:start + batch_size], dtype=np.float32)
+        if range_search:
+            limits, distances, indices = faiss_index.range_search(batch, max_distance)
+            query_positions = np.repeat(np.arange(len(batch)), np.diff(limits.astype(np.int64)))
+            order = np.lexsort((distances, query_positions))  # Range results come unsorted
+            query_positions, distances, indices = query_positions[order], distances[order], indices[order]
+            distances, indices = distances[:, None], indices[:, None]
+        else:
+            distances, indices = faiss_index.search(batch, search_k)
+            query_positions = np.arange(len(batch))
+        if id_map is not None:
+            indices = id_map[indices]
+            if not range_search:  # Keep the recall_at_k nearest neighbors with id
+                valid = indices >= 0
+                indices = np.where(valid & (np.cumsum(valid, axis=1) <= recall_at_k), indices, -1)
+        pairs, pair_distances = similar_pairs_from_search(distances, indices, max_distance, query_ids[start + query_positions])
+        all_pairs.append(pairs)
+        all_distances.append(pair_distances)
+    if not all_pairs:
+        return np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.float32)
+    pairs, distances = np.concatenate(all_pairs), np.concatenate(all_distances)
+    logger.info(f"{len(pairs)} similar pairs (<={max_distance} dist) found for {len(vectors)} vectors")
+    return pairs, distances
+
+
+def find_similar_entities(entities: list,
+                          faiss_index: faiss.Index,
+                          vectors: np.ndarray,
+                          max_distance: float = 0.7,
+                          recall_at_k: int = 3,
+                          range_search: bool = False,
+                          batch_size: int = 8192,
+                          config: Optional[IndexConfig] = None,
+                          row_ids: Optional[List[int]] = None,
+                          query_ids: Optional[List[int]] = None) -> list:
+    """Batched (and optionally range search) version of search_index + build_similar_entities.
+
+    The ids of the pairs (see find_similar_pairs) must be positions in entities.
+    """
+    pairs, _ = find_similar_pairs(faiss_index, vectors, max_distance, recall_at_k, range_search, batch_size, config, row_ids, query_ids)
+    return [{"entity": entities[entity], "similar_entity": entities[similar_entity]} for entity, similar_entity in pairs.tolist()]
 
 # TODO Not used for now
 # https://medium.com/@asakisakamoto02/how-to-use-faiss-similarity-search-with-score-explained-99ea3fe964cf
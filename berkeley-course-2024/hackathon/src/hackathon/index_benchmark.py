@@ -0,0 +1,213 @@
+###################################################################################################
+# ANN index benchmark: recall/latency/memory of FAISS index families on the entity embeddings
+###################################################################################################
+
+import argparse
+import json
+import time
+
+from typing import List, Optional
+
+import faiss
+import numpy as np
+
+from llm_foundation import logger
+from pydantic import BaseModel
+
+from hackathon.embedding_store import load_embeddings_float32, quantize_int8
+from hackathon.index import IndexConfig, create_index, set_search_params
+
+
+class BenchmarkResult(BaseModel):
+    config: IndexConfig
+    recall_at_k: float
+    build_time_s: float
+    latency_p50_ms: float
+    latency_p95_ms: float
+    latency_p99_ms: float
+    memory_bytes: int  # Size of the serialized index
+
+
+class PrecisionReportRow(BaseModel):
+    precision: str
+    storage_bytes: int  # Bytes of the embeddings in the artifact (see embedding_store)
+    storage_saved: float  # Fraction of the float32 storage saved
+    storage_recall_at_k: float  # Recall@k of exact search over the stored (dequantized) embeddings
+    index_memory_bytes: int
+    index_memory_saved: float  # Fraction of the float32 index memory saved
+    recall_at_k: float
+    recall_delta: float  # Index recall@k minus the recall@k of the float32 index
+
+
+def default_index_configs(emb_dimension: int) -> List[IndexConfig]:
+    """The sweep: exact search, HNSW with several M/efConstruction/efSearch, IVF and IVF-PQ with several nprobe."""
+    configs = [IndexConfig(family="flat")]
+    for M in (16, 32, 64):
+        for ef_construction in (40, 200):
+            for ef_search in (16, 64, 256):
+                configs.append(IndexConfig(family="hnsw", M=M, ef_construction=ef_construction, ef_search=ef_search))
+    for nlist in (64, 256):
+        for nprobe in (1, 8, 32):
+            configs.append(IndexConfig(family="ivf", nlist=nlist, nprobe=nprobe))
+    pq_m = next(m for m in (32, 16, 8, 4, 2, 1) if emb_dimension % m == 0)
+    for nlist in (64, 256):
+        for nprobe in (8, 32):
+            configs.append(IndexConfig(family="ivfpq", nlist=nlist, nprobe=nprobe, pq_m=pq_m))
+    return configs
+
+
+def exact_ground_truth(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Exact (brute-force) k nearest neighbors of the queries."""
+    flat_index = faiss.IndexFlatL2(vectors.shape[1])
+    flat_index.add(vectors)
+    _, ground_truth = flat_index.search(queries, k)
+    return ground_truth
+
+
+def recall_at_k(found: np.ndarray, ground_truth: np.ndarray) -> float:
+    k = ground_truth.shape[1]
+    hits = sum(len(set(found_row[:k]) & set(truth_row)) for found_row, truth_row in zip(found, ground_truth))
+    return hits / (k * len(ground_truth))
+
+
+def benchmark_index(vectors: np.ndarray, queries: np.ndarray, ground_truth: np.ndarray, config: IndexConfig) -> BenchmarkResult:
+    k = ground_truth.shape[1]
+    start = time.perf_counter()
+    faiss_index = create_index(vectors, vectors.shape[1], config=config)
+    build_time = time.perf_counter() - start
+
+    # Queries one by one, as in retrieval, to get the latency distribution
+    set_search_params(faiss_index, config)
+    found = np.empty_like(ground_truth)
+    latencies_ms = np.empty(len(queries))
+    for position in range(len(queries)):
+        start = time.perf_counter()
+        _, found[position:position + 1] = faiss_index.search(queries[position:position + 1], k)
+        latencies_ms[position] = (time.perf_counter() - start) * 1000
+
+    return BenchmarkResult(
+        config=config,
+        recall_at_k=recall_at_k(found, ground_truth),
+        build_time_s=build_time,
+        latency_p50_ms=float(np.percentile(latencies_ms, 50)),
+        latency_p95_ms=float(np.percentile(latencies_ms, 95)),
+        latency_p99_ms=float(np.percentile(latencies_ms, 99)),
+        memory_bytes=int(faiss.serialize_index(faiss_index).size),
+    )
+
+
+def _sample_queries(vectors: np.ndarray, k: int, n_queries: int, seed: int):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    return vectors, queries, exact_ground_truth(vectors, queries, min(k, len(vectors)))
+
+
+def run_benchmark(vectors: np.ndarray,
+                  k: int = 10,
+                  n_queries: int = 1000,
+                  configs: Optional[List[IndexConfig]] = None,
+                  seed: int = 42) -> List[BenchmarkResult]:
+    """Benchmarks the index configs on the vectors, querying with a sample of them.
+
+    Args:
+        vectors (np.ndarray): (n, dimension) embeddings, e.g. the entity embeddings.
+        k (int, optional): neighbors retrieved per query, for recall@k. Defaults to 10.
+        n_queries (int, optional): number of vectors sampled as queries. Defaults to 1000.
+        configs (Optional[List[IndexConfig]], optional): configs to benchmark. Defaults to default_index_configs.
+        seed (int, optional): seed of the query sample. Defaults to 42.
+
+    Returns:
+        List[BenchmarkResult]: a result per config.
+    """
+    vectors, queries, ground_truth = _sample_queries(vectors, k, n_queries, seed)
+    k = ground_truth.shape[1]
+    results = []
+    for config in configs or default_index_configs(vectors.shape[1]):
+        try:
+            result = benchmark_index(vectors, queries, ground_truth, config)
+        except Exception as e:  # e.g. not enough vectors to train an IVF-PQ
+            logger.warning(f"Skipping {config}: {e}")
+            continue
+        logger.info(f"{config.model_dump()}: recall@{k} {result.recall_at_k:.3f}, build {result.build_time_s:.2f}s, "
+                    f"p50/p95/p99 {result.latency_p50_ms:.3f}/{result.latency_p95_ms:.3f}/{result.latency_p99_ms:.3f}ms, "
+                    f"{result.memory_bytes / 2**20:.1f}MB")
+        results.append(result)
+    return results
+
+
+def precision_report(vectors: np.ndarray,
+                     k: int = 10,
+                     n_queries: int = 1000,
+                     base_config: Optional[IndexConfig] = None,
+                     seed: int = 42) -> List[PrecisionReportRow]:
+    """Memory saved and recall lost by storing and indexing the vectors in float16 and int8 instead of float32.
+
+    Storage recall measures the stored embeddings alone (exact search over the dequantized vectors with full
+    precision queries), index recall the base_config index (HNSW by default) in each precision.
+    """
+    vectors, queries, ground_truth = _sample_queries(vectors, k, n_queries, seed)
+    k = ground_truth.shape[1]
+    base_config = base_config or IndexConfig()
+
+    rows = []
+    for precision in ("float32", "float16", "int8"):
+        if precision == "int8":
+            codes, scale = quantize_int8(vectors)
+            stored_vectors, storage_bytes = codes.astype(np.float32) * scale, codes.nbytes
+        else:
+            stored = vectors.astype(precision)
+            stored_vectors, storage_bytes = stored.astype(np.float32), stored.nbytes
+        flat_index = faiss.IndexFlatL2(vectors.shape[1])
+        flat_index.add(np.ascontiguousarray(stored_vectors))
+        _, found = flat_index.search(queries, k)
+
+        result = benchmark_index(vectors, queries, ground_truth, base_config.model_copy(update={"precision": precision}))
+        full_precision = rows[0] if rows else None
+        rows.append(PrecisionReportRow(
+            precision=precision,
+            storage_bytes=storage_bytes,
+            storage_saved=1 - storage_bytes / full_precision.storage_bytes if full_precision else 0.0,
+            storage_recall_at_k=recall_at_k(found, ground_truth),
+            index_memory_bytes=result.memory_bytes,
+            index_memory_saved=1 - result.memory_bytes / full_precision.index_memory_bytes if full_precision else 0.0,
+            recall_at_k=result.recall_at_k,
+            recall_delta=result.recall_at_k - full_precision.recall_at_k if full_precision else 0.0,
+        ))
+        logger.info(f"{precision}: storage {storage_bytes / 2**20:.1f}MB (recall@{k} {rows[-1].storage_recall_at_k:.3f}), "
+                    f"{base_config.family} index {result.memory_bytes / 2**20:.1f}MB (recall@{k} {result.recall_at_k:.3f}, "
+                    f"delta {rows[-1].recall_delta:+.3f})")
+    return rows
+
+
+def select_best_config(results: List[BenchmarkResult], target_recall: float = 0.95) -> IndexConfig:
+    """The config with the lowest p95 latency among the ones reaching the target recall (the highest recall if none does)."""
+    candidates = [result for result in results if result.recall_at_k >= target_recall]
+    if not candidates:
+        logger.warning(f"No index config reaches a recall of {target_recall}. Selecting the one with the highest recall")
+        return max(results, key=lambda result: result.recall_at_k).config
+    return min(candidates, key=lambda result: (result.latency_p95_ms, result.memory_bytes)).config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index families on embeddings and select the best config")
+    parser.add_argument("embeddings", help="Embeddings file (see hackathon.embedding_store)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--output", default="index_config.json", help="Where to save the selected IndexConfig")
+    parser.add_argument("--report", default=None, help="Where to save all the results as JSON")
+    parser.add_argument("--precision-report", default=None, help="Where to save the float32/float16/int8 comparison as JSON")
+    args = parser.parse_args()
+
+    embeddings, _ = load_embeddings_float32(args.embeddings)
+    if args.precision_report:
+        with open(args.precision_report, "w") as f:
+            json.dump([row.model_dump() for row in precision_report(embeddings, k=args.k, n_queries=args.n_queries)], f, indent=4)
+    results = run_benchmark(embeddings, k=args.k, n_queries=args.n_queries)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([result.model_dump() for result in results], f, indent=4)
+    best_config = select_best_config(results, args.target_recall)
+    best_config.save(args.output)
+    logger.info(f"Selected index config (target recall {args.target_recall}) saved to {args.output}: {best_config}")
@@ -10,6 +10,7 @@ from crewai import Agent, Task, Crew
 from crewai.crews import CrewOutput
 from langchain.output_parsers.json import SimpleJsonOutputParser
 from rich.pretty import pprint
+from hackathon.cache import get_llm_response_cache
 from hackathon.input_output_types import NamedEntities
 
 
@@ -34,12 +35,21 @@ def extract_named_entities(user_query: str) -> List[str]:
         verbose=True,
     )
 
-    logger.info("^^^^^^^^^^^^^^^^^^^^^^^^^^^^ Calling Agents ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
-    result: CrewOutput = crew.kickoff(inputs=query_inputs)
-    logger.info(".................................................................................")
-    logger.info(type(result.json))
-    logger.info(result)
-    entities = json.loads(result.json)
+    def kickoff() -> Dict:
+        logger.info("^^^^^^^^^^^^^^^^^^^^^^^^^^^^ Calling Agents ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
+        result: CrewOutput = crew.kickoff(inputs=query_inputs)
+        logger.info(".................................................................................")
+        logger.info(type(result.json))
+        logger.info(result)
+        return json.loads(result.json)
+
+    llm_cache = get_llm_response_cache()
+    if llm_cache is None:
+        entities = kickoff()
+    else:
+        extraction_prompt = "\n".join([extract_entities.description, extract_entities.expected_output, query_inputs["entity_extractor_examples"]])
+        llm_model = os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini")
+        entities = llm_cache.cached_call(llm_model, extraction_prompt, "entity_extractor", user_query, kickoff)
     return entities["named_entities"]
 
 
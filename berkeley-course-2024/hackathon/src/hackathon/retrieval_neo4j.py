@@ -1,11 +1,40 @@
+import pickle
+
 import numpy as np
 import igraph as ig
+import scipy.sparse as sp
 
-from typing import Any, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-from langchain_openai import OpenAIEmbeddings
 from llm_foundation import logger
-from hackathon.utils import Neo4jClientFactory
+from hackathon.canonicalization import canonicalization_enabled, load_entity_aliases
+from hackathon.index import embed_texts
+from hackathon.utils import Neo4jClientFactory, document_artifact_path, load_entity_ref_count_matrix
+from hackathon.vector_mirror import EntityVectorMirror, get_entity_vector_mirror
+
+
+def load_retrieval_artifacts(document_name: str, canonical: Optional[bool] = None) -> Tuple[Dict[str, int], sp.csr_matrix, Dict[str, str]]:
+    """Loads the entity dict, the entity per chunk count matrix and the entity aliases of a document.
+
+    With canonicalization (CANONICALIZE_ENTITIES, see graph_creation_step_3) the graph only has the canonical
+    entities, so the canonical dict and matrix are loaded (their uids are the node ids of the graph) along with
+    the aliases of the entities. Otherwise, the original dict and matrix are loaded and there are no aliases.
+
+    Args:
+        document_name (str): the document the artifacts were derived from.
+        canonical (Optional[bool], optional): load the canonical artifacts. Defaults to CANONICALIZE_ENTITIES.
+
+    Returns:
+        Tuple[Dict[str, int], sp.csr_matrix, Dict[str, str]]: entity -> uid, the (n_entities x n_chunks) ref count
+        matrix and entity -> canonical entity.
+    """
+    canonical = canonicalization_enabled() if canonical is None else canonical
+    prefix = "canonical_" if canonical else ""
+    with open(document_artifact_path(document_name, f"{prefix}entity2uid_dict.pkl"), "rb") as f:
+        entity2uid = pickle.load(f)
+    entities_ref_count_matrix = load_entity_ref_count_matrix(document_artifact_path(document_name, f"{prefix}entity_per_chunk_count_matrix.npz"))
+    aliases = load_entity_aliases(document_artifact_path(document_name, "entity_aliases.json")) if canonical else {}
+    return entity2uid, entities_ref_count_matrix, aliases
 
 
 def pagerank(neo4j_conn: Neo4jClientFactory, nodes: List[Any], entities_ref_count_matrix):
@@ -43,7 +72,8 @@ def pagerank(neo4j_conn: Neo4jClientFactory, nodes: List[Any], entities_ref_coun
                 personalization[idx] += personalization_value 
 
                 # calculate node specificity len(node_passages) ** -1
-                node_sum = np.sum(entities_ref_count_matrix[node["id"]])
+                # The matrix is sparse with integer counts (see create_matrix_entity_ref_count)
+                node_sum = float(entities_ref_count_matrix[node["id"]].sum())
                 if node_sum == 0:
                     logger.warning(f"Node sum for node {node['id']} is zero", node)
                 else:
@@ -56,66 +86,100 @@ def pagerank(neo4j_conn: Neo4jClientFactory, nodes: List[Any], entities_ref_coun
     return pagerank_scores
 
 
-def search_similar_entities(neo4j_conn: Neo4jClientFactory, query_entity: str,
-                            emb_model: str = "text-embedding-3-small",
-                            emb_dim: int = 256,
-                            min_score: float=0.8):
-    
-    # Embed the query entity
-    openai_embeddings = OpenAIEmbeddings(model=emb_model, dimensions=emb_dim)
-    query_entity_embedding = openai_embeddings.embed_query(query_entity)
-    
-    results = []
+def link_query_entities(neo4j_conn: Neo4jClientFactory, query_entities: List[str],
+                        emb_model: str = "text-embedding-3-small",
+                        emb_dim: int = 256,
+                        min_score: float = 0.8,
+                        k: int = 3,
+                        mirror: Optional[EntityVectorMirror] = None,
+                        aliases: Optional[Dict[str, str]] = None) -> Dict[str, List[Dict]]:
+    """Links all the query entities to the graph at once.
+
+    The query entities are embedded in a single call, and then resolved in a single read transaction:
+    one vector search for all of them (UNWIND over db.index.vector.queryNodes, or the in-process mirror
+    if available, see vector_mirror) and one SIMILAR_TO expansion of all the linked nodes.
+
+    With the entity aliases of a canonicalized graph (see load_retrieval_artifacts), each query entity
+    is linked through its canonical entity, as the aliases are not in the graph.
+
+    Returns:
+        Dict[str, List[Dict]]: per query entity, the nodes similar to it (with min_score) followed by
+        the SIMILAR_TO neighbors of those nodes.
+    """
+    query_entities = list(dict.fromkeys(query_entities))  # Dedup, keeping the order
+    if not query_entities:
+        return {}
+
+    linked_entities = [aliases.get(entity.lower(), entity) for entity in query_entities] if aliases else query_entities
+
+    # Embed the query entities (cached, see index.embed_texts)
+    query_embeddings = embed_texts(linked_entities, emb_model, emb_dim)
+    # With the in-process mirror of entityIdx (see vector_mirror), Neo4j is only used for the graph expansion
+    if mirror is None:
+        mirror = get_entity_vector_mirror(neo4j_conn, emb_dim)
+
+    def link(tx) -> Dict[str, List[Dict]]:
+        if mirror is not None:
+            vector_results = [{**node, "i": i} for i, embedding in enumerate(query_embeddings) for node in mirror.search(embedding, k=k)]
+        else:
+            # Search for the root nodes of entities similar to the query entities using the embeddings
+            vector_results = tx.run("""
+                UNWIND range(0, size($embeddings) - 1) AS i
+                CALL db.index.vector.queryNodes('entityIdx', $k, $embeddings[i]) YIELD node, score
+                RETURN i, node.node_id as id, node.name as name, coalesce(node.last_name, null) AS last_name, score
+                """, embeddings=[list(map(float, embedding)) for embedding in query_embeddings], k=k).data()
+
+        # Filter the results by the minimum score
+        results = {query_entity: [] for query_entity in query_entities}
+        for result in vector_results:
+            if result["score"] >= min_score:
+                results[query_entities[result.pop("i")]].append(result)
+
+        # Expand the similar results navigating the entity nodes retrieved above, using the SIMILAR_TO entities
+        linked = [{"i": i, "names": [result["name"] for result in results[query_entity]]}
+                  for i, query_entity in enumerate(query_entities) if results[query_entity]]
+        if linked:  # Nothing to expand otherwise
+            similar_results = tx.run("""
+                UNWIND $linked AS l
+                MATCH (a:Entity)-[:SIMILAR_TO]->(b:Entity)
+                WHERE a.name IN l.names
+                RETURN l.i AS i, b.node_id AS id, b.name AS name
+                """, linked=linked).data()
+            for result in similar_results:
+                results[query_entities[result.pop("i")]].append(result)
+        return results
+
     with neo4j_conn.neo4j_client() as driver:
         with driver.session() as session:
-            
-            def search_vector(tx, query_embedding):
-                cypher_query = f"""
-                CALL db.index.vector.queryNodes('entityIdx', 3, {query_embedding}) YIELD node, score
-                RETURN node.node_id as id, node.name as name, coalesce(node.last_name, null) AS last_name, score
-                """
-                return tx.run(cypher_query).data()
-            # Search for the root nodes of entities similar to the query entity using the embeddings
-            graph_results = session.execute_read(lambda tx: search_vector(tx, query_entity_embedding))
-            
-            # Filter the results by the minimum score
-            for result in graph_results:
-                if result["score"] >= min_score:
-                    results.append(result)
-
-            def similar_search(tx, similar_entities):
-                
-                cypher_query = f"""
-                MATCH (a:Entity)-[:SIMILAR_TO]->(b:Entity)
-                WHERE a.name IN $similar_entities
-                RETURN b.node_id AS id, b.name AS name
-                """
-                return tx.run(cypher_query, similar_entities=similar_entities).data()
+            return session.execute_read(link)
 
-            # Expand the similar results navigating the entity nodes retrieved above, 
-            # using the SIMILAR_TO entities
-            similar_entities = [ result["name"] for result in results]
-            graph_results = session.execute_read(lambda tx: similar_search(tx, similar_entities))
-            results.extend(graph_results)
 
-    return results
+def search_similar_entities(neo4j_conn: Neo4jClientFactory, query_entity: str,
+                            emb_model: str = "text-embedding-3-small",
+                            emb_dim: int = 256,
+                            min_score: float=0.8,
+                            mirror: Optional[EntityVectorMirror] = None,
+                            aliases: Optional[Dict[str, str]] = None):
+    """Nodes similar to a query entity (see link_query_entities)."""
+    return link_query_entities(neo4j_conn, [query_entity], emb_model, emb_dim, min_score, mirror=mirror, aliases=aliases)[query_entity]
 
 
-def retrieve_similar_entities(neo4j_conn: Neo4jClientFactory, entities, emb_dim: int = 256):        
+def retrieve_similar_entities(neo4j_conn: Neo4jClientFactory, entities, emb_dim: int = 256, aliases: Optional[Dict[str, str]] = None):
     '''For every entity in the list of entitities, find the nodes in the graph DB 
     similar to those named entities'''
     similar_nodes = []
     if len(entities) == 0:
         logger.info("No named entities found in the query")
     else:
-        for entity in entities:
-            results = search_similar_entities(neo4j_conn, entity, emb_dim=emb_dim)
+        # All the entities are linked at once: one embedding call and one Neo4j transaction
+        for results in link_query_entities(neo4j_conn, entities, emb_dim=emb_dim, aliases=aliases).values():
             similar_nodes.extend(results)
     return similar_nodes
 
 
 def chunk_ranker(entity2chunkrefs_count_matrix, pg_rank_scores) -> Tuple:
-    chunk_scores = np.dot(entity2chunkrefs_count_matrix.T, np.array(pg_rank_scores))
+    # Works for both the sparse and the (legacy) dense matrices. Scores are always float64
+    chunk_scores = np.asarray(entity2chunkrefs_count_matrix.T @ np.array(pg_rank_scores, dtype=np.float64)).ravel()
     logger.warning(f"Chunk Scores:\n{chunk_scores}")
     logger.warning(f"Chunk Indexes:\n{np.argsort(chunk_scores)[::-1]}")
     return chunk_scores, np.argsort(chunk_scores)[::-1]
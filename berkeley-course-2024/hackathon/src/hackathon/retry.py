@@ -0,0 +1,76 @@
+###################################################################################################
+# Retries with exponential backoff
+#
+# Shared by the Neo4j bulk writes, the LLM extractions and the embedding requests. The wait before
+# each retry doubles from initial_backoff up to max_backoff, with jitter so that concurrent callers
+# failing at the same time (e.g. on a rate limit or a deadlock) don't retry in bursts.
+###################################################################################################
+
+import asyncio
+import random
+import time
+
+from typing import Awaitable, Callable, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+# Called with the failed attempt (0 for the first one), its error and the seconds until the next attempt
+RetryCallback = Callable[[int, Exception, float], None]
+
+
+class RetryConfig(BaseModel):
+    max_retries: int = 3  # Retries after the first attempt fails
+    initial_backoff: float = 1.0  # Seconds to wait before the first retry. Doubles on each retry
+    max_backoff: float = 30.0
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait after a failed attempt (0 for the first one), jittered up to twice the backoff."""
+        return min(self.initial_backoff * 2 ** attempt, self.max_backoff) * (1 + random.random())
+
+
+def retry_call(fn: Callable[[], T],
+               config: Optional[RetryConfig] = None,
+               retry_on: Tuple[Type[Exception], ...] = (Exception,),
+               on_retry: Optional[RetryCallback] = None) -> T:
+    """Calls fn until it succeeds, retrying the errors in retry_on up to config.max_retries times.
+
+    Args:
+        fn (Callable[[], T]): the call to retry.
+        config (Optional[RetryConfig], optional): retries and backoff. Defaults to RetryConfig().
+        retry_on (Tuple[Type[Exception], ...], optional): errors worth retrying. Others are raised. Defaults to (Exception,).
+        on_retry (Optional[RetryCallback], optional): called before waiting for each retry, e.g. to log it.
+
+    Returns:
+        T: the result of fn. The error of the last attempt is raised if all of them fail.
+    """
+    config = config or RetryConfig()
+    for attempt in range(config.max_retries + 1):
+        try:
+            return fn()
+        except retry_on as e:
+            if attempt == config.max_retries:
+                raise
+            wait = config.backoff(attempt)
+            if on_retry is not None:
+                on_retry(attempt, e, wait)
+            time.sleep(wait)
+
+
+async def retry_async(fn: Callable[[], Awaitable[T]],
+                      config: Optional[RetryConfig] = None,
+                      retry_on: Tuple[Type[Exception], ...] = (Exception,),
+                      on_retry: Optional[RetryCallback] = None) -> T:
+    """Like retry_call, awaiting fn and the backoff, so the event loop keeps running the other tasks."""
+    config = config or RetryConfig()
+    for attempt in range(config.max_retries + 1):
+        try:
+            return await fn()
+        except retry_on as e:
+            if attempt == config.max_retries:
+                raise
+            wait = config.backoff(attempt)
+            if on_retry is not None:
+                on_retry(attempt, e, wait)
+            await asyncio.sleep(wait)
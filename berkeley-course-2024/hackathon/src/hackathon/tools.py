@@ -2,12 +2,12 @@ import hashlib
 import logging
 import os
 import pickle
-import re
 import uuid
 from typing import Dict, List, Optional, Callable, Any
 
 import numpy as np
 import requests
+import scipy.sparse as sp
 from crewai.tools import BaseTool
 from crewai_tools import tool
 from langchain.output_parsers.json import SimpleJsonOutputParser
@@ -18,8 +18,11 @@ from llm_foundation import logger
 from pydantic import BaseModel, Field, PrivateAttr
 from requests import RequestException
 
+from hackathon.cache import LLMResponseCache, get_llm_response_cache
+from hackathon.document_store import ColumnarDocumentStore
+from hackathon.entity_counter import count_entities_in_chunks
 from hackathon.retrieval_neo4j import retrieve_similar_entities
-from hackathon.utils import Neo4jClientFactory
+from hackathon.utils import Neo4jClientFactory, load_document_structure
 
 
 def get_uuid(string: str):
@@ -62,19 +65,24 @@ def save_doc(doc_name: str, chunks: List[Document], with_uuid_name: bool = True)
 
 
 @tool
-def read_file(filename:str):
+def read_file(filename:str, columns: Optional[List[str]] = None):
     """Reads a file from disk.
-    It returns the content of the file.
+    It returns the content of the file. If columns are given (e.g. ["named_entities", "triples"]), only those fields of each chunk are read.
     """
-    logger.info(f"Loading document structure from {filename}")
-    return pickle.load(open(filename, "rb"))
+    document_structure = load_document_structure(filename)
+    if isinstance(document_structure, ColumnarDocumentStore):  # Only the requested columns are decoded
+        return list(document_structure.iter_rows(columns=columns))
+    if columns:
+        return [{column: chunk[column] for column in columns if column in chunk} for chunk in document_structure]
+    return document_structure
 
 
 def filter_named_entities(document_structure_with_entities_and_triples: List[dict]) -> List[dict]:
     for chunk_info in document_structure_with_entities_and_triples:        
-        named_entities = [entity.lower() for entity in chunk_info["named_entities"]]
+        # Chunks whose extraction failed have no named_entities/triples
+        named_entities = [entity.lower() for entity in chunk_info.get("named_entities", [])]
         logger.debug(named_entities)
-        triples = chunk_info["triples"]
+        triples = chunk_info.get("triples", [])
         logger.info(f"Initial Named Entities ({len(named_entities)}): {named_entities}")
         named_entities: set = set(named_entities)
         logger.info(f"Initial Named Entities after dedup ({len(named_entities)}): {named_entities}")
@@ -134,33 +142,53 @@ def create_document_deduped_entities_dict_tool(document_structure_with_entities_
     return create_document_deduped_entities_dict(document_structure_with_entities_and_triples)
 
 
-def create_matrix_entity_ref_count(document_structure_with_entities_and_triples: List[dict], named_entities_dict: dict) -> np.ndarray:    
+def create_matrix_entity_ref_count(document_structure_with_entities_and_triples: List[dict], named_entities_dict: dict,
+                                   max_workers: Optional[int] = None, normalize: bool = True) -> sp.csr_matrix:
+    """Creates the (n_of_entities x n_of_chunks) matrix with the count of references of each entity in each chunk.
+    The matrix is sparse (CSR), as most entities appear only in a few chunks, with the smallest unsigned
+    integer dtype that fits the counts.
+
+    With normalize, multiple spaces and new lines are removed from the chunk texts before counting. Otherwise
+    the counts are chunk_text.lower().count(entity), as in the step 2 script.
+    """
     n_of_entities = len(named_entities_dict)
     n_of_chunks = len(document_structure_with_entities_and_triples)
     
     document_chunks = document_structure_with_entities_and_triples
-    entity_per_chunk_count_matrix = np.zeros((n_of_entities, n_of_chunks))
+    # All the entities are counted in each chunk (prepared once, see normalize) in a single scan with an
+    # Aho-Corasick automaton. See hackathon.entity_counter
+    entities = list({named_entity.lower(): None for chunk_info in document_chunks for named_entity in chunk_info["named_entities"]})
+    entity_idxs = {entity: idx for idx, entity in enumerate(entities)}
+    chunk_counts = count_entities_in_chunks([chunk_info["text"] for chunk_info in document_chunks], entities, max_workers=max_workers,
+                                           normalize=normalize)
+
+    rows, cols, data = [], [], []
     for chunk_idx, chunk_info in enumerate(document_chunks):
-        named_entities = chunk_info["named_entities"]
-        for named_entity in named_entities:
-            # Remove multiple spaces and new lines
-            text = re.sub(' +', ' ', chunk_info["text"].lower())
-            text = re.sub('\n+', ' ', text)
+        counts = chunk_counts[chunk_idx]
+        chunk_entity_counts = {}
+        for named_entity in chunk_info["named_entities"]:
             named_entity_hash = named_entities_dict[named_entity.lower()]
             # Count of named_entity appearing in the document chunk
-            entity_per_chunk_count_matrix[named_entity_hash][chunk_idx] = text.count(named_entity.lower())
-    return entity_per_chunk_count_matrix
+            chunk_entity_counts[named_entity_hash] = counts.get(entity_idxs[named_entity.lower()], 0)
+        for named_entity_hash, count in chunk_entity_counts.items():
+            if count > 0:
+                rows.append(named_entity_hash)
+                cols.append(chunk_idx)
+                data.append(count)
+
+    dtype = np.min_scalar_type(max(data, default=0))
+    return sp.csr_matrix((np.array(data, dtype=dtype), (rows, cols)), shape=(n_of_entities, n_of_chunks), dtype=dtype)
 
 
 @tool
-def create_matrix_entity_ref_count_tool(document_structure_with_entities_and_triples: List[dict], named_entities_dict: dict) -> np.ndarray:
+def create_matrix_entity_ref_count_tool(document_structure_with_entities_and_triples: List[dict], named_entities_dict: dict) -> sp.csr_matrix:
     """Create a matrix of entity reference count per document chunk.
     
     """
     return create_matrix_entity_ref_count(document_structure_with_entities_and_triples, named_entities_dict)
 
 
-def extract_entities_from_query(llm_model, user_query):
+def extract_entities_from_query(llm_model, user_query, cache: Optional[LLMResponseCache] = None):
     # This prompt is a simpler version o the original, it works better for small paragraphs and less entities and
     # in other languages like portuguese
     extract_entities_custom_prompt = ChatPromptTemplate.from_messages(
@@ -176,7 +204,12 @@ def extract_entities_from_query(llm_model, user_query):
     json_output_parser = SimpleJsonOutputParser()
     chain_query_entities = extract_entities_custom_prompt | ChatOpenAI(model=llm_model, temperature=0.0) | json_output_parser
     #chain_query_entities = extract_entities_prompt | ChatOpenAI(model=llm_model, temperature=0.0) | json_output_parser
-    query_entities = chain_query_entities.invoke({"passage_text": user_query})
+    cache = cache or get_llm_response_cache()
+    if cache is None:
+        query_entities = chain_query_entities.invoke({"passage_text": user_query})
+    else:
+        query_entities = cache.cached_call(llm_model, extract_entities_custom_prompt.pretty_repr(), "query_entity_extractor", user_query,
+                                           lambda: chain_query_entities.invoke({"passage_text": user_query}))
     query_entities["named_entities"] = query_entities["entities"] # change the name to named_entities
 
     return query_entities
@@ -33,8 +33,7 @@ def graph_page(input, output, session, sidebar_text):
         
         @render.ui()
         def graph():
-            neo4j_factory = Neo4jClientFactory()
-            graph_driver = neo4j_factory.neo4j_client()
+            graph_driver = Neo4jClientFactory().neo4j_client()  # Shared pooled driver, see Neo4jClientFactory
             
             query_graph = graph_driver.execute_query("MATCH (n) OPTIONAL MATCH (n)-[r]->() RETURN n, r LIMIT 100",
                                                 name="Neurogen Graph",
@@ -2,6 +2,8 @@ import os
 from shiny.express import input, ui, app_opts
 from .chat_page import chat_page
 from .graph_page import graph_page
+from hackathon.utils import Neo4jClientFactory
+from hackathon.vector_mirror import entity_vector_mirror_enabled, get_entity_vector_mirror
 from langtrace_python_sdk import langtrace  # Must precede any llm module imports
 
 from llm_foundation import logger
@@ -24,6 +26,19 @@ if bool(os.environ.get("OBSERVE_AGENTS")):
 
 logger.info("Starting main app...")
 
+# Open the shared Neo4j connection pool at startup instead of on the first query
+try:
+    Neo4jClientFactory().warm_up()
+except Exception as e:
+    logger.error(f"Error connecting to Neo4j: {e}")
+
+# Load the in-process entity vector index at startup instead of on the first chat query (it's reloaded when the graph changes)
+if entity_vector_mirror_enabled():
+    try:
+        get_entity_vector_mirror()
+    except Exception as e:
+        logger.error(f"Error loading the entity vector mirror: {e}")
+
 # Configure Shiny page
 app_opts(static_assets=WWW)
 ui.page_opts(
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 import uuid
 
 import numpy as np
@@ -9,10 +9,12 @@ from crewai.crews import CrewOutput
 from crewai_tools import tool
 from pydantic import BaseModel
 from rich.pretty import pprint
+from hackathon.bulk_writer import BulkWriter
 from hackathon.graph_graphiti import GraphitiSearchTool
 from hackathon.index import generate_embeddings
 from hackathon.tools import graphdb_retrieval_tool
 from hackathon.utils import Neo4jClientFactory
+from hackathon.vector_mirror import bump_entities_version, mirror_upsert_callback
 from llm_foundation.agent_types import Persona, Role
 from llm_foundation import logger
 
@@ -166,22 +168,25 @@ class UserCreationCrew():
 
 #### User Database ####
 
-def add_users(neo4j_factory: Neo4jClientFactory, embeddings: np.ndarray, users: List[User]):
-    kg = neo4j_factory.langchain_client()
+def add_users(neo4j_factory: Neo4jClientFactory, embeddings: np.ndarray, users: List[User], bulk_writer: Optional[BulkWriter] = None):
+    bulk_writer = bulk_writer or BulkWriter(neo4j_factory)
     
     all_users = []
     for user, emb in zip(users, embeddings):
         uuid_text = f"{user.name} {user.last_name}"
         generated_uuid = str(uuid.uuid5(uuid.NAMESPACE_DNS, uuid_text))
-        all_users.append({"uid": generated_uuid, "type": "user", "name": user.name, "last_name": user.last_name, "embedding": emb})
+        all_users.append({"uid": generated_uuid, "type": "user", "name": user.name, "last_name": user.last_name, "embedding": np.asarray(emb).tolist()})
 
     print(f"Number of users to add: {len(all_users)}")
 
     query = """
-    UNWIND $all_users AS au
-    MERGE (a:Entity {node_id: au.uid, type: au.type, name: au.name, last_name: au.last_name, embedding: au.embedding})
+    UNWIND $rows AS au
+    MERGE (a:Entity {node_id: au.uid})
+    SET a.type = au.type, a.name = au.name, a.last_name = au.last_name, a.embedding = au.embedding
     """
-    kg.query(query, {"all_users": all_users})
+    upsert_users_in_mirror = mirror_upsert_callback(lambda user: {"id": user["uid"], "name": user["name"], "last_name": user["last_name"]})
+    bulk_writer.write(query, all_users, name="User nodes", on_batch=upsert_users_in_mirror)
+    bump_entities_version(neo4j_factory)
 
 
 ###################################################################################################
@@ -1,8 +1,15 @@
+import asyncio
+import atexit
+import hashlib
 import json
 import os
 import pickle
+import threading
 
-from typing import Dict, List, Literal
+from typing import Dict, Iterable, Iterator, List, Literal, Optional, Union
+
+import numpy as np
+import scipy.sparse as sp
 
 from graphiti_core import Graphiti
 from llm_foundation import logger
@@ -10,10 +17,52 @@ from langchain_community.document_loaders import PyPDFLoader
 from langchain_community.graphs import Neo4jGraph
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from neo4j import GraphDatabase
+from neo4j import AsyncDriver, AsyncGraphDatabase, Driver, GraphDatabase
 from pydantic import BaseModel
 
 from llm_foundation import logger
+from hackathon.document_store import ColumnarDocumentStore, is_columnar_document_store
+
+
+###################################################################################################
+# Neo4j clients
+#
+# Drivers are expensive (TCP/TLS handshakes, routing table) and thread safe, and Neo4jGraph also
+# introspects the schema when created, so the factory hands out process-wide clients: one pooled
+# driver (and async driver, and Neo4jGraph) per connection config, created on first use and closed
+# at exit.
+###################################################################################################
+
+_clients_lock = threading.Lock()
+_drivers: Dict[tuple, Driver] = {}
+_async_drivers: Dict[tuple, AsyncDriver] = {}
+_langchain_clients: Dict[tuple, Neo4jGraph] = {}
+
+
+class SharedDriver:
+    """A shared driver that isn't closed by close() or by exiting a with block, so existing code like
+    `with factory.neo4j_client() as driver:` keeps working without closing the pool for everyone else."""
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def close(self):
+        pass  # Closed at exit, see close_all_clients
 
 
 class Neo4jClientFactory(BaseModel):
@@ -22,17 +71,80 @@ class Neo4jClientFactory(BaseModel):
     username: str = os.getenv("NEO4J_USERNAME", "neo4j")
     password: str = os.getenv("NEO4J_PASSWORD")
     database: str = os.getenv("NEO4J_DB", "neo4j")
-    
+    max_connection_pool_size: int = int(os.getenv("NEO4J_MAX_POOL_SIZE", "100"))
+    connection_acquisition_timeout: float = float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", "60"))  # Seconds waiting for a free connection
+    liveness_check_timeout: Optional[float] = float(os.getenv("NEO4J_LIVENESS_CHECK_TIMEOUT", "30"))  # Idle seconds before a connection is checked
+    max_connection_lifetime: float = float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", "3600"))
+
+    def _key(self) -> tuple:
+        return (self.uri, self.username, self.password, self.database, self.max_connection_pool_size,
+                self.connection_acquisition_timeout, self.liveness_check_timeout, self.max_connection_lifetime)
+
+    def driver_config(self) -> Dict:
+        return {
+            "max_connection_pool_size": self.max_connection_pool_size,
+            "connection_acquisition_timeout": self.connection_acquisition_timeout,
+            "liveness_check_timeout": self.liveness_check_timeout,
+            "max_connection_lifetime": self.max_connection_lifetime,
+        }
+
     def langchain_client(self):
-        return Neo4jGraph(url=self.uri, username=self.username, password=self.password, database=self.database)
-    
+        key = self._key()
+        if key not in _langchain_clients:
+            with _clients_lock:
+                if key not in _langchain_clients:
+                    _langchain_clients[key] = Neo4jGraph(url=self.uri, username=self.username, password=self.password,
+                                                         database=self.database, driver_config=self.driver_config())
+        return _langchain_clients[key]
+
     def neo4j_client(self):
-        return GraphDatabase.driver(self.uri, auth=(self.username, self.password))
+        key = self._key()
+        if key not in _drivers:
+            with _clients_lock:
+                if key not in _drivers:
+                    _drivers[key] = GraphDatabase.driver(self.uri, auth=(self.username, self.password), **self.driver_config())
+        return SharedDriver(_drivers[key])
+
+    def async_neo4j_client(self):
+        """Shared async driver, with the same pool config as the sync one. Its connections are bound to the
+        event loop they are opened in, so it must be used from a single, long-lived loop (e.g. the app's)."""
+        key = self._key()
+        if key not in _async_drivers:
+            with _clients_lock:
+                if key not in _async_drivers:
+                    _async_drivers[key] = AsyncGraphDatabase.driver(self.uri, auth=(self.username, self.password), **self.driver_config())
+        return SharedDriver(_async_drivers[key])
+
+    def warm_up(self):
+        """Creates the shared clients and opens a connection, so the first query doesn't pay for it (e.g. at app startup)."""
+        self.neo4j_client().verify_connectivity()
+        self.langchain_client()
+        logger.info(f"Neo4j clients ready for {self.uri} (pool size {self.max_connection_pool_size})")
     
     def graphiti_client(self):
         return Graphiti(self.uri, self.username, self.password)
 
 
+def close_all_clients():
+    """Closes the shared Neo4j drivers (registered to run at exit)."""
+    with _clients_lock:
+        for driver in _drivers.values():
+            driver.close()
+        for graph in _langchain_clients.values():
+            graph._driver.close()
+        for async_driver in _async_drivers.values():
+            try:  # The loop of its connections may be gone by now, so they can only be dropped
+                asyncio.run(async_driver.close())
+            except Exception as e:
+                logger.warning(f"Error closing the async Neo4j driver: {e}")
+        _drivers.clear()
+        _langchain_clients.clear()
+        _async_drivers.clear()
+
+
+atexit.register(close_all_clients)
+
+
 def load_pdf(file_path:str = "2405.14831v1.pdf"): 
 
     doc_loader = PyPDFLoader(file_path)
@@ -40,6 +152,13 @@ def load_pdf(file_path:str = "2405.14831v1.pdf"):
     return "\n".join([p.page_content for p in pages])
 
 
+def load_pdf_pages(file_path: str = "2405.14831v1.pdf") -> Iterator[str]:
+    """Lazily yields the text of each page of a PDF, one page at a time."""
+    doc_loader = PyPDFLoader(file_path)
+    for page in doc_loader.lazy_load():
+        yield page.page_content
+
+
 def split_text(text: str, chunk_size: int=1000, char_overlap: int=0) -> List[Document]:
 
     text_splitter = RecursiveCharacterTextSplitter(
@@ -52,21 +171,122 @@ def split_text(text: str, chunk_size: int=1000, char_overlap: int=0) -> List[Doc
     return text_splitter.create_documents([text])
 
 
-def build_document_structure(document_path: str, chunk_size=1000, char_overlap=0, chunk_limit: int = -1) -> List[Dict]:
-    text = load_pdf(document_path)
-    chunks = split_text(text, chunk_size=chunk_size, char_overlap=0)
-    document_chunks: List[Dict] = [ { "id":idx, "text":chunk.page_content } for idx, chunk in enumerate(chunks)]
+def file_digest(file_path: str, block_size: int = 1 << 20) -> str:
+    """Returns the SHA-256 hex digest of the bytes of a file, reading it by blocks."""
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def chunk_digest(chunk_size: int, char_overlap: int, text: str) -> str:
+    """Content address of a chunk: a digest of the chunking params and the chunk text. The same chunk text
+    chunked the same way always gets the same digest, so the unchanged chunks of an edited document keep theirs."""
+    chunk_hash = hashlib.sha256(f"{chunk_size}:{char_overlap}:".encode())
+    chunk_hash.update(text.encode())
+    return chunk_hash.hexdigest()
+
+
+def iter_document_structure(document_path: str, chunk_size=1000, char_overlap=0, chunk_limit: int = -1) -> Iterator[Dict]:
+    """Streams the document chunks of a PDF, reading and splitting it page by page.
+
+    The text of each new page is appended to the tail left over from the previous pages, split, and all
+    the resulting chunks but the last one (which may still grow with the next page) are yielded. This way,
+    only a few pages are kept in memory at a time, regardless of the size of the document.
+
+    Args:
+        document_path (str): path to the PDF document.
+        chunk_size (int, optional): max number of chars per chunk. Defaults to 1000.
+        char_overlap (int, optional): number of chars overlapping between chunks. Defaults to 0.
+        chunk_limit (int, optional): if > 0, stop after yielding this number of chunks. Defaults to -1.
+
+    Yields:
+        Dict: the document chunks as { "id": idx, "text": chunk_text, "digest": chunk_digest }, with ids
+        increasing from 0.
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=char_overlap,
+        length_function=len,
+        is_separator_regex=False,
+    )
+
+    next_idx = 0
+    tail = ""
+    for page_text in load_pdf_pages(document_path):
+        tail = f"{tail}\n{page_text}" if tail else page_text
+        chunks = text_splitter.split_text(tail)
+        if not chunks:
+            continue
+        tail = chunks.pop()  # The last chunk may continue in the next page
+        for chunk in chunks:
+            yield { "id": next_idx, "text": chunk, "digest": chunk_digest(chunk_size, char_overlap, chunk) }
+            next_idx += 1
+            if 0 < chunk_limit <= next_idx:
+                logger.warning(f"Capping the Document to only {chunk_limit} chunks!!!")
+                return
+    if tail:
+        yield { "id": next_idx, "text": tail, "digest": chunk_digest(chunk_size, char_overlap, tail) }
+        next_idx += 1
+    logger.info(f"Number of chunks streamed: {next_idx}")
+
+
+def build_document_structure(document_path: str, chunk_size=1000, char_overlap=0, chunk_limit: int = -1,
+                             streaming: bool = False) -> Union[List[Dict], Iterator[Dict]]:
+    """The document chunks of a PDF (see iter_document_structure). Both modes chunk the document the same
+    way, so their chunks (and digests) match and extractions are reused across them.
+
+    With streaming, returns a generator of chunk dicts (page-at-a-time ingestion) instead of a list."""
+    document_chunks = iter_document_structure(document_path, chunk_size=chunk_size, char_overlap=char_overlap, chunk_limit=chunk_limit)
+    if streaming:
+        return document_chunks
+
+    document_chunks = list(document_chunks)
     # assert len(document_chunks) == 1, f"Number of chunks mismatch: {len(document_chunks)} is not 1"  # TODO Remove this assert!!!! Just for testing
     logger.info("--------------------------------------------------------------------------------")
-    logger.info(f"Number of chunks: {len(chunks)}")
+    logger.info(f"Number of chunks: {len(document_chunks)}")
     logger.info("--------------------------------------------------------------------------------")
-    if chunk_limit > 0:  # Limit the number of chunks!!!!
-        logger.warning(f"Capping the Document to only {chunk_limit} chunks!!!")
-        return document_chunks[:chunk_limit]
     return document_chunks
 
 
-def save_document_structure(document_chunks: List[dict], output_file: str, format: Literal["pickle", "json"] = "pickle"):
+DOCUMENT_STRUCTURE_SUFFIXES = {"pickle": "document_structure.pkl", "columnar": "document_structure"}
+
+
+def document_structure_format() -> Literal["pickle", "columnar"]:
+    """Format of the document structure artifacts of the pipeline steps, set with the DOCUMENT_STRUCTURE_FORMAT
+    env variable: columnar (see hackathon.document_store) by default, or pickle."""
+    format = os.getenv("DOCUMENT_STRUCTURE_FORMAT", "columnar")
+    if format not in DOCUMENT_STRUCTURE_SUFFIXES:
+        raise ValueError(f"Invalid DOCUMENT_STRUCTURE_FORMAT: {format}")
+    return format
+
+
+def document_structure_path(document_path: str, format: Optional[Literal["pickle", "columnar"]] = None, **kwargs) -> str:
+    """Path of the document structure artifact of a document (see document_artifact_path, which gets the kwargs).
+    The format defaults to document_structure_format()."""
+    return document_artifact_path(document_path, DOCUMENT_STRUCTURE_SUFFIXES[format or document_structure_format()], **kwargs)
+
+
+def document_artifact_path(document_path: str, suffix: str, output_dir: Optional[str] = None, source_root: Optional[str] = None) -> str:
+    """Returns the path of an artifact derived from a document, e.g. 2405.14831v1_document_structure.pkl
+    for 2405.14831v1.pdf and the document_structure.pkl suffix. By default, next to the document.
+
+    With an output_dir, the artifact goes there. If source_root is given too, the path of the document relative
+    to it is kept under output_dir, so documents with the same name in different directories don't collide."""
+    base_name = document_path.rsplit(".", 1)[0]
+    if output_dir is not None:
+        if source_root is not None:
+            base_name = os.path.join(output_dir, os.path.relpath(os.path.abspath(base_name), os.path.abspath(source_root)))
+        else:
+            base_name = os.path.join(output_dir, os.path.basename(base_name))
+    return f"{base_name}_{suffix}"
+
+
+def save_document_structure(document_chunks: Iterable[dict],
+                            output_file: str,
+                            format: Literal["pickle", "json", "columnar"] = "pickle",
+                            compression: Optional[Literal["zlib"]] = None):
     logger.info(f"Saving document structure to {output_file}")
     match format:
         case "pickle":
@@ -75,5 +295,79 @@ def save_document_structure(document_chunks: List[dict], output_file: str, forma
         case "json":
             with open(output_file, "w") as f:
                 json.dump(document_chunks, f, indent=4)
+        case "columnar":
+            # output_file is a directory in this format. See hackathon.document_store
+            ColumnarDocumentStore.write(document_chunks, output_file, compression=compression)
         case _:
             raise ValueError(f"Invalid format: {format}")
+
+
+def load_document_structure(input_file: str) -> Union[List[dict], ColumnarDocumentStore]:
+    """Loads a document structure saved with save_document_structure. Columnar stores are opened lazily
+    (memory-mapped) instead of being read in full; use to_list() on them to get a mutable list of chunks."""
+    logger.info(f"Loading document structure from {input_file}")
+    if is_columnar_document_store(input_file):
+        return ColumnarDocumentStore(input_file)
+    if input_file.endswith(".json"):
+        with open(input_file, "r") as f:
+            return json.load(f)
+    with open(input_file, "rb") as f:
+        return pickle.load(f)
+
+
+def extracted_chunks_by_digest(previous_chunks: Iterable[dict]) -> Dict[str, dict]:
+    """The chunks of a previous run that were extracted (with named_entities and triples), by content digest."""
+    if isinstance(previous_chunks, ColumnarDocumentStore):  # Don't page in the text of the previous chunks
+        previous_chunks = previous_chunks.iter_rows(columns=["digest", "named_entities", "triples"])
+    return {
+        chunk["digest"]: chunk for chunk in previous_chunks
+        if "digest" in chunk and "named_entities" in chunk and "triples" in chunk
+    }
+
+
+def reuse_extracted_chunk(chunk: dict, extracted_chunks: Dict[str, dict]) -> bool:
+    """Copies to the chunk (in place) the entities and triples extracted for its digest (see extracted_chunks_by_digest).
+
+    Returns:
+        bool: whether they were reused, i.e. the chunk doesn't need extraction.
+    """
+    previous_chunk = extracted_chunks.get(chunk.get("digest"))
+    if previous_chunk is None:
+        return False
+    chunk["named_entities"] = previous_chunk["named_entities"]
+    chunk["triples"] = previous_chunk["triples"]
+    return True
+
+
+def reuse_extracted_chunks(document_chunks: List[dict], previous_chunks: Iterable[dict]) -> List[dict]:
+    """Copies the entities and triples already extracted for a chunk in a previous run to the chunks
+    with the same content digest.
+
+    Args:
+        document_chunks (List[dict]): the (new) document chunks, updated in place.
+        previous_chunks (List[dict]): the document chunks of a previous run, e.g. loaded from the artifact.
+
+    Returns:
+        List[dict]: the document chunks that are new or changed and still need extraction.
+    """
+    extracted = extracted_chunks_by_digest(previous_chunks)
+    pending_chunks = [chunk for chunk in document_chunks if not reuse_extracted_chunk(chunk, extracted)]
+    logger.info(f"Reused extractions for {len(document_chunks) - len(pending_chunks)} chunks. {len(pending_chunks)} chunks pending")
+    return pending_chunks
+
+
+def save_entity_ref_count_matrix(matrix: sp.spmatrix, output_file: str):
+    """Saves the entity per chunk count matrix in the scipy sparse format (.npz)."""
+    logger.info(f"Saving entity per chunk count matrix {matrix.shape} with {matrix.nnz} refs to {output_file}")
+    sp.save_npz(output_file, sp.csr_matrix(matrix))
+
+
+def load_entity_ref_count_matrix(input_file: str) -> sp.csr_matrix:
+    """Loads the entity per chunk count matrix as a sparse CSR matrix. Legacy pickled dense matrices
+    (*_entity_per_chunk_count_matrix.pkl) are converted."""
+    logger.info(f"Loading entity per chunk count matrix from {input_file}")
+    if input_file.endswith(".npz"):
+        return sp.load_npz(input_file).tocsr()
+    with open(input_file, "rb") as f:
+        dense_matrix = np.asarray(pickle.load(f))
+    return sp.csr_matrix(dense_matrix)
@@ -0,0 +1,198 @@
+###################################################################################################
+# In-process mirror of the Neo4j entity vector index (entityIdx)
+###################################################################################################
+
+import os
+import threading
+
+from typing import Any, Callable, Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from llm_foundation import logger
+
+from hackathon.embedding_store import load_embeddings_float32
+from hackathon.utils import Neo4jClientFactory
+
+
+class EntityVectorMirror:
+    """Local copy of the embeddings of the Entity nodes, to link query entities without a Neo4j round trip.
+
+    Vectors are L2 normalized in an exact inner product index, so searches return the same nodes and
+    scores as the cosine entityIdx of Neo4j (score = (1 + cosine) / 2). Nodes are keyed by their node_id
+    (ints for the document entities, uuid strings for the users) and upserted when they are written to
+    Neo4j (see graph_neo4j.add_entities and users.add_users), so the mirror stays in sync with the graph.
+    Writes in other processes are detected with the version of the entities (see entities_version).
+    Safe to share between threads.
+    """
+
+    def __init__(self, emb_dimension: int = 256):
+        self.emb_dimension = emb_dimension
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(emb_dimension))
+        self._lock = threading.RLock()
+        self._faiss_ids: Dict[Any, int] = {}  # node_id -> FAISS id
+        self._nodes: Dict[int, Dict] = {}  # FAISS id -> node (id, name, last_name)
+        self._next_faiss_id = 0
+        self.neo4j_version: Optional[str] = None  # Version of the entities when loaded from Neo4j
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def upsert(self, nodes: List[Dict], embeddings):
+        """Adds or replaces nodes (dicts with id, name and optionally last_name) with their embeddings."""
+        if not nodes:
+            return
+        vectors = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(nodes), self.emb_dimension).copy()
+        faiss.normalize_L2(vectors)
+        with self._lock:
+            replaced_ids = [self._faiss_ids[node["id"]] for node in nodes if node["id"] in self._faiss_ids]
+            if replaced_ids:
+                self.index.remove_ids(np.asarray(replaced_ids, dtype=np.int64))
+            faiss_ids = np.arange(self._next_faiss_id, self._next_faiss_id + len(nodes), dtype=np.int64)
+            self._next_faiss_id += len(nodes)
+            for faiss_id, node in zip(faiss_ids.tolist(), nodes):
+                self._nodes.pop(self._faiss_ids.get(node["id"]), None)
+                self._faiss_ids[node["id"]] = faiss_id
+                self._nodes[faiss_id] = {"id": node["id"], "name": node["name"], "last_name": node.get("last_name")}
+            self.index.add_with_ids(vectors, faiss_ids)
+
+    def renumber(self, node_ids: Dict[Any, Any]):
+        """Changes the node_id of nodes (old node_id -> new node_id), keeping their embeddings."""
+        with self._lock:
+            faiss_ids = {new_node_id: self._faiss_ids.pop(old_node_id) for old_node_id, new_node_id in node_ids.items()
+                         if old_node_id in self._faiss_ids}  # All popped first, as node ids can be swapped
+            for new_node_id, faiss_id in faiss_ids.items():
+                self._faiss_ids[new_node_id] = faiss_id
+                self._nodes[faiss_id]["id"] = new_node_id
+
+    def remove(self, node_ids: List[Any]):
+        with self._lock:
+            faiss_ids = [self._faiss_ids.pop(node_id) for node_id in node_ids if node_id in self._faiss_ids]
+            for faiss_id in faiss_ids:
+                del self._nodes[faiss_id]
+            if faiss_ids:
+                self.index.remove_ids(np.asarray(faiss_ids, dtype=np.int64))
+
+    def search(self, query_embedding, k: int = 3) -> List[Dict]:
+        """Like db.index.vector.queryNodes('entityIdx', k, query_embedding): the k most similar nodes with their score."""
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(1, self.emb_dimension).copy()
+        faiss.normalize_L2(query)
+        with self._lock:
+            similarities, faiss_ids = self.index.search(query, k)
+            return [{**self._nodes[faiss_id], "score": (1 + similarity) / 2}
+                    for similarity, faiss_id in zip(similarities[0].tolist(), faiss_ids[0].tolist()) if faiss_id >= 0]
+
+    @classmethod
+    def from_neo4j(cls, neo4j_factory: Neo4jClientFactory, emb_dimension: int = 256, batch_size: int = 10_000) -> "EntityVectorMirror":
+        """Loads the embeddings of all the Entity nodes, streaming them in batches."""
+        mirror = cls(emb_dimension)
+        mirror.neo4j_version = entities_version(neo4j_factory)  # Before the nodes, so writes while loading make it stale
+        query = """
+        MATCH (n:Entity) WHERE n.embedding IS NOT NULL
+        RETURN n.node_id AS id, n.name AS name, n.last_name AS last_name, n.embedding AS embedding
+        """
+        with neo4j_factory.neo4j_client() as driver:
+            with driver.session() as session:
+                nodes, embeddings = [], []
+                for record in session.run(query):
+                    nodes.append({"id": record["id"], "name": record["name"], "last_name": record["last_name"]})
+                    embeddings.append(record["embedding"])
+                    if len(nodes) == batch_size:
+                        mirror.upsert(nodes, embeddings)
+                        nodes, embeddings = [], []
+                mirror.upsert(nodes, embeddings)
+        logger.info(f"Entity vector mirror loaded from Neo4j with {len(mirror)} nodes")
+        return mirror
+
+    @classmethod
+    def from_artifacts(cls, named_entities_dict: Dict[str, int], embeddings_path: str) -> "EntityVectorMirror":
+        """Loads the entities of a document from the step 3 artifacts (entity dict and embeddings file)."""
+        embeddings, header = load_embeddings_float32(embeddings_path)
+        uid2entity = {uid: entity for entity, uid in named_entities_dict.items()}
+        mirror = cls(header.dimension)
+        mirror.upsert([{"id": node_id, "name": uid2entity[node_id]} for node_id in header.entity_ids], embeddings)
+        logger.info(f"Entity vector mirror loaded from {embeddings_path} with {len(mirror)} nodes")
+        return mirror
+
+
+def entities_version(neo4j_factory: Neo4jClientFactory) -> Optional[str]:
+    """Version of the Entity nodes of the graph, changed by every write to them (see bump_entities_version).
+    None if they were never versioned, e.g. in an empty or just imported database."""
+    result = neo4j_factory.langchain_client().query("MATCH (v:EntityVersion) RETURN v.version AS version LIMIT 1")
+    return result[0]["version"] if result else None
+
+
+def bump_entities_version(neo4j_factory: Neo4jClientFactory):
+    """Changes the version of the Entity nodes after writing them, so the mirrors of other processes reload.
+    The mirror of this process is kept in sync by the writes, so it stays current, unless it was already stale."""
+    result = neo4j_factory.langchain_client().query("""
+        MERGE (v:EntityVersion)
+        WITH v, v.version AS previous
+        SET v.version = randomUUID()
+        RETURN previous, v.version AS version
+        """)
+    mirror = loaded_entity_vector_mirror()
+    if mirror is not None and result and mirror.neo4j_version == result[0]["previous"]:
+        mirror.neo4j_version = result[0]["version"]
+
+
+_entity_vector_mirror: Optional[EntityVectorMirror] = None
+_entity_vector_mirror_from_neo4j = False  # Mirrors set from the artifacts aren't reloaded from Neo4j
+_entity_vector_mirror_lock = threading.Lock()
+
+
+def entity_vector_mirror_enabled() -> bool:
+    return os.getenv("ENTITY_VECTOR_MIRROR", "false").lower() == "true"
+
+
+def get_entity_vector_mirror(neo4j_factory: Optional[Neo4jClientFactory] = None, emb_dimension: int = 256) -> Optional[EntityVectorMirror]:
+    """Process-wide mirror, loaded from Neo4j on the first call if the ENTITY_VECTOR_MIRROR env variable is true.
+    It's reloaded when the entities were written by another process since it was loaded, e.g. by step 3,
+    the graph sync or a bulk import (see entities_version). Returns None if the mirror is disabled."""
+    global _entity_vector_mirror, _entity_vector_mirror_from_neo4j
+    if not entity_vector_mirror_enabled() or (_entity_vector_mirror is not None and not _entity_vector_mirror_from_neo4j):
+        return _entity_vector_mirror
+
+    neo4j_factory = neo4j_factory or Neo4jClientFactory()
+    mirror = _entity_vector_mirror
+    if mirror is None or mirror.neo4j_version != entities_version(neo4j_factory):
+        with _entity_vector_mirror_lock:
+            if _entity_vector_mirror is mirror:  # Not reloaded by another thread meanwhile
+                if mirror is not None:
+                    logger.info("The entities changed in Neo4j, reloading the entity vector mirror")
+                _entity_vector_mirror = EntityVectorMirror.from_neo4j(neo4j_factory, emb_dimension)
+                _entity_vector_mirror_from_neo4j = True
+    return _entity_vector_mirror
+
+
+def set_entity_vector_mirror(mirror: Optional[EntityVectorMirror]):
+    """Sets (or clears with None) the process-wide mirror, e.g. one loaded with EntityVectorMirror.from_artifacts."""
+    global _entity_vector_mirror, _entity_vector_mirror_from_neo4j
+    _entity_vector_mirror = mirror
+    _entity_vector_mirror_from_neo4j = False
+
+
+def loaded_entity_vector_mirror() -> Optional[EntityVectorMirror]:
+    """The process-wide mirror if it's already loaded (writes keep it in sync without loading it)."""
+    return _entity_vector_mirror
+
+
+def mirror_upsert_callback(to_node: Callable[[Dict], Dict]) -> Callable[[List[Dict]], None]:
+    """BulkWriter on_batch callback upserting the written rows in the process-wide mirror if it's loaded, so it
+    stays in sync with the graph. to_node maps a row to its mirror node (id, name and optionally last_name),
+    and the embedding is the one of the row."""
+    def upsert(rows: List[Dict]):
+        mirror = loaded_entity_vector_mirror()
+        if mirror is not None:
+            mirror.upsert([to_node(row) for row in rows], [row["embedding"] for row in rows])
+    return upsert
+
+
+def sync_entity_vector_mirror(removed_node_ids: Optional[List[Any]] = None, renumbered_node_ids: Optional[Dict[Any, Any]] = None):
+    """Removes (node ids) and renumbers (old node id -> new node id) nodes deleted and renumbered in the graph
+    from the process-wide mirror if it's loaded."""
+    mirror = loaded_entity_vector_mirror()
+    if mirror is not None:
+        mirror.remove(removed_node_ids or [])
+        mirror.renumber(renumbered_node_ids or {})
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from collections import Counter
+
+from hackathon.extraction import ExtractionConfig, extract_chunks, extract_chunks_async, fake_extractor
+
+
+def make_chunks(n_chunks: int):
+    return [{"id": idx, "text": f"Chunk {idx} mentions Neo4j"} for idx in range(n_chunks)]
+
+
+def test_concurrency_bounds_in_flight_extractions_and_wall_time():
+    chunks = make_chunks(16)
+    latency, concurrency = 0.05, 4
+    extractor = fake_extractor(latency)
+    in_flight, max_in_flight = 0, 0
+
+    async def tracked_extractor(chunk):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        try:
+            return await extractor(chunk)
+        finally:
+            in_flight -= 1
+
+    start = time.perf_counter()
+    failed_chunks = extract_chunks(chunks, tracked_extractor, ExtractionConfig(concurrency=concurrency))
+    seconds = time.perf_counter() - start
+
+    assert failed_chunks == []
+    assert max_in_flight == concurrency
+    # (chunks / concurrency) x latency, not the sum of the latencies
+    assert len(chunks) / concurrency * latency <= seconds < len(chunks) * latency / 2
+
+
+def test_results_keep_chunk_order():
+    chunks = make_chunks(8)
+
+    async def reversed_latency_extractor(chunk):
+        await asyncio.sleep(0.01 * (len(chunks) - chunk["id"]))  # Later chunks finish first
+        return {"named_entities": [f"entity {chunk['id']}"], "triples": [[f"entity {chunk['id']}", "is", "chunk"]]}
+
+    completion_order = []
+    failed_chunks = asyncio.run(extract_chunks_async(chunks, reversed_latency_extractor, ExtractionConfig(concurrency=8),
+                                                     on_chunk_extracted=lambda chunk: completion_order.append(chunk["id"])))
+
+    assert failed_chunks == []
+    assert completion_order == list(reversed(range(len(chunks))))
+    assert [chunk["id"] for chunk in chunks] == list(range(len(chunks)))
+    assert [chunk["named_entities"] for chunk in chunks] == [[f"entity {idx}"] for idx in range(len(chunks))]
+
+
+def test_failed_attempts_are_retried():
+    chunks = make_chunks(4)
+    attempts = Counter()
+    config = ExtractionConfig(concurrency=2, max_retries=3, initial_backoff=0.0)
+
+    failed_chunks = extract_chunks(chunks, fake_extractor(0.0, failures_per_chunk=2, attempts=attempts), config)
+
+    assert failed_chunks == []
+    assert attempts == {chunk["id"]: 3 for chunk in chunks}
+    assert all(chunk["named_entities"] == ["Chunk", "Neo4j"] for chunk in chunks)
+
+
+def test_chunks_failing_all_retries_are_left_pending():
+    chunks = make_chunks(4)
+    attempts = Counter()
+    config = ExtractionConfig(concurrency=4, max_retries=1, initial_backoff=0.0)
+
+    failed_chunks = extract_chunks(chunks, fake_extractor(0.0, failures_per_chunk=5, attempts=attempts), config)
+
+    assert [chunk["id"] for chunk in failed_chunks] == [0, 1, 2, 3]
+    assert attempts == {chunk["id"]: 2 for chunk in chunks}
+    assert not any("named_entities" in chunk or "triples" in chunk for chunk in chunks)
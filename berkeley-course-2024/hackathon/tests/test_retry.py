@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from hackathon.retry import RetryConfig, retry_async, retry_call
+
+
+def flaky(failures: int, error: type = ValueError):
+    calls = []
+
+    def call():
+        calls.append(len(calls))
+        if len(calls) <= failures:
+            raise error(f"failure {len(calls)}")
+        return "done"
+
+    return call, calls
+
+
+def test_backoff_doubles_up_to_the_max_with_jitter():
+    config = RetryConfig(initial_backoff=1.0, max_backoff=5.0)
+    for attempt, backoff in enumerate([1.0, 2.0, 4.0, 5.0, 5.0]):
+        assert backoff <= config.backoff(attempt) < 2 * backoff
+
+
+def test_retry_call_retries_until_success():
+    fn, calls = flaky(2)
+    retries = []
+
+    result = retry_call(fn, RetryConfig(max_retries=3, initial_backoff=0.0),
+                        on_retry=lambda attempt, e, wait: retries.append((attempt, str(e))))
+
+    assert result == "done"
+    assert len(calls) == 3
+    assert retries == [(0, "failure 1"), (1, "failure 2")]
+
+
+def test_retry_call_raises_the_last_error_after_max_retries():
+    fn, calls = flaky(5)
+
+    with pytest.raises(ValueError, match="failure 3"):
+        retry_call(fn, RetryConfig(max_retries=2, initial_backoff=0.0))
+    assert len(calls) == 3
+
+
+def test_retry_call_only_retries_the_given_errors():
+    fn, calls = flaky(1, error=KeyError)
+
+    with pytest.raises(KeyError):
+        retry_call(fn, RetryConfig(initial_backoff=0.0), retry_on=(ValueError,))
+    assert len(calls) == 1
+
+
+def test_retry_async_retries_until_success():
+    fn, calls = flaky(2)
+
+    async def async_fn():
+        return fn()
+
+    assert asyncio.run(retry_async(async_fn, RetryConfig(max_retries=2, initial_backoff=0.0))) == "done"
+    assert len(calls) == 3